@@ -0,0 +1,99 @@
+import io
+import os
+
+import pdfrw
+from django.conf import settings
+from django.core.files.base import ContentFile
+from PIL import Image, ImageOps, UnidentifiedImageError
+
+PREVIEW = "preview"
+
+
+def thumbnail_kind(size):
+    return f"thumb-{size}"
+
+
+def derivative_name(source_name, kind, extension):
+    """
+    Derivatives are stored next to their original, e.g.
+    images/sku/<uid>/photo.png -> images/sku/<uid>/photo.thumb-256.jpg
+    """
+    root, _ = os.path.splitext(source_name)
+    return f"{root}.{kind}.{extension}"
+
+
+def thumbnail_size(size):
+    """
+    The smallest generated thumbnail at least `size` pixels across, or the
+    largest one there is.
+    """
+    sizes = sorted(settings.THUMBNAIL_SIZES)
+    for candidate in sizes:
+        if candidate >= size:
+            return candidate
+    return sizes[-1]
+
+
+def make_thumbnails(data):
+    """
+    Returns {kind: jpeg bytes} for every configured size, or {} when data is
+    not an image Pillow can read.
+    """
+    try:
+        image = Image.open(io.BytesIO(data))
+        image.load()
+    except (UnidentifiedImageError, OSError):
+        return {}
+    image = ImageOps.exif_transpose(image).convert("RGB")
+    thumbnails = {}
+    for size in sorted(settings.THUMBNAIL_SIZES, reverse=True):
+        # downscale from the previous (larger) thumbnail, not the original
+        image.thumbnail((size, size), Image.LANCZOS)
+        out = io.BytesIO()
+        image.save(out, "JPEG", quality=85, optimize=True)
+        thumbnails[thumbnail_kind(size)] = out.getvalue()
+    return thumbnails
+
+
+def make_pdf_preview(data):
+    """
+    Returns a PDF holding only the first page of data, or None when data is
+    not a PDF.
+    """
+    if not data.startswith(b"%PDF"):
+        return None
+    try:
+        reader = pdfrw.PdfReader(fdata=data)
+    except Exception:
+        return None
+    if not reader.pages:
+        return None
+    writer = pdfrw.PdfWriter()
+    writer.addpage(reader.pages[0])
+    out = io.BytesIO()
+    writer.write(out)
+    return out.getvalue()
+
+
+def derive(storage, source_name):
+    """
+    Generates and stores the derivatives of one stored file, returning
+    {kind: (storage name, size)}.
+    """
+    if storage.size(source_name) > settings.DERIVATIVE_MAX_SOURCE_SIZE:
+        return {}
+    with storage.open(source_name, "rb") as f:
+        data = f.read()
+    derived = {
+        kind: (derivative_name(source_name, kind, "jpg"), content)
+        for kind, content in make_thumbnails(data).items()
+    }
+    preview = make_pdf_preview(data)
+    if preview is not None:
+        derived[PREVIEW] = (derivative_name(source_name, PREVIEW, "pdf"), preview)
+    stored = {}
+    for kind, (name, content) in derived.items():
+        if storage.exists(name):
+            storage.delete(name)
+        stored[kind] = (storage.save(name, ContentFile(content)), len(content))
+    return stored
@@ -0,0 +1,177 @@
+import os
+import queue
+import threading
+import zipfile
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+from django.utils import timezone
+from django.utils.text import get_valid_filename
+
+from app.uploads import iter_storage_chunks
+
+EXPORT_CHUNK_SIZE = 256 * 1024
+# chunks buffered per prefetched file, bounding memory to
+# prefetch * PREFETCH_QUEUE_SIZE * EXPORT_CHUNK_SIZE
+PREFETCH_QUEUE_SIZE = 8
+_DONE = object()
+
+
+class ExportEntry:
+    def __init__(self, arcname, storage, name, modified):
+        self.arcname = arcname
+        self.storage = storage
+        self.name = name
+        self.modified = modified
+
+    def chunks(self):
+        return iter_storage_chunks(self.storage, self.name, EXPORT_CHUNK_SIZE)
+
+
+class _ZipStream:
+    """
+    Write-only file object for ZipFile that hands its bytes back to the
+    response as they are produced. Without seek() ZipFile writes data
+    descriptors instead of going back to patch headers.
+    """
+
+    def __init__(self):
+        self._buffer = bytearray()
+        self._position = 0
+
+    def write(self, data):
+        self._buffer += data
+        self._position += len(data)
+        return len(data)
+
+    def tell(self):
+        return self._position
+
+    def flush(self):
+        pass
+
+    def drain(self):
+        data = bytes(self._buffer)
+        self._buffer.clear()
+        return data
+
+
+def _fill(chunks, chunk_queue, stop):
+    def put(item):
+        while not stop.is_set():
+            try:
+                chunk_queue.put(item, timeout=1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    try:
+        for chunk in chunks:
+            if not put(chunk):
+                return
+        put(_DONE)
+    except Exception as e:
+        put(e)
+
+
+def _drain(chunk_queue):
+    while True:
+        item = chunk_queue.get()
+        if item is _DONE:
+            return
+        if isinstance(item, Exception):
+            raise item
+        yield item
+
+
+def _prefetched(entries, prefetch):
+    """
+    Yields (entry, chunks) in order while up to `prefetch` upcoming files are
+    read from storage concurrently into bounded queues.
+    """
+    stop = threading.Event()
+    pending = deque()
+    entries = iter(entries)
+    with ThreadPoolExecutor(max_workers=prefetch) as pool:
+        try:
+            while True:
+                while len(pending) < prefetch:
+                    entry = next(entries, None)
+                    if entry is None:
+                        break
+                    chunk_queue = queue.Queue(maxsize=PREFETCH_QUEUE_SIZE)
+                    pool.submit(_fill, entry.chunks(), chunk_queue, stop)
+                    pending.append((entry, chunk_queue))
+                if not pending:
+                    return
+                entry, chunk_queue = pending.popleft()
+                yield entry, _drain(chunk_queue)
+        finally:
+            # the client went away or a read failed: release blocked readers
+            stop.set()
+
+
+def export_entries(obj, include_rendered_forms=False):
+    """
+    The files exported for an object: its attachments under attachments/ and,
+    if asked and the object has any, its rendered forms under forms/.
+    """
+    arcnames = set()
+
+    def unique(folder, filename):
+        filename = get_valid_filename(os.path.basename(filename)) or "file"
+        arcname = f"{folder}/{filename}"
+        stem, dot, extension = arcname.rpartition(".")
+        if not dot:
+            stem, extension = arcname, ""
+        candidate, n = arcname, 1
+        while candidate in arcnames:
+            n += 1
+            candidate = f"{stem} ({n}){dot}{extension}"
+        arcnames.add(candidate)
+        return candidate
+
+    for attachment in obj.attachments.order_by("created_at"):
+        yield ExportEntry(
+            unique("attachments", attachment.name),
+            attachment.attached_file.storage,
+            attachment.attached_file.name,
+            attachment.created_at,
+        )
+    rendered_forms = getattr(obj, "rendered_forms", None)
+    if include_rendered_forms and rendered_forms is not None:
+        forms = rendered_forms.select_related("template").exclude(rendered_file="")
+        for form in forms:
+            template_name = form.template.name if form.template else "form"
+            yield ExportEntry(
+                unique("forms", f"{template_name}.pdf"),
+                form.rendered_file.storage,
+                form.rendered_file.name,
+                form.template.updated_at if form.template else timezone.now(),
+            )
+
+
+def _zip_pieces(entries, prefetch):
+    if prefetch:
+        files = _prefetched(entries, prefetch)
+    else:
+        files = ((entry, entry.chunks()) for entry in entries)
+    stream = _ZipStream()
+    with zipfile.ZipFile(stream, "w", zipfile.ZIP_STORED, allowZip64=True) as archive:
+        for entry, chunks in files:
+            info = zipfile.ZipInfo(entry.arcname, entry.modified.timetuple()[:6])
+            with archive.open(info, "w", force_zip64=True) as dest:
+                for chunk in chunks:
+                    dest.write(chunk)
+                    yield stream.drain()
+            yield stream.drain()
+    yield stream.drain()
+
+
+def stream_zip(entries, prefetch=0):
+    """
+    Yields a ZIP archive of entries piece by piece, holding no more than a
+    few chunks in memory however large the files are.
+    """
+    return (piece for piece in _zip_pieces(entries, prefetch) if piece)
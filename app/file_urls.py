@@ -0,0 +1,50 @@
+import hashlib
+
+from django.conf import settings
+from django.core.cache import cache
+
+
+def is_signing_storage(storage):
+    return hasattr(storage, "bucket")
+
+
+def url_cache_key(storage, name):
+    digest = hashlib.sha1(name.encode()).hexdigest()
+    return f"file-url:{storage.__class__.__name__}:{digest}"
+
+
+def url_cache_timeout():
+    # stop handing a URL out well before S3 starts rejecting it
+    return max(settings.SIGNED_URL_EXPIRY - settings.SIGNED_URL_EXPIRY_MARGIN, 0)
+
+
+def storage_url(storage, name):
+    if is_signing_storage(storage):
+        return storage.url(name, expire=settings.SIGNED_URL_EXPIRY)
+    return storage.url(name)
+
+
+def storage_urls(storage, names):
+    """
+    Returns {name: url} for many names in one storage, fetching cached URLs
+    with a single cache round trip and caching the newly signed ones together.
+    """
+    keys = {url_cache_key(storage, name): name for name in names}
+    urls = {keys[key]: url for key, url in cache.get_many(keys).items()}
+    signed = {}
+    for key, name in keys.items():
+        if name not in urls:
+            signed[key] = urls[name] = storage_url(storage, name)
+    if signed:
+        cache.set_many(signed, url_cache_timeout())
+    return urls
+
+
+def file_url(field_file):
+    """
+    Returns a (signed, for S3) GET URL for a FieldFile, reusing the one issued
+    for the same storage name until shortly before it expires.
+    """
+    if not field_file:
+        return ""
+    return storage_urls(field_file.storage, [field_file.name])[field_file.name]
@@ -0,0 +1,372 @@
+import threading
+import time
+from contextlib import ExitStack, contextmanager
+from contextvars import ContextVar
+from functools import partial, wraps
+
+from django.conf import settings
+from django.db import connections
+from graphene.types.resolver import attr_resolver, dict_or_attr_resolver
+from graphql.execution.middleware import MiddlewareManager
+
+DURATION_BUCKETS = (
+    0.001,
+    0.0025,
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1,
+    2.5,
+    5,
+    10,
+)
+QUERY_COUNT_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100, 200, 500)
+# label values beyond this many per metric are folded into "other", so
+# client-chosen operation names cannot grow the registry without bound
+MAX_LABEL_SETS = 200
+# slowest resolver paths listed in the Server-Timing header
+SERVER_TIMING_RESOLVERS = 10
+
+DEFAULT_RESOLVERS = (attr_resolver, dict_or_attr_resolver)
+
+_current_trace = ContextVar("current_trace", default=None)
+
+
+def current_trace():
+    return _current_trace.get()
+
+
+class Histogram:
+    """
+    Prometheus histogram kept in process memory. Each worker process
+    aggregates and exposes its own observations.
+    """
+
+    def __init__(self, name, documentation, labelnames, buckets):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(buckets)
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value, *labels):
+        with self._lock:
+            series = self._series.get(labels)
+            if series is None:
+                if len(self._series) >= MAX_LABEL_SETS:
+                    labels = ("other",) * len(self.labelnames)
+                series = self._series.setdefault(
+                    labels, [[0] * len(self.buckets), 0, 0.0]
+                )
+            counts = series[0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+            series[1] += 1
+            series[2] += value
+
+    def render(self):
+        lines = [
+            f"# HELP {self.name} {self.documentation}",
+            f"# TYPE {self.name} histogram",
+        ]
+        with self._lock:
+            series = sorted(
+                (labels, list(counts), count, total)
+                for labels, (counts, count, total) in self._series.items()
+            )
+        for labels, counts, count, total in series:
+            pairs = [
+                f'{name}="{_escape_label(value)}"'
+                for name, value in zip(self.labelnames, labels)
+            ]
+            for bound, bucket_count in zip(self.buckets, counts):
+                le = ",".join(pairs + [f'le="{bound}"'])
+                lines.append(f"{self.name}_bucket{{{le}}} {bucket_count}")
+            le = ",".join(pairs + ['le="+Inf"'])
+            lines.append(f"{self.name}_bucket{{{le}}} {count}")
+            lines.append(f"{self.name}_sum{{{','.join(pairs)}}} {total}")
+            lines.append(f"{self.name}_count{{{','.join(pairs)}}} {count}")
+        return "\n".join(lines)
+
+
+def _escape_label(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+OPERATION_DURATION = Histogram(
+    "graphql_operation_duration_seconds",
+    "Wall time of requests running a GraphQL operation.",
+    ["operation"],
+    DURATION_BUCKETS,
+)
+OPERATION_DB_QUERIES = Histogram(
+    "graphql_operation_db_queries",
+    "Database queries per GraphQL operation.",
+    ["operation"],
+    QUERY_COUNT_BUCKETS,
+)
+OPERATION_DB_DURATION = Histogram(
+    "graphql_operation_db_duration_seconds",
+    "Database time per GraphQL operation.",
+    ["operation"],
+    DURATION_BUCKETS,
+)
+RESOLVER_DURATION = Histogram(
+    "graphql_resolver_duration_seconds",
+    "Wall time one request spent in a field's resolver, over all its calls.",
+    ["field"],
+    DURATION_BUCKETS,
+)
+RESOLVER_DB_QUERIES = Histogram(
+    "graphql_resolver_db_queries",
+    "Database queries one request made in a field's resolver.",
+    ["field"],
+    QUERY_COUNT_BUCKETS,
+)
+RESOLVER_DB_DURATION = Histogram(
+    "graphql_resolver_db_duration_seconds",
+    "Database time one request spent in a field's resolver.",
+    ["field"],
+    DURATION_BUCKETS,
+)
+METRICS = [
+    OPERATION_DURATION,
+    OPERATION_DB_QUERIES,
+    OPERATION_DB_DURATION,
+    RESOLVER_DURATION,
+    RESOLVER_DB_QUERIES,
+    RESOLVER_DB_DURATION,
+]
+
+
+def render_metrics():
+    return "\n".join(metric.render() for metric in METRICS) + "\n"
+
+
+class ResolverStats:
+    __slots__ = ("path", "field", "calls", "duration", "db_queries", "db_duration")
+
+    def __init__(self, path, field):
+        self.path = path
+        self.field = field
+        self.calls = 0
+        self.duration = 0.0
+        self.db_queries = 0
+        self.db_duration = 0.0
+
+
+class Trace:
+    """
+    Wall time, database queries and database time of one request, in total
+    and per resolver path ("clients.edges.node.invoiceCounts"). Queries are
+    counted against the resolver or loader batch running when they execute.
+    """
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.duration = None
+        self.operation = None
+        self.db_queries = 0
+        self.db_duration = 0.0
+        self.resolvers = {}
+        self._active = None
+
+    def execute(self, execute, sql, params, many, context):
+        started = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            elapsed = time.perf_counter() - started
+            self.db_queries += 1
+            self.db_duration += elapsed
+            if self._active is not None:
+                self._active.db_queries += 1
+                self._active.db_duration += elapsed
+
+    def stats(self, path, field):
+        stats = self.resolvers.get(path)
+        if stats is None:
+            stats = self.resolvers[path] = ResolverStats(path, field)
+        return stats
+
+    @contextmanager
+    def resolving(self, stats):
+        previous, self._active = self._active, stats
+        try:
+            yield
+        finally:
+            self._active = previous
+
+    def finish(self):
+        self.duration = time.perf_counter() - self.started
+
+    def elapsed(self):
+        if self.duration is not None:
+            return self.duration
+        return time.perf_counter() - self.started
+
+    def slowest(self, count=None):
+        resolvers = sorted(
+            self.resolvers.values(), key=lambda stats: stats.duration, reverse=True
+        )
+        return resolvers[:count]
+
+    def server_timing(self):
+        entries = [
+            f"total;dur={self.elapsed() * 1000:.1f}",
+            f'db;dur={self.db_duration * 1000:.1f};desc="{self.db_queries} queries"',
+        ]
+        for stats in self.slowest(SERVER_TIMING_RESOLVERS):
+            entries.append(
+                f"{stats.path};dur={stats.duration * 1000:.1f};"
+                f'desc="{stats.calls} calls, {stats.db_queries} queries"'
+            )
+        return ", ".join(entries)
+
+    def as_extension(self):
+        return {
+            "operation": self.operation,
+            "duration": round(self.elapsed() * 1000, 3),
+            "dbQueries": self.db_queries,
+            "dbDuration": round(self.db_duration * 1000, 3),
+            "resolvers": [
+                {
+                    "path": stats.path,
+                    "field": stats.field,
+                    "calls": stats.calls,
+                    "duration": round(stats.duration * 1000, 3),
+                    "dbQueries": stats.db_queries,
+                    "dbDuration": round(stats.db_duration * 1000, 3),
+                }
+                for stats in self.slowest()
+            ],
+        }
+
+    def observe(self):
+        if self.operation is None:
+            return
+        OPERATION_DURATION.observe(self.elapsed(), self.operation)
+        OPERATION_DB_QUERIES.observe(self.db_queries, self.operation)
+        OPERATION_DB_DURATION.observe(self.db_duration, self.operation)
+        fields = {}
+        for stats in self.resolvers.values():
+            totals = fields.setdefault(stats.field, [0.0, 0, 0.0])
+            totals[0] += stats.duration
+            totals[1] += stats.db_queries
+            totals[2] += stats.db_duration
+        for field, (duration, db_queries, db_duration) in fields.items():
+            RESOLVER_DURATION.observe(duration, field)
+            RESOLVER_DB_QUERIES.observe(db_queries, field)
+            RESOLVER_DB_DURATION.observe(db_duration, field)
+
+
+class ResolverTimingMiddleware:
+    """
+    Graphene middleware timing every resolver that is not a plain attribute
+    lookup, for as long as the resolver call takes. A lazy queryset it
+    returns is left for graphene to evaluate (and slice) as before, so its
+    query counts against whatever resolver is active then, not this one. One
+    returning a loader promise is timed until it returns: the batch it joins
+    is timed by traced_batch.
+    """
+
+    def resolve(self, next, root, info, **args):
+        trace = _current_trace.get()
+        if trace is None:
+            return next(root, info, **args)
+        if trace.operation is None:
+            name = info.operation.name
+            trace.operation = name.value if name else "anonymous"
+        if isinstance(next, partial) and next.func in DEFAULT_RESOLVERS:
+            return next(root, info, **args)
+
+        path = ".".join(str(key) for key in info.path if not isinstance(key, int))
+        stats = trace.stats(path, f"{info.parent_type.name}.{info.field_name}")
+        stats.calls += 1
+        started = time.perf_counter()
+        try:
+            with trace.resolving(stats):
+                return next(root, info, **args)
+        finally:
+            stats.duration += time.perf_counter() - started
+
+
+resolver_middleware = MiddlewareManager(
+    ResolverTimingMiddleware(), wrap_in_promise=False
+)
+
+
+def traced_batch(batch_load_fn):
+    """
+    Counts a DataLoader batch's queries and time under loader.<ClassName>,
+    since batches run after the resolvers that queued their keys returned.
+    """
+
+    @wraps(batch_load_fn)
+    def wrapper(self, keys):
+        trace = _current_trace.get()
+        if trace is None:
+            return batch_load_fn(self, keys)
+        name = type(self).__name__
+        stats = trace.stats(f"loader.{name}", name)
+        stats.calls += 1
+        started = time.perf_counter()
+        try:
+            with trace.resolving(stats):
+                return batch_load_fn(self, keys)
+        finally:
+            stats.duration += time.perf_counter() - started
+
+    return wrapper
+
+
+class TimingMiddleware:
+    """
+    Traces each request: database queries of every connection are timed,
+    GraphQL operations are added to the histograms served at /metrics and,
+    if GRAPHQL_SERVER_TIMING is on, the response gets a Server-Timing header
+    with the totals and the slowest resolvers.
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        trace = Trace()
+        token = _current_trace.set(trace)
+        try:
+            with ExitStack() as stack:
+                for connection in connections.all():
+                    stack.enter_context(connection.execute_wrapper(trace.execute))
+                response = self.get_response(request)
+        finally:
+            _current_trace.reset(token)
+        trace.finish()
+        if server_timing_enabled():
+            response["Server-Timing"] = trace.server_timing()
+        trace.observe()
+        return response
+
+
+def tracing_enabled():
+    return getattr(settings, "GRAPHQL_TRACING", False)
+
+
+def server_timing_enabled():
+    return getattr(settings, "GRAPHQL_SERVER_TIMING", False)
+
+
+def metrics_allowed(request):
+    """
+    /metrics is served to local scrapers only: loopback and INTERNAL_IPS.
+    """
+    address = request.META.get("REMOTE_ADDR")
+    return address in ("127.0.0.1", "::1") or address in getattr(
+        settings, "INTERNAL_IPS", ()
+    )
@@ -0,0 +1,222 @@
+import json
+
+from django.db import models
+from django.db.models import Case, F, Func, Value, When
+from django.db.models.functions import Coalesce
+from django.utils import timezone
+
+
+def json_path(path):
+    """
+    Compiles a path into a JSON path expression. A path is a dotted string of
+    object keys ("vendor.address") or a list mixing keys and array indices
+    (["stops", 0, "port"]).
+    """
+    if isinstance(path, str):
+        path = path.split(".")
+    if not path:
+        raise ValueError("An empty path addresses the whole document")
+    compiled = "$"
+    for key in path:
+        if isinstance(key, int):
+            compiled += f"[{key}]"
+        elif isinstance(key, str) and key and '"' not in key and "\\" not in key:
+            compiled += f'."{key}"'
+        else:
+            raise ValueError(f"Invalid JSON path segment {key!r}")
+    return compiled
+
+
+class JSONFunc(Func):
+    """
+    A JSON function named `function` on MySQL/MariaDB and `sqlite_function`
+    on SQLite.
+    """
+
+    sqlite_function = None
+
+    def __init__(self, *expressions):
+        super().__init__(*expressions, output_field=models.JSONField())
+
+    def as_sqlite(self, compiler, connection, **extra_context):
+        return self.as_sql(
+            compiler, connection, function=self.sqlite_function, **extra_context
+        )
+
+
+class JSONLiteral(JSONFunc):
+    """
+    A Python value passed in as JSON text, so the functions below insert it
+    as JSON rather than as a string.
+    """
+
+    function = "JSON_EXTRACT"
+    template = "%(function)s(%(expressions)s, '$')"
+    sqlite_function = "json"
+
+    def __init__(self, value):
+        super().__init__(Value(json.dumps(value)))
+
+    def as_sqlite(self, compiler, connection, **extra_context):
+        return super().as_sqlite(
+            compiler, connection, template="%(function)s(%(expressions)s)"
+        )
+
+
+class JSONInsert(JSONFunc):
+    function = "JSON_INSERT"
+    sqlite_function = "json_insert"
+
+
+class JSONSet(JSONFunc):
+    function = "JSON_SET"
+    sqlite_function = "json_set"
+
+
+class JSONRemove(JSONFunc):
+    function = "JSON_REMOVE"
+    sqlite_function = "json_remove"
+
+
+class JSONMergePatch(JSONFunc):
+    function = "JSON_MERGE_PATCH"
+    sqlite_function = "json_patch"
+
+
+class JSONArrayAppend(JSONFunc):
+    function = "JSON_ARRAY_APPEND"
+    sqlite_function = "json_insert"
+
+    def __init__(self, document, path, value):
+        super().__init__(document, Value(path), value)
+
+    def as_sqlite(self, compiler, connection, **extra_context):
+        # SQLite appends by inserting past the end of the array
+        document, path, value = self.get_source_expressions()
+        clone = self.copy()
+        clone.set_source_expressions([document, Value(f"{path.value}[#]"), value])
+        return super(JSONArrayAppend, clone).as_sqlite(
+            compiler, connection, **extra_context
+        )
+
+
+class MetadataPatch:
+    """
+    An ordered list of edits to a JSON column, compiled into one expression
+    so the database applies them to the stored document in a single UPDATE:
+
+        MetadataPatch().set("vendor", "ACME").remove("draft").apply(qs)
+
+    Concurrent patches to different keys no longer overwrite each other and
+    only the statement, not the whole document, travels to the database.
+    Setting a nested path requires its parent object to exist; use merge()
+    to create nested objects.
+    """
+
+    OPERATIONS = ("set", "merge", "remove", "append")
+
+    def __init__(self, operations=()):
+        self.operations = []
+        for operation in operations:
+            operation = dict(operation)
+            op = operation.pop("op", None)
+            if op not in self.OPERATIONS:
+                raise ValueError(f"Unknown patch operation {op!r}")
+            getattr(self, op)(**operation)
+
+    def __bool__(self):
+        return bool(self.operations)
+
+    def set(self, path, value):
+        self.operations.append(("set", json_path(path), value))
+        return self
+
+    def merge(self, value):
+        """
+        Applies an RFC 7396 merge patch: objects merge recursively and keys
+        set to None are removed.
+        """
+        if not isinstance(value, dict):
+            raise ValueError("A merge patch must be an object")
+        self.operations.append(("merge", None, value))
+        return self
+
+    def remove(self, path):
+        self.operations.append(("remove", json_path(path), None))
+        return self
+
+    def append(self, path, value):
+        """
+        Appends value to the array at path, creating the array if needed.
+        """
+        self.operations.append(("append", json_path(path), value))
+        return self
+
+    @classmethod
+    def update(cls, values):
+        """
+        The patch equivalent of dict.update(values).
+        """
+        patch = cls()
+        for key, value in values.items():
+            patch.set([key], value)
+        return patch
+
+    def expression(self, field):
+        document = Coalesce(F(field), Value("{}"), output_field=models.JSONField())
+        for op, path, value in self.operations:
+            if op == "set":
+                document = JSONSet(document, Value(path), JSONLiteral(value))
+            elif op == "merge":
+                document = JSONMergePatch(document, Value(json.dumps(value)))
+            elif op == "remove":
+                document = JSONRemove(document, Value(path))
+            elif op == "append":
+                document = JSONInsert(document, Value(path), JSONLiteral([]))
+                document = JSONArrayAppend(document, path, JSONLiteral(value))
+        return document
+
+    def apply(self, queryset, field="metadata", **updates):
+        """
+        Patches `field` on every row of queryset in one UPDATE, along with
+        any other column values in updates. Returns the number of rows.
+        """
+        if self:
+            updates[field] = self.expression(field)
+        return queryset.update(**_touch(queryset.model), **updates)
+
+
+def patch_many(model, patches, field="metadata"):
+    """
+    Applies a different patch to each row, given {pk: MetadataPatch}, in one
+    UPDATE. Returns the number of rows.
+    """
+    patches = {pk: patch for pk, patch in patches.items() if patch}
+    if not patches:
+        return 0
+    document = Case(
+        *[When(pk=pk, then=patch.expression(field)) for pk, patch in patches.items()],
+        default=F(field),
+        output_field=models.JSONField(),
+    )
+    return model._default_manager.filter(pk__in=patches).update(
+        **{field: document}, **_touch(model)
+    )
+
+
+def replace_document(queryset, value, field="metadata"):
+    """
+    Overwrites `field` on every row of queryset with value in one UPDATE,
+    bumping auto_now fields as patches do. Returns the number of rows.
+    """
+    return queryset.update(**_touch(queryset.model), **{field: value})
+
+
+def _touch(model):
+    # update() skips auto_now, which e.g. the form template cache keys on
+    now = timezone.now()
+    return {
+        f.name: now
+        for f in model._meta.concrete_fields
+        if getattr(f, "auto_now", False)
+    }
@@ -0,0 +1,183 @@
+import base64
+import json
+import uuid
+
+import graphene
+from django.conf import settings
+from django.db import connections
+from django.db.models import F, Q, QuerySet
+from django.utils.dateparse import parse_datetime
+from graphene.relay import Connection, ConnectionField, PageInfo
+from graphene_django.utils import maybe_queryset
+
+from app.optimizer import OptimizedConnectionField
+
+CURSOR_ANNOTATION = "keyset_created_at"
+
+
+def keyset_fields(model):
+    """
+    The columns pages are ordered by: (created_at, uid), or just uid for
+    models without created_at.
+    """
+    names = {field.name for field in model._meta.concrete_fields}
+    return ["created_at", "pk"] if "created_at" in names else ["pk"]
+
+
+def encode_cursor(row, fields):
+    values = []
+    for field in fields:
+        if field == "pk":
+            values.append(str(row.pk))
+        else:
+            values.append(getattr(row, CURSOR_ANNOTATION).isoformat())
+    return base64.urlsafe_b64encode(json.dumps(values).encode()).decode()
+
+
+def decode_cursor(cursor, fields):
+    try:
+        values = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+        if len(values) != len(fields):
+            raise ValueError(cursor)
+        decoded = [
+            uuid.UUID(value) if field == "pk" else parse_datetime(value)
+            for field, value in zip(fields, values)
+        ]
+    except (AttributeError, TypeError, ValueError):
+        raise Exception(f"Invalid cursor {cursor}")
+    if None in decoded:
+        raise Exception(f"Invalid cursor {cursor}")
+    return decoded
+
+
+def beyond(fields, values, lookup):
+    """
+    Rows after (lookup "gt") or before ("lt") the row with these values in
+    the lexicographic order of fields.
+    """
+    condition = Q()
+    equal = {}
+    for field, value in zip(fields, values):
+        condition |= Q(**equal, **{f"{field}__{lookup}": value})
+        equal[field] = value
+    return condition
+
+
+def approximate_count(queryset):
+    """
+    The table's row estimate for unfiltered querysets on MySQL/MariaDB,
+    otherwise an exact count that stops at APPROXIMATE_COUNT_LIMIT.
+    """
+    connection = connections[queryset.db]
+    if connection.vendor == "mysql" and not queryset.query.where:
+        with connection.cursor() as cursor:
+            cursor.execute(
+                "SELECT TABLE_ROWS FROM information_schema.TABLES "
+                "WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = %s",
+                [queryset.model._meta.db_table],
+            )
+            row = cursor.fetchone()
+        if row and row[0] is not None:
+            return row[0]
+    limit = getattr(settings, "APPROXIMATE_COUNT_LIMIT", 10000)
+    return queryset.order_by()[:limit].count()
+
+
+class KeysetConnection(Connection):
+    class Meta:
+        abstract = True
+
+    approximate_count = graphene.Int()
+
+    def resolve_approximate_count(root, info):
+        return approximate_count(root.iterable)
+
+
+_keyset_connections = {}
+
+
+def keyset_connection(node):
+    if node not in _keyset_connections:
+        _keyset_connections[node] = type(
+            f"{node.__name__}KeysetConnection",
+            (KeysetConnection,),
+            {"Meta": type("Meta", (), {"node": node})},
+        )
+    return _keyset_connections[node]
+
+
+class KeysetConnectionField(OptimizedConnectionField):
+    """
+    OptimizedConnectionField that pages by (created_at, uid) instead of
+    OFFSET, so every page costs the same however deep it is, and that only
+    counts rows when approximateCount is asked for. Cursors are opaque and
+    stay valid while rows are inserted or deleted. offset still works but is
+    deprecated: it skips rows with OFFSET, which costs what keyset paging
+    saves.
+    """
+
+    def __init__(self, *args, **kwargs):
+        kwargs.setdefault(
+            "offset",
+            graphene.Int(
+                description=(
+                    "Deprecated: rows to skip, which the database still reads. "
+                    "Pass the previous page's endCursor as after instead."
+                )
+            ),
+        )
+        super().__init__(*args, **kwargs)
+
+    @property
+    def type(self):
+        return keyset_connection(super(ConnectionField, self).type)
+
+    @classmethod
+    def resolve_connection(cls, connection, args, iterable, max_limit=None):
+        iterable = maybe_queryset(iterable)
+        if not isinstance(iterable, QuerySet):
+            return super().resolve_connection(connection, args, iterable, max_limit)
+        fields = keyset_fields(iterable.model)
+        queryset = iterable
+        if "created_at" in fields:
+            queryset = queryset.annotate(**{CURSOR_ANNOTATION: F("created_at")})
+        after, before = args.get("after"), args.get("before")
+        if after:
+            queryset = queryset.filter(
+                beyond(fields, decode_cursor(after, fields), "gt")
+            )
+        if before:
+            queryset = queryset.filter(
+                beyond(fields, decode_cursor(before, fields), "lt")
+            )
+
+        first, last = args.get("first"), args.get("last")
+        if first is None and last is None:
+            first = max_limit
+        backwards = first is None
+        limit = last if backwards else first
+        ordering = [f"-{field}" for field in fields] if backwards else fields
+        queryset = queryset.order_by(*ordering)
+        offset = args.get("offset") or 0
+        if offset:
+            queryset = queryset[offset:]
+        rows = list(queryset if limit is None else queryset[: limit + 1])
+        has_more = limit is not None and len(rows) > limit
+        rows = rows[:limit]
+        if backwards:
+            rows.reverse()
+        elif last is not None:
+            rows = rows[-last:]
+
+        edges = [
+            connection.Edge(node=row, cursor=encode_cursor(row, fields)) for row in rows
+        ]
+        page_info = PageInfo(
+            start_cursor=edges[0].cursor if edges else None,
+            end_cursor=edges[-1].cursor if edges else None,
+            has_previous_page=has_more if backwards else bool(after or offset),
+            has_next_page=bool(before or offset) if backwards else has_more,
+        )
+        result = connection(edges=edges, page_info=page_info)
+        result.iterable = iterable
+        return result
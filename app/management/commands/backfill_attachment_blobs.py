@@ -0,0 +1,74 @@
+from concurrent.futures import ThreadPoolExecutor
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import F
+
+from app.models import Attachment, AttachmentBlob, sha256_of_chunks
+from app.uploads import iter_storage_chunks
+
+
+class Command(BaseCommand):
+    help = (
+        "Hash the files of attachments stored before content addressing and "
+        "point them at shared AttachmentBlobs."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--workers",
+            type=int,
+            default=8,
+            help="Files downloaded and hashed concurrently.",
+        )
+        parser.add_argument(
+            "--prune",
+            action="store_true",
+            help="Delete stored files that turned out to duplicate a blob.",
+        )
+
+    def handle(self, *args, workers=8, prune=False, **options):
+        storage = AttachmentBlob._meta.get_field("file").storage
+        names = list(
+            Attachment.objects.filter(blob__isnull=True)
+            .values_list("attached_file", flat=True)
+            .distinct()
+        )
+        self.stdout.write(f"Hashing {len(names)} file(s)...")
+
+        def digest(name):
+            try:
+                return name, sha256_of_chunks(iter_storage_chunks(storage, name))
+            except Exception as e:
+                self.stderr.write(f"{name}: {e}")
+                return name, None
+
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            digests = [(n, d) for n, d in pool.map(digest, names) if d is not None]
+
+        duplicates = []
+        for name, (sha256, size) in digests:
+            with transaction.atomic():
+                blob = AttachmentBlob.objects.filter(sha256=sha256).first()
+                if blob is None:
+                    blob = AttachmentBlob.objects.create(
+                        sha256=sha256, file=name, size=size
+                    )
+                elif blob.file.name != name:
+                    duplicates.append(name)
+                linked = Attachment.objects.filter(
+                    attached_file=name, blob__isnull=True
+                ).update(blob=blob, attached_file=blob.file.name)
+                AttachmentBlob.objects.filter(pk=blob.pk).update(
+                    ref_count=F("ref_count") + linked
+                )
+
+        if prune:
+            for name in duplicates:
+                storage.delete(name)
+        self.stdout.write(
+            self.style.SUCCESS(
+                f"Linked {len(digests)} file(s), {len(duplicates)} duplicate(s)"
+                + (" deleted." if prune else "; rerun with --prune to delete them.")
+            )
+        )
@@ -0,0 +1,41 @@
+from django.contrib.contenttypes.models import ContentType
+from django.core.management.base import BaseCommand
+
+from app.models import UID_MODELS, ObjectUid
+
+
+class Command(BaseCommand):
+    help = (
+        "Record the uid of every existing object in the ObjectUid registry and "
+        "drop entries whose object no longer exists."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--batch-size",
+            type=int,
+            default=1000,
+            help="Registry rows inserted per query.",
+        )
+
+    def handle(self, *args, batch_size=1000, **options):
+        registered = 0
+        for model in UID_MODELS:
+            content_type = ContentType.objects.get_for_model(model)
+            uids = model._default_manager.values_list("pk", flat=True)
+            ObjectUid.objects.bulk_create(
+                (ObjectUid(uid=uid, content_type=content_type) for uid in uids),
+                batch_size=batch_size,
+                ignore_conflicts=True,
+            )
+            stale, _ = (
+                ObjectUid.objects.filter(content_type=content_type)
+                .exclude(uid__in=model._default_manager.values("pk"))
+                .delete()
+            )
+            count = uids.count()
+            registered += count
+            self.stdout.write(
+                f"{model.__name__}: {count} registered, {stale} stale removed"
+            )
+        self.stdout.write(self.style.SUCCESS(f"Registered {registered} uid(s)."))
@@ -0,0 +1,235 @@
+import io
+import json
+import platform
+import statistics
+import subprocess
+import tempfile
+import time
+from datetime import datetime, timezone
+
+import django
+from django.core.files.base import ContentFile
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from django.test.utils import override_settings
+from reportlab.pdfgen import canvas
+
+from app.models import FormTemplate
+from app.rendering import template_cache
+
+STAGES = [
+    "parse_annotations",
+    "fill_template_with_annotation_fields",
+    "get_overlay_canvas",
+    "merge",
+    "write_form",
+    "render_with_data",
+]
+FIELDS_PER_COLUMN = 30
+
+
+def make_template_pdf(field_count, page_count):
+    """
+    Builds an AcroForm PDF with field_count text fields spread over
+    page_count pages.
+    """
+    data = io.BytesIO()
+    pdf = canvas.Canvas(data)
+    for page in range(page_count):
+        for i in range(page, field_count, page_count):
+            slot = i // page_count
+            pdf.acroForm.textfield(
+                name=f"field_{i}",
+                x=40 + (slot // FIELDS_PER_COLUMN % 3) * 180,
+                y=780 - (slot % FIELDS_PER_COLUMN) * 25,
+                width=160,
+                height=18,
+                value="",
+            )
+        pdf.showPage()
+    pdf.save()
+    return data.getvalue()
+
+
+def make_overlay_fields(field_count, page_count):
+    return {
+        f"overlay_{i}": {
+            "type": "text",
+            "coords": [40 + (i // FIELDS_PER_COLUMN % 3) * 180, 60 + i % 30],
+            "size": 8,
+            "page": i % page_count,
+        }
+        for i in range(field_count)
+    }
+
+
+def count_filled(filled, annotations, data):
+    """
+    How many of the template's annotations carry their value from data in
+    the filled PDF.
+    """
+    count = 0
+    for annotation in annotations:
+        value = data.get(annotation["field_name"])
+        if value is None:
+            continue
+        annot = filled.pages[annotation["page"]].Annots[annotation["annot_idx"]]
+        if annot.V == value:
+            count += 1
+    return count
+
+
+def summarize(samples):
+    samples = sorted(samples)
+    return {
+        "n": len(samples),
+        "min_ms": samples[0] * 1000,
+        "median_ms": statistics.median(samples) * 1000,
+        "mean_ms": statistics.mean(samples) * 1000,
+        "p95_ms": samples[min(len(samples) - 1, int(len(samples) * 0.95))] * 1000,
+        "max_ms": samples[-1] * 1000,
+    }
+
+
+def git_revision():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "HEAD"],
+            capture_output=True,
+            check=True,
+            text=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+class Command(BaseCommand):
+    help = (
+        "Time each stage of the PDF form pipeline against synthetic templates "
+        "and print the results as JSON. Rendered files go to a temporary "
+        "directory and all database writes are rolled back."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--fields",
+            type=int,
+            nargs="+",
+            default=[10, 50, 200],
+            help="Annotation field counts to benchmark.",
+        )
+        parser.add_argument(
+            "--pages",
+            type=int,
+            nargs="+",
+            default=[1, 5],
+            help="Page counts to benchmark.",
+        )
+        parser.add_argument(
+            "--overlay-fields",
+            type=int,
+            default=10,
+            help="Overlay (canvas) fields drawn on each template.",
+        )
+        parser.add_argument("--iterations", type=int, default=20)
+        parser.add_argument(
+            "--output", help="Write the JSON results to this file instead."
+        )
+
+    def handle(self, *args, **options):
+        with tempfile.TemporaryDirectory() as media_root:
+            with override_settings(
+                DEFAULT_FILE_STORAGE="django.core.files.storage.FileSystemStorage",
+                MEDIA_ROOT=media_root,
+            ):
+                with transaction.atomic():
+                    results = [
+                        self.bench(
+                            field_count,
+                            page_count,
+                            options["overlay_fields"],
+                            options["iterations"],
+                        )
+                        for field_count in options["fields"]
+                        for page_count in options["pages"]
+                    ]
+                    transaction.set_rollback(True)
+        report = {
+            "revision": git_revision(),
+            "timestamp": datetime.now(timezone.utc).isoformat(),
+            "python": platform.python_version(),
+            "django": django.get_version(),
+            "iterations": options["iterations"],
+            "results": results,
+        }
+        output = json.dumps(report, indent=2)
+        if options["output"]:
+            with open(options["output"], "w") as f:
+                f.write(output + "\n")
+        else:
+            self.stdout.write(output)
+
+    def bench(self, field_count, page_count, overlay_count, iterations):
+        self.stderr.write(f"{field_count} fields on {page_count} page(s)")
+        template = FormTemplate.objects.create(
+            name=f"bench-{field_count}x{page_count}",
+            template_file=ContentFile(
+                make_template_pdf(field_count, page_count), "bench.pdf"
+            ),
+            fields=make_overlay_fields(overlay_count, page_count),
+        )
+        template.write_parsed_annotations()
+        # parsed names are the /T strings made JSON-safe, e.g. "_field_0_"
+        data = {
+            annotation["field_name"]: f"value {i}"
+            for i, annotation in enumerate(template.annotations)
+        }
+        data.update((name, f"overlay {name}") for name in template.fields)
+        # warm the template cache so every stage measures steady-state work
+        template_cache.get(template).data
+        filled = count_filled(
+            template.fill_template_with_annotation_fields(data),
+            template.annotations,
+            data,
+        )
+        if filled != field_count:
+            raise CommandError(
+                f"Filled {filled} of {field_count} annotation fields, the fill "
+                "stage would not measure real work"
+            )
+
+        samples = {stage: [] for stage in STAGES}
+        for _ in range(iterations):
+            start = time.perf_counter()
+            template.parse_annotations(template.template_file)
+            samples["parse_annotations"].append(time.perf_counter() - start)
+
+            start = time.perf_counter()
+            filled = template.fill_template_with_annotation_fields(data)
+            samples["fill_template_with_annotation_fields"].append(
+                time.perf_counter() - start
+            )
+
+            start = time.perf_counter()
+            canvas_data = template.get_overlay_canvas(data)
+            samples["get_overlay_canvas"].append(time.perf_counter() - start)
+
+            start = time.perf_counter()
+            form = template.merge(canvas_data, filled)
+            samples["merge"].append(time.perf_counter() - start)
+
+            start = time.perf_counter()
+            template.write_form(form, data)
+            samples["write_form"].append(time.perf_counter() - start)
+
+            start = time.perf_counter()
+            template.render_with_data(dict(data), use_cache=False)
+            samples["render_with_data"].append(time.perf_counter() - start)
+
+        return {
+            "fields": field_count,
+            "pages": page_count,
+            "overlay_fields": overlay_count,
+            "template_bytes": template.template_file.size,
+            "stages": {stage: summarize(samples[stage]) for stage in STAGES},
+        }
@@ -0,0 +1,65 @@
+import json
+from pathlib import Path
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from app.persisted_queries import build_manifest, load_client_manifest
+from app.schema import schema
+
+
+class Command(BaseCommand):
+    help = (
+        "Validate the frontend's GraphQL queries and write them to the "
+        "persisted query manifest, so clients can send just their hash."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--source",
+            default=str(settings.BASE_DIR / "frontend" / "src"),
+            help="Directory of .jsx/.js files holding gql`...` queries.",
+        )
+        parser.add_argument(
+            "--client-manifest",
+            help=(
+                "Persisted query manifest generated by the client build. Its "
+                "ids are used as they are, instead of hashing the queries "
+                "found in --source, which Apollo Client would not match."
+            ),
+        )
+        parser.add_argument(
+            "--output",
+            default=str(settings.PERSISTED_QUERIES_MANIFEST),
+            help="Manifest file to write.",
+        )
+        parser.add_argument(
+            "--strict",
+            action="store_true",
+            help="Fail instead of skipping queries that do not validate.",
+        )
+
+    def handle(
+        self, *args, source, output, client_manifest=None, strict=False, **options
+    ):
+        if client_manifest:
+            with open(client_manifest) as f:
+                manifest, invalid = load_client_manifest(json.load(f), schema)
+        else:
+            sources = [
+                path.read_text()
+                for pattern in ("*.jsx", "*.js")
+                for path in sorted(Path(source).rglob(pattern))
+            ]
+            manifest, invalid = build_manifest(sources, schema)
+        for query, errors in invalid:
+            self.stderr.write(f"Skipping invalid query: {errors[0].message}")
+            self.stderr.write(query)
+        if invalid and strict:
+            raise CommandError(f"{len(invalid)} invalid queries.")
+        with open(output, "w") as f:
+            json.dump(manifest, f, indent=2, sort_keys=True)
+            f.write("\n")
+        self.stdout.write(
+            self.style.SUCCESS(f"Wrote {len(manifest)} persisted queries to {output}.")
+        )
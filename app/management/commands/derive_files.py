@@ -0,0 +1,32 @@
+from django.core.management.base import BaseCommand
+
+from app.models import SKU, AttachmentBlob, Client, Contact, FileDerivative, Vessel
+from app.tasks import derive_file
+
+
+class Command(BaseCommand):
+    help = (
+        "Queue thumbnail/preview derivation for images and attachment blobs "
+        "that have no derivatives yet."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--all",
+            action="store_true",
+            help="Regenerate derivatives for every file, not just missing ones.",
+        )
+
+    def handle(self, *args, all=False, **options):
+        names = set(AttachmentBlob.objects.values_list("file", flat=True))
+        for model in (Client, Contact, SKU, Vessel):
+            names.update(
+                model.objects.exclude(image="")
+                .exclude(image__isnull=True)
+                .values_list("image", flat=True)
+            )
+        if not all:
+            names -= set(FileDerivative.objects.values_list("source_name", flat=True))
+        for name in sorted(names):
+            derive_file.delay(name)
+        self.stdout.write(self.style.SUCCESS(f"Queued {len(names)} file(s)."))
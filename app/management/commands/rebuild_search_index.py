@@ -0,0 +1,31 @@
+from django.core.management.base import BaseCommand
+
+from app.models import SEARCH_MODELS, SearchToken
+
+
+class Command(BaseCommand):
+    help = "Rebuild the search index of contacts, clients, vessels and SKUs."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--batch-size",
+            type=int,
+            default=500,
+            help="Objects indexed per transaction.",
+        )
+
+    def handle(self, *args, batch_size=500, **options):
+        for model in SEARCH_MODELS:
+            fields = ["pk", *model.search_fields]
+            batch, count = [], 0
+            for obj in model._default_manager.only(*fields).iterator(batch_size):
+                batch.append(obj)
+                if len(batch) >= batch_size:
+                    SearchToken.objects.index(batch)
+                    count += len(batch)
+                    batch = []
+            if batch:
+                SearchToken.objects.index(batch)
+                count += len(batch)
+            self.stdout.write(f"{model.__name__}: {count} indexed")
+        self.stdout.write(self.style.SUCCESS("Search index rebuilt."))
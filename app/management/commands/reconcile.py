@@ -0,0 +1,45 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from app.models import Invoice
+
+
+class Command(BaseCommand):
+    help = (
+        "Verify stored invoice balances against the SUM of their line items "
+        "and credits, optionally rewriting the ones that have drifted."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--fix",
+            action="store_true",
+            help="Rewrite mismatched balances from the computed sums.",
+        )
+
+    def handle(self, *args, fix=False, **options):
+        mismatched = Invoice.objects.out_of_balance().values_list(
+            "uid",
+            "initial_balance",
+            "computed_initial_balance",
+            "paid_balance",
+            "computed_paid_balance",
+        )
+        uids = []
+        for uid, initial, computed_initial, paid, computed_paid in mismatched:
+            uids.append(uid)
+            self.stdout.write(
+                f"{uid}: initial {initial} != {computed_initial}, "
+                f"paid {paid} != {computed_paid}"
+            )
+        if not uids:
+            self.stdout.write(self.style.SUCCESS("All invoice balances reconcile."))
+            return
+        if not fix:
+            self.stdout.write(
+                self.style.WARNING(f"{len(uids)} invoice(s) out of balance.")
+            )
+            return
+        with transaction.atomic():
+            updated = Invoice.objects.filter(pk__in=uids).reconcile_balances()
+        self.stdout.write(self.style.SUCCESS(f"Reconciled {updated} invoice(s)."))
@@ -0,0 +1,18 @@
+# Generated by Django 3.1.10 on 2026-10-18 18:49
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0010_renderedform_metadata'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='renderedform',
+            name='status',
+            field=models.IntegerField(choices=[(0, 'Pending'), (1, 'Rendering'), (2, 'Done'), (-1, 'Failed')], default=2),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 3.1.10 on 2026-10-18 18:53
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0011_renderedform_status'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='renderedform',
+            name='content_hash',
+            field=models.CharField(db_index=True, max_length=64, null=True),
+        ),
+    ]
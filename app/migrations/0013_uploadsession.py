@@ -0,0 +1,40 @@
+# Generated by Django 3.1.10 on 2026-10-18 18:55
+
+from django.db import migrations, models
+import django.db.models.deletion
+import uuid
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('contenttypes', '0002_remove_content_type_name'),
+        ('app', '0012_renderedform_content_hash'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='attachment',
+            name='attached_file',
+            field=models.FileField(max_length=512, upload_to=''),
+        ),
+        migrations.CreateModel(
+            name='UploadSession',
+            fields=[
+                ('uid', models.UUIDField(default=uuid.uuid4, editable=False, primary_key=True, serialize=False)),
+                ('object_id', models.UUIDField()),
+                ('name', models.CharField(max_length=256)),
+                ('storage_name', models.CharField(max_length=512)),
+                ('size', models.BigIntegerField()),
+                ('offset', models.BigIntegerField(default=0)),
+                ('upload_id', models.CharField(max_length=1024, null=True)),
+                ('parts', models.JSONField(default=list)),
+                ('metadata', models.JSONField(null=True)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+                ('completed_at', models.DateTimeField(null=True)),
+                ('attachment', models.ForeignKey(null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to='app.attachment')),
+                ('content_type', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='contenttypes.contenttype')),
+            ],
+        ),
+    ]
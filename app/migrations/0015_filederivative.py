@@ -0,0 +1,28 @@
+# Generated by Django 3.1.10 on 2026-10-18 19:02
+
+from django.db import migrations, models
+import uuid
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0014_attachmentblob'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='FileDerivative',
+            fields=[
+                ('uid', models.UUIDField(default=uuid.uuid4, editable=False, primary_key=True, serialize=False)),
+                ('source_name', models.CharField(max_length=512)),
+                ('kind', models.CharField(max_length=32)),
+                ('file', models.FileField(max_length=512, upload_to='')),
+                ('size', models.BigIntegerField()),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+            ],
+            options={
+                'unique_together': {('source_name', 'kind')},
+            },
+        ),
+    ]
@@ -0,0 +1,22 @@
+# Generated by Django 3.1.10 on 2026-10-18 19:06
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('contenttypes', '0002_remove_content_type_name'),
+        ('app', '0015_filederivative'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ObjectUid',
+            fields=[
+                ('uid', models.UUIDField(primary_key=True, serialize=False)),
+                ('content_type', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='contenttypes.contenttype')),
+            ],
+        ),
+    ]
@@ -0,0 +1,14 @@
+from django.db import migrations
+
+from app.promoted_metadata import promote_keys
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("app", "0016_object_uid"),
+    ]
+
+    operations = [
+        promote_keys("sku", "metadata", ["type", "tag"]),
+    ]
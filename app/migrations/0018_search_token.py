@@ -0,0 +1,29 @@
+# Generated by Django 3.1.10 on 2026-10-18 19:11
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('contenttypes', '0002_remove_content_type_name'),
+        ('app', '0017_promote_sku_metadata'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='SearchToken',
+            fields=[
+                ('id', models.BigAutoField(primary_key=True, serialize=False)),
+                ('token', models.CharField(max_length=64)),
+                ('object_id', models.UUIDField(db_index=True)),
+                ('weight', models.IntegerField()),
+                ('content_type', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='contenttypes.contenttype')),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='searchtoken',
+            index=models.Index(fields=['token', 'content_type', 'object_id', 'weight'], name='app_searcht_token_f9c443_idx'),
+        ),
+    ]
@@ -0,0 +1,48 @@
+from django.db import migrations
+
+
+# models exposed as relay nodes, as listed in UID_MODEL_NAMES
+UID_MODEL_NAMES = [
+    "attachment",
+    "contact",
+    "client",
+    "vessel",
+    "task",
+    "job",
+    "sku",
+    "invoice",
+    "lineitem",
+    "credit",
+    "formtemplate",
+    "renderedform",
+]
+
+
+def backfill(apps, schema_editor):
+    ContentType = apps.get_model("contenttypes", "ContentType")
+    ObjectUid = apps.get_model("app", "ObjectUid")
+    for model_name in UID_MODEL_NAMES:
+        model = apps.get_model("app", model_name)
+        uids = model._default_manager.values_list("pk", flat=True)
+        if not uids.exists():
+            continue
+        content_type, _ = ContentType.objects.get_or_create(
+            app_label="app", model=model._meta.model_name
+        )
+        ObjectUid.objects.bulk_create(
+            (ObjectUid(uid=uid, content_type=content_type) for uid in uids.iterator()),
+            batch_size=1000,
+            ignore_conflicts=True,
+        )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("contenttypes", "0002_remove_content_type_name"),
+        ("app", "0019_keyset_created_at_indexes"),
+    ]
+
+    operations = [
+        migrations.RunPython(backfill, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,20 @@
+from django.db import migrations, models
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0020_backfill_object_uid'),
+    ]
+
+    operations = [
+        # existing forms get the migration time and keep paging by uid among
+        # themselves
+        migrations.AddField(
+            model_name='renderedform',
+            name='created_at',
+            field=models.DateTimeField(auto_now_add=True, db_index=True, default=django.utils.timezone.now),
+            preserve_default=False,
+        ),
+    ]
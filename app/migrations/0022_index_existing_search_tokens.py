@@ -0,0 +1,72 @@
+from collections import defaultdict
+
+from django.db import migrations
+
+from app.search import tokenize
+
+# search_fields of each model when the index was introduced; later changes
+# to them are picked up by rebuild_search_index
+SEARCH_FIELDS = {
+    "contact": {
+        "first_name": 3,
+        "last_name": 3,
+        "primary_email": 2,
+        "role": 1,
+        "phone_number": 1,
+        "mailing_address": 1,
+        "billing_address": 1,
+    },
+    "client": {"company": 3},
+    "vessel": {"name": 3, "mmsi": 2},
+    "sku": {"name": 3},
+}
+
+
+def index(apps, schema_editor):
+    ContentType = apps.get_model("contenttypes", "ContentType")
+    SearchToken = apps.get_model("app", "SearchToken")
+    for model_name, search_fields in SEARCH_FIELDS.items():
+        model = apps.get_model("app", model_name)
+        objects = model._default_manager.only("pk", *search_fields)
+        if not objects.exists():
+            continue
+        content_type, _ = ContentType.objects.get_or_create(
+            app_label="app", model=model_name
+        )
+        # drop whatever rebuild_search_index may already have written
+        SearchToken.objects.filter(content_type=content_type).delete()
+        tokens = []
+        for obj in objects.iterator():
+            weights = defaultdict(int)
+            for field, weight in search_fields.items():
+                for token in set(tokenize(getattr(obj, field))):
+                    weights[token] += weight
+            tokens.extend(
+                SearchToken(
+                    token=token,
+                    content_type=content_type,
+                    object_id=obj.pk,
+                    weight=weight,
+                )
+                for token, weight in weights.items()
+            )
+            if len(tokens) >= 1000:
+                SearchToken.objects.bulk_create(tokens)
+                tokens = []
+        SearchToken.objects.bulk_create(tokens)
+
+
+def unindex(apps, schema_editor):
+    apps.get_model("app", "SearchToken").objects.all().delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("contenttypes", "0002_remove_content_type_name"),
+        ("app", "0021_renderedform_created_at"),
+    ]
+
+    operations = [
+        migrations.RunPython(index, unindex),
+    ]
@@ -0,0 +1,38 @@
+from django.db import migrations
+
+# models exposed as relay nodes, as listed in UID_MODEL_NAMES
+UID_MODEL_NAMES = [
+    "attachment",
+    "contact",
+    "client",
+    "vessel",
+    "task",
+    "job",
+    "sku",
+    "invoice",
+    "lineitem",
+    "credit",
+    "formtemplate",
+    "renderedform",
+]
+
+
+def prune(apps, schema_editor):
+    # earlier versions of 0020 and the save hooks also registered internal
+    # models such as blobs, derivatives and upload sessions
+    ObjectUid = apps.get_model("app", "ObjectUid")
+    ObjectUid.objects.exclude(
+        content_type__app_label="app", content_type__model__in=UID_MODEL_NAMES
+    ).delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("contenttypes", "0002_remove_content_type_name"),
+        ("app", "0022_index_existing_search_tokens"),
+    ]
+
+    operations = [
+        migrations.RunPython(prune, migrations.RunPython.noop),
+    ]
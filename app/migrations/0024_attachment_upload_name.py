@@ -0,0 +1,18 @@
+# Generated by Django 3.1.10 on 2026-10-18 19:38
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0023_prune_object_uid'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='attachment',
+            name='upload_name',
+            field=models.CharField(max_length=512, null=True),
+        ),
+    ]
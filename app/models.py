@@ -1,24 +1,286 @@
-from django.db import models, transaction
-from decimal import Decimal
+from django.db import IntegrityError, models, transaction
+from django.db.models import Case, F, Max, OuterRef, Q, Subquery, Sum, Value, When
+from django.db.models.functions import Coalesce
+from decimal import Decimal, ROUND_HALF_UP
 from django.conf import settings
 from django.contrib.contenttypes.fields import GenericForeignKey, GenericRelation
 from django.contrib.contenttypes.models import ContentType
+from django.core.exceptions import FieldDoesNotExist
+from django.db.models.signals import class_prepared, post_delete, post_save, pre_save
+from django.dispatch import receiver
+from app.derivatives import derive
+from app.promoted_metadata import PromotedJSONField
+from app.rendering import template_cache
+from app.search import MIN_PREFIX_LENGTH, query_terms, tokenize
+from app.uploads import iter_storage_chunks
 from app.metadata import (
     ItemMetadataSchema,
     TransportMetadataSchema,
     ServiceMetadataSchema,
     CreditMetadataSchema,
 )
+import hashlib
+import json
+import logging
+import os
 import uuid
+from collections import defaultdict
+from collections.abc import Mapping
 
 ### for rendering --> move elsewhere later
 import io
 import pdfrw
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
 from reportlab.pdfgen import canvas
-from django.core.files.base import ContentFile
+from django.core.files.base import ContentFile, File
 
 ###
 
+logger = logging.getLogger(__name__)
+
+# models exposed as relay nodes, whose uids the ObjectUid registry tracks so
+# node(uid), nodes(uids) and the metadata mutations can find them
+UID_MODEL_NAMES = {
+    "attachment",
+    "contact",
+    "client",
+    "vessel",
+    "task",
+    "job",
+    "sku",
+    "invoice",
+    "lineitem",
+    "credit",
+    "formtemplate",
+    "renderedform",
+}
+# the concrete ones among them, filled in as they are declared below
+UID_MODELS = []
+
+
+def register_uid(sender, instance, created, **kwargs):
+    if created:
+        ObjectUid.objects.register([instance])
+
+
+def unregister_uid(sender, instance, **kwargs):
+    ObjectUid.objects.filter(uid=instance.pk).delete()
+
+
+@receiver(class_prepared)
+def track_uid_model(sender, **kwargs):
+    """
+    Hooks the models in UID_MODEL_NAMES, and their proxies, up to the
+    ObjectUid registry as they are declared.
+    """
+    if sender.__module__ != __name__:
+        return
+    if sender._meta.concrete_model._meta.model_name not in UID_MODEL_NAMES:
+        return
+    if not sender._meta.proxy:
+        UID_MODELS.append(sender)
+    post_save.connect(register_uid, sender=sender)
+    post_delete.connect(unregister_uid, sender=sender)
+
+
+# concrete models declaring search_fields, kept in the SearchToken index
+SEARCH_MODELS = []
+
+
+def index_search_tokens(sender, instance, update_fields=None, **kwargs):
+    if update_fields is None or set(update_fields) & set(sender.search_fields):
+        SearchToken.objects.index([instance])
+
+
+def unindex_search_tokens(sender, instance, **kwargs):
+    SearchToken.objects.filter(object_id=instance.pk).delete()
+
+
+@receiver(class_prepared)
+def track_searchable_model(sender, **kwargs):
+    """
+    Keeps the search index up to date for models in this module that
+    declare search_fields, a {field name: weight} dict.
+    """
+    if sender.__module__ != __name__ or not hasattr(sender, "search_fields"):
+        return
+    if not sender._meta.proxy:
+        SEARCH_MODELS.append(sender)
+    post_save.connect(index_search_tokens, sender=sender)
+    post_delete.connect(unindex_search_tokens, sender=sender)
+
+
+def blob_file_name(sha256, filename):
+    _, ext = os.path.splitext(filename or "")
+    return f"blobs/{sha256[:2]}/{sha256}{ext.lower()}"
+
+
+def sha256_of_chunks(chunks):
+    digest = hashlib.sha256()
+    size = 0
+    for chunk in chunks:
+        digest.update(chunk)
+        size += len(chunk)
+    return digest.hexdigest(), size
+
+
+class AttachmentBlobQuerySet(models.QuerySet):
+    def store(self, file_obj, filename):
+        """
+        Returns the blob holding the content of an uploaded file, writing it to
+        storage only when no blob has that content yet. Uses the hash the
+        upload handlers computed while the file was streamed in, if any.
+        """
+        sha256 = getattr(file_obj, "sha256", None)
+        if sha256 is None:
+            sha256, _ = sha256_of_chunks(file_obj.chunks())
+        blob = self.filter(sha256=sha256).first()
+        if blob is not None:
+            return blob
+        storage = AttachmentBlob._meta.get_field("file").storage
+        name = storage.save(blob_file_name(sha256, filename), file_obj)
+        return self._create_or_get(sha256, name, file_obj.size)
+
+    def store_many(self, files, saved=None):
+        """
+        Bulk version of store() for (file, filename) pairs: one query finds the
+        content that is already stored, the rest is uploaded concurrently and
+        inserted with one bulk_create. Returns each file's blob, in order.
+        The names of the files it writes are appended to `saved`, so a caller
+        whose transaction rolls back can delete them.
+        """
+        saved = [] if saved is None else saved
+        hashes = []
+        for file_obj, filename in files:
+            sha256 = getattr(file_obj, "sha256", None)
+            if sha256 is None:
+                sha256, _ = sha256_of_chunks(file_obj.chunks())
+            hashes.append(sha256)
+        blobs = self.in_bulk(set(hashes), field_name="sha256")
+        storage = AttachmentBlob._meta.get_field("file").storage
+        workers = getattr(settings, "ATTACHMENT_UPLOAD_WORKERS", 8)
+        uploads = {}
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            for (file_obj, filename), sha256 in zip(files, hashes):
+                if sha256 in blobs or sha256 in uploads:
+                    continue
+                upload = pool.submit(
+                    storage.save, blob_file_name(sha256, filename), file_obj
+                )
+                uploads[sha256] = (file_obj.size, upload)
+        saved.extend(
+            upload.result()
+            for _, upload in uploads.values()
+            if upload.exception() is None
+        )
+        if uploads:
+            new_blobs = [
+                AttachmentBlob(sha256=sha256, file=upload.result(), size=size)
+                for sha256, (size, upload) in uploads.items()
+            ]
+            self.bulk_create(new_blobs, ignore_conflicts=True)
+            stored = self.in_bulk(list(uploads), field_name="sha256")
+            for blob in new_blobs:
+                # lost a race with a concurrent upload of the same content
+                if stored[blob.sha256].file.name != blob.file.name:
+                    storage.delete(blob.file.name)
+            blobs.update(stored)
+            for blob in new_blobs:
+                if stored[blob.sha256].file.name == blob.file.name:
+                    schedule_derivation(blob.file.name)
+        return [blobs[sha256] for sha256 in hashes]
+
+    def add_references(self, counts):
+        """
+        Adds counts[blob pk] references in one UPDATE, for attachments created
+        with bulk_create (which sends no post_save).
+        """
+        if not counts:
+            return
+        self.filter(pk__in=counts).update(
+            ref_count=F("ref_count")
+            + Case(
+                *[When(pk=pk, then=Value(n)) for pk, n in counts.items()],
+                default=Value(0),
+                output_field=models.IntegerField(),
+            )
+        )
+
+    def adopt(self, name):
+        """
+        Returns the blob for a file that was written to storage directly (a
+        chunked or presigned upload). The bytes hashed are copied to the
+        content-addressed name and the uploaded file is deleted, so a client
+        whose upload URL is still valid cannot change a shared blob.
+        """
+        storage = AttachmentBlob._meta.get_field("file").storage
+        with tempfile.SpooledTemporaryFile(
+            max_size=settings.FILE_UPLOAD_MAX_MEMORY_SIZE
+        ) as copy:
+            digest = hashlib.sha256()
+            for chunk in iter_storage_chunks(storage, name):
+                digest.update(chunk)
+                copy.write(chunk)
+            sha256, size = digest.hexdigest(), copy.tell()
+            blob = self.filter(sha256=sha256).first()
+            if blob is None:
+                copy.seek(0)
+                stored = storage.save(
+                    blob_file_name(sha256, name), File(copy, name=name)
+                )
+                blob = self._create_or_get(sha256, stored, size)
+        if blob.file.name != name:
+            transaction.on_commit(lambda: storage.delete(name))
+        return blob
+
+    def _create_or_get(self, sha256, name, size):
+        try:
+            with transaction.atomic():
+                return self.create(sha256=sha256, file=name, size=size)
+        except IntegrityError:
+            # someone stored the same content concurrently
+            blob = self.get(sha256=sha256)
+            if blob.file.name != name:
+                blob.file.storage.delete(name)
+            return blob
+
+    def collect_garbage(self):
+        """
+        Deletes the blobs in this queryset that nothing references any more,
+        and their files once the rows are gone.
+        """
+        with transaction.atomic():
+            referenced = Attachment.objects.filter(blob__isnull=False).values("blob")
+            blobs = list(
+                self.select_for_update()
+                .filter(ref_count__lte=0)
+                .exclude(pk__in=referenced)
+            )
+            AttachmentBlob.objects.filter(pk__in=[b.pk for b in blobs]).delete()
+        for blob in blobs:
+            blob.file.delete(save=False)
+        FileDerivative.objects.filter(
+            source_name__in=[blob.file.name for blob in blobs]
+        ).delete_with_files()
+        return len(blobs)
+
+
+class AttachmentBlob(models.Model):
+    """
+    One stored copy of some attachment content, identified by its SHA-256 and
+    shared by every Attachment with identical content.
+    """
+
+    uid = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
+    sha256 = models.CharField(max_length=64, unique=True)
+    file = models.FileField(max_length=512)
+    size = models.BigIntegerField()
+    ref_count = models.IntegerField(default=0)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    objects = AttachmentBlobQuerySet.as_manager()
+
 
 class Attachment(models.Model):
     uid = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
@@ -26,10 +288,160 @@ class Attachment(models.Model):
     content_type = models.ForeignKey(ContentType, on_delete=models.CASCADE)
     object_id = models.UUIDField()
     content_object = GenericForeignKey("content_type", "object_id")
-    attached_file = models.FileField(null=False)
+    attached_file = models.FileField(null=False, max_length=512)
+    blob = models.ForeignKey(
+        AttachmentBlob,
+        on_delete=models.PROTECT,
+        null=True,
+        related_name="attachments",
+    )
+    metadata = models.JSONField(null=True)
+    # the storage key a direct upload was written to before it was adopted
+    # into a blob, so confirming the same upload twice finds this attachment
+    upload_name = models.CharField(max_length=512, null=True)
+    created_at = models.DateTimeField(auto_now_add=True, db_index=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+
+def schedule_derivation(name):
+    from app.tasks import derive_file
+
+    transaction.on_commit(lambda: derive_file.delay(name))
+
+
+@receiver(post_save, sender=AttachmentBlob)
+def derive_attachment_blob(sender, instance, created, raw=False, **kwargs):
+    if created and not raw:
+        schedule_derivation(instance.file.name)
+
+
+class FileDerivativeQuerySet(models.QuerySet):
+    def derive(self, source_name):
+        """
+        (Re)generates the thumbnails and preview of a stored file.
+        """
+        storage = FileDerivative._meta.get_field("file").storage
+        derivatives = []
+        for kind, (name, size) in derive(storage, source_name).items():
+            derivative, _ = self.update_or_create(
+                source_name=source_name,
+                kind=kind,
+                defaults={"file": name, "size": size},
+            )
+            derivatives.append(derivative)
+        return derivatives
+
+    def delete_with_files(self):
+        for derivative in self:
+            derivative.file.delete(save=False)
+        return self.delete()
+
+
+class FileDerivative(models.Model):
+    """
+    A thumbnail or first-page preview generated from a stored file, found by
+    the storage name of the original.
+    """
+
+    uid = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
+    source_name = models.CharField(max_length=512)
+    kind = models.CharField(max_length=32)
+    file = models.FileField(max_length=512)
+    size = models.BigIntegerField()
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    objects = FileDerivativeQuerySet.as_manager()
+
+    class Meta:
+        unique_together = [("source_name", "kind")]
+
+
+@receiver(post_save, sender=Attachment)
+def reference_attachment_blob(sender, instance, created, raw=False, **kwargs):
+    if created and not raw and instance.blob_id:
+        AttachmentBlob.objects.filter(pk=instance.blob_id).update(
+            ref_count=F("ref_count") + 1
+        )
+
+
+@receiver(post_delete, sender=Attachment)
+def release_attachment_blob(sender, instance, **kwargs):
+    # post_delete also fires for attachments removed by cascading deletes
+    blob_id = instance.blob_id
+    if blob_id:
+        AttachmentBlob.objects.filter(pk=blob_id).update(ref_count=F("ref_count") - 1)
+        transaction.on_commit(
+            lambda: AttachmentBlob.objects.filter(pk=blob_id).collect_garbage()
+        )
+
+
+def release_derivatives(source_name):
+    transaction.on_commit(
+        lambda: FileDerivative.objects.filter(
+            source_name=source_name
+        ).delete_with_files()
+    )
+
+
+def release_replaced_image(sender, instance, raw=False, update_fields=None, **kwargs):
+    if raw or instance._state.adding:
+        return
+    if update_fields is not None and "image" not in update_fields:
+        return
+    previous = (
+        sender._base_manager.filter(pk=instance.pk)
+        .values_list("image", flat=True)
+        .first()
+    )
+    # a new upload can be saved under the old name, replacing its content
+    if previous and (previous != instance.image.name or not instance.image._committed):
+        release_derivatives(previous)
+
+
+def release_deleted_image(sender, instance, **kwargs):
+    if instance.image:
+        release_derivatives(instance.image.name)
+
+
+@receiver(class_prepared)
+def track_image_model(sender, **kwargs):
+    """
+    Deletes the thumbnails and previews of a model's `image` once it is
+    replaced, cleared or deleted with its row.
+    """
+    if sender.__module__ != __name__:
+        return
+    try:
+        sender._meta.get_field("image")
+    except FieldDoesNotExist:
+        return
+    pre_save.connect(release_replaced_image, sender=sender)
+    post_delete.connect(release_deleted_image, sender=sender)
+
+
+class UploadSession(models.Model):
+    """
+    A resumable, chunked attachment upload. Chunks are written straight to
+    storage at `offset`; completing the session creates the Attachment.
+    """
+
+    uid = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
+    content_type = models.ForeignKey(ContentType, on_delete=models.CASCADE)
+    object_id = models.UUIDField()
+    content_object = GenericForeignKey("content_type", "object_id")
+    name = models.CharField(max_length=256)
+    storage_name = models.CharField(max_length=512)
+    size = models.BigIntegerField()
+    offset = models.BigIntegerField(default=0)
+    upload_id = models.CharField(max_length=1024, null=True)
+    parts = models.JSONField(default=list)
     metadata = models.JSONField(null=True)
+    attachment = models.ForeignKey(
+        Attachment, on_delete=models.SET_NULL, null=True, related_name="+"
+    )
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
+    completed_at = models.DateTimeField(null=True)
 
 
 class Contact(models.Model):
@@ -47,6 +459,16 @@ class Contact(models.Model):
     image = models.FileField(null=True)
     attachments = GenericRelation(Attachment)
 
+    search_fields = {
+        "first_name": 3,
+        "last_name": 3,
+        "primary_email": 2,
+        "role": 1,
+        "phone_number": 1,
+        "mailing_address": 1,
+        "billing_address": 1,
+    }
+
     @property
     def name(self):
         return " ".join([_ for _ in [self.first_name, self.last_name] if _])
@@ -72,6 +494,8 @@ class Client(models.Model):
     image = models.FileField(null=True)
     attachments = GenericRelation(Attachment)
 
+    search_fields = {"company": 3}
+
     def __str__(self):
         return f"{self.company}[{self.uid}]"
 
@@ -94,6 +518,8 @@ class Vessel(models.Model):
     image = models.FileField(null=True)
     attachments = GenericRelation(Attachment)
 
+    search_fields = {"name": 3, "mmsi": 2}
+
     def __str__(self):
         return f"{self.name}[{self.uid}]"
 
@@ -134,12 +560,8 @@ class Job(models.Model):
 
 class SKUQuerySet(models.QuerySet):
     def add_to_invoice(self, invoice, **li_kwargs):
-        new_line_item_ids = set()
-        with transaction.atomic():
-            for sku in self.all():
-                li = sku.add_to_invoice(invoice, **li_kwargs)
-                new_line_item_ids.add(li.uid)
-        return LineItem.objects.filter(id__in=new_line_item_ids)
+        line_items = [sku.build_line_item(invoice, **li_kwargs) for sku in self]
+        return LineItem.objects.bulk_add_to_invoice(invoice, line_items)
 
 
 class SKUManager(models.Manager):
@@ -179,7 +601,7 @@ class TransportationManager(SKUManager):
 class SKU(models.Model):
     uid = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
     name = models.CharField(blank=True, max_length=256)
-    metadata = models.JSONField()
+    metadata = PromotedJSONField(promoted_keys=("type", "tag"))
     default_quantity = models.DecimalField(
         default=Decimal(1.0), max_digits=32, decimal_places=2
     )
@@ -201,11 +623,18 @@ class SKU(models.Model):
 
     objects = SKUManager()
 
-    def add_to_invoice(self, invoice, **li_kwargs):
+    search_fields = {"name": 3}
+
+    def build_line_item(self, invoice, **li_kwargs):
         li_kwargs = li_kwargs or {}
         li_kwargs["quantity"] = li_kwargs.get("quantity", self.default_quantity)
         li_kwargs["price"] = li_kwargs.get("price", self.default_price)
-        return LineItem.objects.create(sku=self, invoice=invoice, **li_kwargs)
+        return LineItem(sku=self, invoice=invoice, **li_kwargs)
+
+    def add_to_invoice(self, invoice, **li_kwargs):
+        line_item = self.build_line_item(invoice, **li_kwargs)
+        line_item.save()
+        return line_item
 
     @property
     def sku_type(self):
@@ -256,6 +685,58 @@ class TransportationSKU(SKU):
         super().save(*args, **kwargs)
 
 
+class InvoiceQuerySet(models.QuerySet):
+    def apply_balance_delta(self, initial_delta=0, paid_delta=0):
+        """
+        Shifts stored balances by signed deltas in a single UPDATE, so the
+        arithmetic happens on the locked row rather than on a stale copy.
+        """
+        if not initial_delta and not paid_delta:
+            return 0
+        return self.update(
+            initial_balance=F("initial_balance") + initial_delta,
+            paid_balance=F("paid_balance") + paid_delta,
+        )
+
+    def with_computed_balances(self):
+        return self.annotate(
+            computed_initial_balance=_summed_balance(LineItem, "subtotal"),
+            computed_paid_balance=_summed_balance(Credit, "amount"),
+        )
+
+    def out_of_balance(self):
+        return self.with_computed_balances().filter(
+            ~Q(initial_balance=F("computed_initial_balance"))
+            | ~Q(paid_balance=F("computed_paid_balance"))
+        )
+
+    def reconcile_balances(self):
+        """
+        Rewrites stored balances for every invoice in the queryset from the
+        SUM of its line items and credits, in one UPDATE.
+        """
+        return self.update(
+            initial_balance=_summed_balance(LineItem, "subtotal"),
+            paid_balance=_summed_balance(Credit, "amount"),
+        )
+
+
+def _summed_balance(model, value_field):
+    balance_field = models.DecimalField(max_digits=32, decimal_places=2)
+    total = (
+        model.objects.filter(invoice=OuterRef("pk"))
+        .order_by()
+        .values("invoice")
+        .annotate(total=Sum(value_field))
+        .values("total")
+    )
+    return Coalesce(
+        Subquery(total, output_field=balance_field),
+        Value(0),
+        output_field=balance_field,
+    )
+
+
 class Invoice(models.Model):
     class InvoiceState(models.IntegerChoices):
         DRAFT = 0
@@ -278,16 +759,20 @@ class Invoice(models.Model):
     initial_balance = models.DecimalField(max_digits=32, decimal_places=2, default=0)
     paid_balance = models.DecimalField(max_digits=32, decimal_places=2, default=0)
     due_date = models.DateTimeField(null=True)
-    created_at = models.DateTimeField(auto_now_add=True)
+    created_at = models.DateTimeField(auto_now_add=True, db_index=True)
     updated_at = models.DateTimeField(auto_now=True)
     metadata = models.JSONField(null=True)
     attachments = GenericRelation(Attachment)
 
+    objects = InvoiceQuerySet.as_manager()
+
     def get_initial_balance(self):
-        return sum(self.line_items.all().values_list("subtotal", flat=True))
+        return self.line_items.aggregate(total=Coalesce(Sum("subtotal"), Value(0)))[
+            "total"
+        ]
 
     def get_paid_balance(self):
-        return sum(self.credits.all().values_list("amount", flat=True))
+        return self.credits.aggregate(total=Coalesce(Sum("amount"), Value(0)))["total"]
 
     def get_remaining_balance(self):
         return self.get_initial_balance() - self.get_paid_balance()
@@ -296,12 +781,57 @@ class Invoice(models.Model):
     def remaining_balance(self):
         return self.initial_balance - self.paid_balance
 
-    def update_balances(self):
-        self.initial_balance, self.paid_balance = (
-            self.get_initial_balance(),
-            self.get_paid_balance(),
-        )
-        self.save()
+    def refresh_balances(self):
+        self.refresh_from_db(fields=["initial_balance", "paid_balance"])
+
+
+class BalanceQuerySet(models.QuerySet):
+    """
+    Deletes shift invoice balances by the stored values of the removed rows,
+    with one UPDATE per invoice. Cascades from a deleted invoice bypass this,
+    as there is no balance left to adjust.
+    """
+
+    balance_field = None
+    balance_delta = None
+
+    def delete(self):
+        with transaction.atomic():
+            removed = defaultdict(Decimal)
+            for invoice_id, value in self.select_for_update().values_list(
+                "invoice_id", self.balance_field
+            ):
+                removed[invoice_id] += value
+            result = super().delete()
+            for invoice_id, value in removed.items():
+                Invoice.objects.filter(pk=invoice_id).apply_balance_delta(
+                    **{self.balance_delta: -value}
+                )
+        return result
+
+    delete.alters_data = True
+    delete.queryset_only = True
+
+
+class LineItemQuerySet(BalanceQuerySet):
+    balance_field = "subtotal"
+    balance_delta = "initial_delta"
+
+    def bulk_add_to_invoice(self, invoice, line_items):
+        """
+        Inserts unsaved line items with a single INSERT and applies their
+        combined subtotal to the invoice balance once.
+        """
+        for line_item in line_items:
+            line_item.invoice = invoice
+            line_item.subtotal = line_item.compute_subtotal()
+        with transaction.atomic():
+            created = self.bulk_create(line_items)
+            ObjectUid.objects.register(created)
+            Invoice.objects.filter(pk=invoice.pk).apply_balance_delta(
+                initial_delta=sum(li.subtotal for li in created)
+            )
+        return created
 
 
 class LineItem(models.Model):
@@ -315,13 +845,30 @@ class LineItem(models.Model):
     subtotal = models.DecimalField(max_digits=32, decimal_places=2)
     posted_date = models.DateTimeField(auto_now_add=True)
     service_date = models.DateTimeField(auto_now_add=True)
-    created_at = models.DateTimeField(auto_now_add=True)
+    created_at = models.DateTimeField(auto_now_add=True, db_index=True)
     updated_at = models.DateTimeField(auto_now=True)
 
+    objects = LineItemQuerySet.as_manager()
+
+    def compute_subtotal(self):
+        return _to_balance(_to_balance(self.price) * _to_balance(self.quantity))
+
     def save(self, *args, **kwargs):
-        self.subtotal = self.price * self.quantity
-        self.invoice.update_balances()
-        return super().save(*args, **kwargs)
+        self.subtotal = self.compute_subtotal()
+        with transaction.atomic():
+            previous = _locked_previous_values(self, "subtotal")
+            super().save(*args, **kwargs)
+            _apply_balance_change(
+                self, previous, self.subtotal, balance="initial_delta"
+            )
+
+    def delete(self, *args, **kwargs):
+        return _delete_with_balance(self, super().delete, *args, **kwargs)
+
+
+class CreditQuerySet(BalanceQuerySet):
+    balance_field = "amount"
+    balance_delta = "paid_delta"
 
 
 class Credit(models.Model):
@@ -339,10 +886,75 @@ class Credit(models.Model):
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
 
+    objects = CreditQuerySet.as_manager()
+
     def save(self, *args, **kwargs):
-        self.invoice.update_balances()
-        self.metadata = CreditMetadataSchema().load(self.metadata)
-        return super().save(*args, **kwargs)
+        self.amount = _to_balance(self.amount)
+        self.metadata = CreditMetadataSchema().load(self.metadata or {})
+        with transaction.atomic():
+            previous = _locked_previous_values(self, "amount")
+            super().save(*args, **kwargs)
+            _apply_balance_change(self, previous, self.amount, balance="paid_delta")
+
+    def delete(self, *args, **kwargs):
+        return _delete_with_balance(self, super().delete, *args, **kwargs)
+
+
+def _to_balance(value):
+    if not isinstance(value, Decimal):
+        value = Decimal(str(value))
+    return value.quantize(Decimal("0.01"), rounding=ROUND_HALF_UP)
+
+
+def _locked_previous_values(obj, value_field):
+    """
+    Returns the (invoice_id, value) currently stored for a line item or credit,
+    locking its row for the rest of the transaction, or None for new rows.
+    """
+    if obj._state.adding:
+        return None
+    return (
+        type(obj)
+        .objects.select_for_update()
+        .filter(pk=obj.pk)
+        .values_list("invoice_id", value_field)
+        .first()
+    )
+
+
+def _apply_balance_change(obj, previous, value, balance):
+    if previous is None:
+        Invoice.objects.filter(pk=obj.invoice_id).apply_balance_delta(
+            **{balance: value}
+        )
+        return
+    previous_invoice_id, previous_value = previous
+    if previous_invoice_id == obj.invoice_id:
+        Invoice.objects.filter(pk=obj.invoice_id).apply_balance_delta(
+            **{balance: value - previous_value}
+        )
+        return
+    Invoice.objects.filter(pk=previous_invoice_id).apply_balance_delta(
+        **{balance: -previous_value}
+    )
+    Invoice.objects.filter(pk=obj.invoice_id).apply_balance_delta(**{balance: value})
+
+
+def _delete_with_balance(obj, delete, *args, **kwargs):
+    """
+    Deletes a line item or credit, removing the value stored for its row,
+    not the possibly stale one on the instance, from its invoice.
+    """
+    queryset = type(obj)._default_manager.all()
+    with transaction.atomic():
+        previous = _locked_previous_values(obj, queryset.balance_field)
+        result = delete(*args, **kwargs)
+        if previous is not None:
+            invoice_id, value = previous
+            Invoice.objects.filter(pk=invoice_id).apply_balance_delta(
+                **{queryset.balance_delta: -value}
+            )
+    return result
 
 
 class FormTemplate(models.Model):
@@ -356,7 +968,8 @@ class FormTemplate(models.Model):
             },
             "last_name": {
                 "type": "point",
-                "coords": [32, 32]
+                "coords": [32, 32],
+                "page": <0-based page to draw on, defaults to 0>
             }
         }
     """
@@ -374,23 +987,11 @@ class FormTemplate(models.Model):
 
     @property
     def annotations_by_idx(self):
-        return {
-            annotation["annot_idx"]: {
-                "initial_value": annotation["initial_value"],
-                "field_name": annotation["field_name"],
-            }
-            for annotation in self.annotations or []
-        }
+        return template_cache.get(self).annotations_by_idx
 
     @property
     def annotations_by_name(self):
-        return {
-            annotation["field_name"]: {
-                "initial_value": annotation["initial_value"],
-                "annot_idx": annotation["annot_idx"],
-            }
-            for annotation in self.annotations or []
-        }
+        return template_cache.get(self).annotations_by_name
 
     @classmethod
     def parse_annotations(cls, template_file):
@@ -398,8 +999,8 @@ class FormTemplate(models.Model):
         if not template_file:
             return annots
         template = pdfrw.PdfReader(template_file)
-        for page in template.pages:
-            for i, annotation in enumerate(page.Annots):
+        for page_idx, page in enumerate(template.pages):
+            for i, annotation in enumerate(page.Annots or []):
                 annots.append(
                     {
                         "field_name": cls.make_annotation_key_valid_json_key(
@@ -407,6 +1008,7 @@ class FormTemplate(models.Model):
                         ),
                         "initial_value": annotation["/V"] or "",
                         "annot_idx": i,
+                        "page": page_idx,
                     }
                 )
         template_file.seek(0)
@@ -425,21 +1027,124 @@ class FormTemplate(models.Model):
         self.save()
         return self.annotations
 
-    def render_with_data(self, data):
+    def content_hash(self, data):
+        """
+        Identifies the output of rendering data against this version of the
+        template: equal hashes produce the same PDF.
+        """
+        data = {**data, **(self.default_fields or {})}
+        key = json.dumps(
+            [str(self.uid), self.updated_at.isoformat(), data],
+            sort_keys=True,
+            separators=(",", ":"),
+            default=str,
+        )
+        return hashlib.sha256(key.encode()).hexdigest()
+
+    def find_rendered(self, content_hashes):
+        forms = RenderedForm.objects.filter(
+            template=self,
+            content_hash__in=content_hashes,
+            status=RenderedForm.RenderStatus.DONE,
+        )
+        return {form.content_hash: form for form in forms}
+
+    def render_with_data(self, data, use_cache=True):
+        content_hash = self.content_hash(data)
+        if use_cache:
+            existing = self.find_rendered([content_hash]).get(content_hash)
+            if existing is not None:
+                return existing
+        form = self.build_form(data)
+        return self.write_form(form, data, content_hash=content_hash)
+
+    def render_many(self, rows, use_cache=True):
+        """
+        Renders one form per row of data against this template, uploading the
+        results concurrently and inserting all RenderedForms at once. Rows
+        that were rendered before, or repeat within the batch, are rendered
+        once and share a RenderedForm. If any row fails, the files already
+        uploaded for the batch are deleted.
+        """
+        for i, row in enumerate(rows):
+            if not isinstance(row, Mapping):
+                raise ValueError(f"Row {i} is not an object of field values: {row!r}")
+        rows = [(dict(row), self.content_hash(row)) for row in rows]
+        existing = self.find_rendered([h for _, h in rows]) if use_cache else {}
+        storage = RenderedForm._meta.get_field("rendered_file").storage
+        workers = getattr(settings, "FORM_RENDER_UPLOAD_WORKERS", 8)
+        rendered = {}
+        try:
+            with ThreadPoolExecutor(max_workers=workers) as pool:
+                for data, content_hash in rows:
+                    if content_hash in existing or content_hash in rendered:
+                        continue
+                    form = self.build_form(data)
+                    upload = pool.submit(
+                        storage.save, self.form_filename(), ContentFile(form.getvalue())
+                    )
+                    rendered[content_hash] = (data, upload)
+            with transaction.atomic():
+                created = RenderedForm.objects.bulk_create(
+                    RenderedForm(
+                        template=self,
+                        rendering_data=data,
+                        rendered_file=upload.result(),
+                        content_hash=content_hash,
+                    )
+                    for content_hash, (data, upload) in rendered.items()
+                )
+                ObjectUid.objects.register(created)
+        except BaseException:
+            # leaving the pool waited for every upload to finish
+            for _, upload in rendered.values():
+                if upload.exception() is None:
+                    storage.delete(upload.result())
+            raise
+        existing.update((form.content_hash, form) for form in created)
+        return [existing[content_hash] for _, content_hash in rows]
+
+    def render_pending(self, rendered_form):
+        """
+        Renders a RenderedForm created ahead of time with its rendering_data,
+        moving it through the RENDERING state to DONE or FAILED.
+        """
+        rendered_form.status = RenderedForm.RenderStatus.RENDERING
+        rendered_form.save(update_fields=["status"])
+        try:
+            data = rendered_form.rendering_data or {}
+            rendered_form.content_hash = self.content_hash(data)
+            form = self.build_form(data)
+            storage = RenderedForm._meta.get_field("rendered_file").storage
+            rendered_form.rendered_file = storage.save(
+                self.form_filename(), ContentFile(form.getvalue())
+            )
+        except Exception:
+            rendered_form.status = RenderedForm.RenderStatus.FAILED
+            rendered_form.save(update_fields=["status"])
+            raise
+        rendered_form.rendering_data = data
+        rendered_form.status = RenderedForm.RenderStatus.DONE
+        rendered_form.save()
+        return rendered_form
+
+    def build_form(self, data):
         default_fields = self.default_fields or {}
         data.update(default_fields)
         template = self.fill_template_with_annotation_fields(data)
+        if not self.fields:
+            return self.merge(None, template)
         canvas_data = self.get_overlay_canvas(data)
-        form = self.merge(canvas_data, template)
-        return self.write_form(form, data)
+        return self.merge(canvas_data, template)
 
     def fill_template_with_annotation_fields(self, data):
-        template = pdfrw.PdfReader(self.template_file)
+        parsed = template_cache.get(self)
+        template = parsed.copy()
+        annotation_index = parsed.annotation_index
         for field_name, value in data.items():
-            if field_name in self.annotations_by_name:
-                idx = self.annotations_by_name[field_name]["annot_idx"]
+            for page, idx in annotation_index.get(field_name, ()):
                 try:
-                    annot = template.pages[0].Annots[idx]
+                    annot = template.pages[page].Annots[idx]
                     if not annot:
                         continue
                     if isinstance(value, bool) and value:
@@ -447,59 +1152,266 @@ class FormTemplate(models.Model):
                     else:
                         annot.update(pdfrw.PdfDict(V="{}".format(value)))
                     annot.update(pdfrw.PdfDict(AP=""))
-                except Exception as e:
-                    print(idx, e)
+                except Exception:
+                    logger.warning(
+                        "Could not fill %r into annotation %d on page %d of form "
+                        "template %s",
+                        field_name,
+                        idx,
+                        page,
+                        self.uid,
+                        exc_info=True,
+                    )
         return template
 
     def get_overlay_canvas(self, field_data):
         data = io.BytesIO()
         pdf = canvas.Canvas(data)
-        fields = self.fields or {}
-        pdf.setFontSize(size=10)
-        for field_name, field in fields.items():
-            if field["type"] == "text":
-                x, y = field["coords"]
-                font_size = field.get("size", None)
-                pdf.setFontSize(size=font_size)
-                pdf.drawString(x=x, y=y, text=field_data.get(field_name, ""))
-                pdf.setFontSize(size=10)
-            elif field["type"] == "select":
-                x, y = field["coords"]
-                radius = field.get("radius", 2)
-                pdf.circle(x, y, radius, fill=1)
+        fields_by_page = template_cache.get(self).overlay_fields_by_page
+        for page in range(max(fields_by_page, default=0) + 1):
+            pdf.setFontSize(size=10)
+            for field_name, field in fields_by_page.get(page, ()):
+                if field["type"] == "text":
+                    x, y = field["coords"]
+                    font_size = field.get("size", None)
+                    pdf.setFontSize(size=font_size)
+                    pdf.drawString(x=x, y=y, text=field_data.get(field_name, ""))
+                    pdf.setFontSize(size=10)
+                elif field["type"] == "select":
+                    x, y = field["coords"]
+                    radius = field.get("radius", 2)
+                    pdf.circle(x, y, radius, fill=1)
+            pdf.showPage()
         pdf.save()
         data.seek(0)
         return data
 
     def merge(self, canvas_data, template):
-        overlay_pdf = pdfrw.PdfReader(canvas_data)
-        for page, data in zip(template.pages, overlay_pdf.pages):
-            overlay = pdfrw.PageMerge().add(data)[0]
-            pdfrw.PageMerge(page).add(overlay).render()
+        if canvas_data is not None:
+            overlay_pdf = pdfrw.PdfReader(canvas_data)
+            for page, data in zip(template.pages, overlay_pdf.pages):
+                overlay = pdfrw.PageMerge().add(data)[0]
+                pdfrw.PageMerge(page).add(overlay).render()
         form = io.BytesIO()
         pdfrw.PdfWriter().write(form, template)
         form.seek(0)
         return form
 
-    def write_form(self, form_obj, data):
-        pdf_uuid = uuid.uuid4()
-        form_filename = f"rendered_forms/{self.name}/{pdf_uuid}.pdf"
-        form_obj.name = form_filename
-        rendered = ContentFile(form_obj.getvalue(), form_obj.name)
+    def form_filename(self):
+        return f"rendered_forms/{self.name}/{uuid.uuid4()}.pdf"
+
+    def write_form(self, form_obj, data, content_hash=None):
+        storage = RenderedForm._meta.get_field("rendered_file").storage
+        form_filename = storage.save(
+            self.form_filename(), ContentFile(form_obj.getvalue())
+        )
         rendered = RenderedForm.objects.create(
-            template=self, rendering_data=data, rendered_file=rendered
+            template=self,
+            rendering_data=data,
+            rendered_file=form_filename,
+            content_hash=content_hash,
         )
         return rendered
 
 
 class RenderedForm(models.Model):
+    class RenderStatus(models.IntegerChoices):
+        PENDING = 0
+        RENDERING = 1
+        DONE = 2
+        FAILED = -1
+
     uid = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
     template = models.ForeignKey(
         FormTemplate, on_delete=models.SET_NULL, null=True, related_name="+"
     )
     rendering_data = models.JSONField(null=True)
     rendered_file = models.FileField()
+    content_hash = models.CharField(max_length=64, null=True, db_index=True)
+    status = models.IntegerField(
+        choices=RenderStatus.choices, default=RenderStatus.DONE
+    )
     client = models.ForeignKey(
         Client, on_delete=models.SET_NULL, null=True, related_name="rendered_forms"
     )
     metadata = models.JSONField(null=True)
+    created_at = models.DateTimeField(auto_now_add=True, db_index=True)
+
+
+class ObjectUidQuerySet(models.QuerySet):
+    def register(self, objs):
+        """
+        Records the uids of saved objects; needed after bulk_create, which
+        sends no post_save.
+        """
+        self.bulk_create(
+            [
+                ObjectUid(
+                    uid=obj.pk, content_type=ContentType.objects.get_for_model(obj)
+                )
+                for obj in objs
+            ],
+            ignore_conflicts=True,
+        )
+
+    def models_for(self, uids, candidates=()):
+        """
+        Returns {uid: model class} for the uids that exist, in one query.
+        Uids missing from the registry are looked for in the candidates
+        models and registered when found, so rows written before the
+        registry existed resolve too.
+        """
+        uids = {u if isinstance(u, uuid.UUID) else uuid.UUID(str(u)) for u in uids}
+        found = {
+            uid: ContentType.objects.get_for_id(content_type_id).model_class()
+            for uid, content_type_id in self.filter(uid__in=uids).values_list(
+                "uid", "content_type_id"
+            )
+        }
+        missing = uids - set(found)
+        for model in candidates:
+            if not missing:
+                break
+            content_type = ContentType.objects.get_for_model(model)
+            pks = set(
+                model._default_manager.filter(pk__in=missing).values_list(
+                    "pk", flat=True
+                )
+            )
+            self.bulk_create(
+                [ObjectUid(uid=pk, content_type=content_type) for pk in pks],
+                ignore_conflicts=True,
+            )
+            found.update(dict.fromkeys(pks, content_type.model_class()))
+            missing -= pks
+        return found
+
+    def resolve_uids(self, uids):
+        """
+        Returns {uid: object} for the uids that exist, whatever their model,
+        with one query on the registry and one per model found.
+        """
+        by_model = defaultdict(list)
+        for uid, model in self.models_for(uids).items():
+            by_model[model].append(uid)
+        objects = {}
+        for model, model_uids in by_model.items():
+            objects.update(model._default_manager.in_bulk(model_uids))
+        return objects
+
+
+class ObjectUid(models.Model):
+    """
+    Which model every uid in the database belongs to, so an object can be
+    looked up by uid alone without trying each table in turn.
+    """
+
+    uid = models.UUIDField(primary_key=True)
+    content_type = models.ForeignKey(ContentType, on_delete=models.CASCADE)
+
+    objects = ObjectUidQuerySet.as_manager()
+
+
+class SearchTokenQuerySet(models.QuerySet):
+    def index(self, objs):
+        """
+        (Re)indexes saved objects of models with search_fields: each distinct
+        token gets one row weighted by the fields it appears in.
+        """
+        tokens = []
+        for obj in objs:
+            content_type = ContentType.objects.get_for_model(obj)
+            weights = defaultdict(int)
+            for field, weight in obj.search_fields.items():
+                for token in set(tokenize(getattr(obj, field))):
+                    weights[token] += weight
+            tokens.extend(
+                SearchToken(
+                    token=token,
+                    content_type=content_type,
+                    object_id=obj.pk,
+                    weight=weight,
+                )
+                for token, weight in weights.items()
+            )
+        with transaction.atomic():
+            self.filter(object_id__in=[obj.pk for obj in objs]).delete()
+            self.bulk_create(tokens, batch_size=1000)
+
+    def search(self, query, types=None, first=20):
+        """
+        Returns [(object, score)] for the best `first` objects, of the given
+        model types or any, whose tokens match every term of query, by
+        prefix. Whole-token matches and matches in heavier fields score
+        higher.
+        """
+        terms = query_terms(query)
+        if not terms:
+            return []
+        matches = self
+        if types:
+            matches = matches.filter(
+                content_type__in=ContentType.objects.get_for_models(*types).values()
+            )
+
+        def term_match(term):
+            if len(term) < MIN_PREFIX_LENGTH:
+                return Q(token=term)
+            return Q(token__istartswith=term)
+
+        conditions = [term_match(term) for term in terms]
+        any_term = Q()
+        for condition in conditions:
+            any_term |= condition
+        matched = {
+            f"term_{i}": Max(
+                Case(
+                    When(condition, then=Value(1)),
+                    default=Value(0),
+                    output_field=models.IntegerField(),
+                )
+            )
+            for i, condition in enumerate(conditions)
+        }
+        hits = (
+            matches.filter(any_term)
+            .values("content_type_id", "object_id")
+            .annotate(
+                score=Sum(
+                    F("weight")
+                    * Case(
+                        When(token__in=terms, then=Value(2)),
+                        default=Value(1),
+                        output_field=models.IntegerField(),
+                    )
+                ),
+                **matched,
+            )
+            .filter(**{name: 1 for name in matched})
+            .order_by("-score", "object_id")
+            .values_list("object_id", "score")[:first]
+        )
+        hits = list(hits)
+        objects = ObjectUid.objects.resolve_uids(uid for uid, _ in hits)
+        return [(objects[uid], score) for uid, score in hits if uid in objects]
+
+
+class SearchToken(models.Model):
+    """
+    Inverted index behind search: one row per distinct token of a
+    searchable object.
+    """
+
+    id = models.BigAutoField(primary_key=True)
+    token = models.CharField(max_length=64)
+    content_type = models.ForeignKey(ContentType, on_delete=models.CASCADE)
+    object_id = models.UUIDField(db_index=True)
+    weight = models.IntegerField()
+
+    objects = SearchTokenQuerySet.as_manager()
+
+    class Meta:
+        # covers the whole search query, so it never reads the table itself
+        indexes = [
+            models.Index(fields=["token", "content_type", "object_id", "weight"])
+        ]
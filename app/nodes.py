@@ -28,6 +28,16 @@ from app.models import TransportationSKU as TransportationSKUModel
 from app.models import Vessel as VesselModel
 from app.models import FormTemplate as FormTemplateModel
 from app.models import RenderedForm as RenderedFormModel
+from app.derivatives import PREVIEW, thumbnail_kind, thumbnail_size
+from app.loaders import get_loaders
+from app.optimizer import CONNECTION_ARGS, OptimizedConnectionField
+
+
+def resolve_thumbnail_url(info, field_file, size):
+    loaders = get_loaders(info)
+    return loaders.derivatives.load_url(
+        field_file, thumbnail_kind(thumbnail_size(size)), loaders.file_urls
+    )
 
 
 class AttachmentFilterSet(django_filters.FilterSet):
@@ -43,13 +53,13 @@ class AttachmentFilterSet(django_filters.FilterSet):
         return queryset.filter(name__icontains=value)
 
     def filename_exact_filter(self, queryset, name, value):
-        return queryset.filter(attached_file=value)
+        return queryset.filter(name=value)
 
     def filename_like_filter(self, queryset, name, value):
-        return queryset.filter(attached_file__icontains=value)
+        return queryset.filter(name__icontains=value)
 
     def filename_extension_filter(self, queryset, name, value):
-        return queryset.filter(attached_file__endswith=f".{value}")
+        return queryset.filter(name__iendswith=f".{value}")
 
 
 class AttachmentNode(DjangoObjectType):
@@ -60,13 +70,56 @@ class AttachmentNode(DjangoObjectType):
 
     metadata = generic.GenericScalar()
     url = graphene.String()
+    thumbnail_url = graphene.String(size=graphene.Int(default_value=128))
+    preview_url = graphene.String()
     attached_to = graphene.String()
 
+    optimizer_hints = {
+        "url": ["attached_file"],
+        "thumbnail_url": ["attached_file"],
+        "preview_url": ["attached_file"],
+        "attached_to": ["content_type", "object_id"],
+    }
+
     def resolve_url(self, info):
-        return self.attached_file.url
+        return get_loaders(info).file_urls.load_for(self.attached_file)
+
+    def resolve_thumbnail_url(self, info, size):
+        return resolve_thumbnail_url(info, self.attached_file, size)
+
+    def resolve_preview_url(self, info):
+        loaders = get_loaders(info)
+        return loaders.derivatives.load_url(
+            self.attached_file, PREVIEW, loaders.file_urls
+        )
 
     def resolve_attached_to(self, info):
-        return self.content_object.__class__.__name__
+        return (
+            get_loaders(info)
+            .content_objects.load((self.content_type_id, self.object_id))
+            .then(lambda content_object: content_object.__class__.__name__)
+        )
+
+
+def resolve_batched_attachments(root, info, **args):
+    if any(v is not None for k, v in args.items() if k not in CONNECTION_ARGS):
+        return root.attachments.all()
+    if "attachments" in getattr(root, "_prefetched_objects_cache", {}):
+        return root.attachments.all()
+    return get_loaders(info).attachments.load_for(root)
+
+
+class AttachmentConnectionField(OptimizedConnectionField):
+    """
+    Attachment connection whose unfiltered pages are served from the request's
+    batched attachments loader instead of one query per parent object.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(AttachmentNode, *args, **kwargs)
+
+    def get_resolver(self, parent_resolver):
+        return super().get_resolver(resolve_batched_attachments)
 
 
 class InvoiceFilterSet(django_filters.FilterSet):
@@ -83,7 +136,9 @@ class InvoiceNode(DjangoObjectType):
 
     uid = graphene.UUID(source="pk")
     metadata = generic.GenericScalar()
-    attachments = DjangoFilterConnectionField(AttachmentNode)
+    attachments = AttachmentConnectionField()
+    line_items = OptimizedConnectionField(lambda: LineItemNode)
+    credits = OptimizedConnectionField(lambda: CreditNode)
 
 
 class SKUFilterSet(django_filters.FilterSet):
@@ -116,13 +171,17 @@ class SKUNode(DjangoObjectType):
 
     uid = graphene.UUID(source="pk")
     metadata = generic.GenericScalar()
-    attachments = DjangoFilterConnectionField(AttachmentNode)
+    attachments = AttachmentConnectionField()
     image_url = graphene.String()
+    thumbnail_url = graphene.String(size=graphene.Int(default_value=128))
+
+    optimizer_hints = {"image_url": ["image"], "thumbnail_url": ["image"]}
 
     def resolve_image_url(self, info):
-        if self.image:
-            return self.image.url
-        return ""
+        return get_loaders(info).file_urls.load_for(self.image)
+
+    def resolve_thumbnail_url(self, info, size):
+        return resolve_thumbnail_url(info, self.image, size)
 
 
 class ContactFilterSet(django_filters.FilterSet):
@@ -150,16 +209,22 @@ class ContactNode(DjangoObjectType):
     fullname = graphene.String(source="fullname")
     uid = graphene.UUID(source="pk")
     metadata = generic.GenericScalar()
-    attachments = DjangoFilterConnectionField(AttachmentNode)
+    attachments = AttachmentConnectionField()
     image_url = graphene.String()
+    thumbnail_url = graphene.String(size=graphene.Int(default_value=128))
+
+    optimizer_hints = {
+        "name": ["first_name", "last_name"],
+        "fullname": ["title", "first_name", "last_name"],
+        "image_url": ["image"],
+        "thumbnail_url": ["image"],
+    }
 
     def resolve_image_url(self, info):
-        if self.image:
-            return self.image.url
-        return ""
+        return get_loaders(info).file_urls.load_for(self.image)
 
-    def resolve_attachments(self, info):
-        return self.attachments.all()
+    def resolve_thumbnail_url(self, info, size):
+        return resolve_thumbnail_url(info, self.image, size)
 
 
 class ClientNode(DjangoObjectType):
@@ -170,24 +235,30 @@ class ClientNode(DjangoObjectType):
 
     uid = graphene.UUID(source="pk")
     metadata = generic.GenericScalar()
-    attachments = DjangoFilterConnectionField(AttachmentNode)
+    attachments = AttachmentConnectionField()
     image_url = graphene.String()
+    thumbnail_url = graphene.String(size=graphene.Int(default_value=128))
     invoice_counts = generic.GenericScalar()
+    vessels = OptimizedConnectionField(lambda: VesselNode)
+    tasks = OptimizedConnectionField(lambda: TaskNode)
+    invoices = OptimizedConnectionField(InvoiceNode)
+    forms = OptimizedConnectionField(lambda: FormTemplateNode)
+    rendered_forms = OptimizedConnectionField(lambda: RenderedFormNode)
+
+    optimizer_hints = {
+        "image_url": ["image"],
+        "thumbnail_url": ["image"],
+        "invoice_counts": [],
+    }
 
     def resolve_image_url(self, info):
-        if self.image:
-            return self.image.url
-        return ""
+        return get_loaders(info).file_urls.load_for(self.image)
+
+    def resolve_thumbnail_url(self, info, size):
+        return resolve_thumbnail_url(info, self.image, size)
 
     def resolve_invoice_counts(self, info):
-        return {
-            "open": self.invoices.filter(state=1).count(),
-            "paid_partial": self.invoices.filter(state=2).count(),
-            "paid_full": self.invoices.filter(state=3).count(),
-            "drafts": self.invoices.filter(state=0).count(),
-            "closed": self.invoices.filter(state=4).count(),
-            "void": self.invoices.filter(state=-1).count(),
-        }
+        return get_loaders(info).invoice_counts.load(self.pk)
 
 
 class VesselNode(DjangoObjectType):
@@ -197,13 +268,18 @@ class VesselNode(DjangoObjectType):
         filter_fields = {"uid": ["exact"], "name": ["exact", "icontains"]}
 
     metadata = generic.GenericScalar()
-    attachments = DjangoFilterConnectionField(AttachmentNode)
+    attachments = AttachmentConnectionField()
     image_url = graphene.String()
+    thumbnail_url = graphene.String(size=graphene.Int(default_value=128))
+    jobs = OptimizedConnectionField(lambda: JobNode)
+
+    optimizer_hints = {"image_url": ["image"], "thumbnail_url": ["image"]}
 
     def resolve_image_url(self, info):
-        if self.image:
-            return self.image.url
-        return ""
+        return get_loaders(info).file_urls.load_for(self.image)
+
+    def resolve_thumbnail_url(self, info, size):
+        return resolve_thumbnail_url(info, self.image, size)
 
 
 class TaskNode(DjangoObjectType):
@@ -213,7 +289,7 @@ class TaskNode(DjangoObjectType):
         filter_fields = {"uid": ["exact"]}
 
     metadata = generic.GenericScalar()
-    attachments = DjangoFilterConnectionField(AttachmentNode)
+    attachments = AttachmentConnectionField()
 
 
 class JobNode(DjangoObjectType):
@@ -223,7 +299,8 @@ class JobNode(DjangoObjectType):
         filter_fields = {"uid": ["exact"]}
 
     metadata = generic.GenericScalar()
-    attachments = DjangoFilterConnectionField(AttachmentNode)
+    attachments = AttachmentConnectionField()
+    invoices = OptimizedConnectionField(InvoiceNode)
 
 
 class LineItemNode(DjangoObjectType):
@@ -261,10 +338,10 @@ class FormTemplateNode(DjangoObjectType):
     url = graphene.String()
     annotations = generic.GenericScalar()
 
+    optimizer_hints = {"url": ["template_file"]}
+
     def resolve_url(self, info):
-        if not self.template_file:
-            return ""
-        return self.template_file.url
+        return get_loaders(info).file_urls.load_for(self.template_file)
 
 
 class RenderedFormNode(DjangoObjectType):
@@ -277,7 +354,7 @@ class RenderedFormNode(DjangoObjectType):
     rendering_data = generic.GenericScalar()
     url = graphene.String()
 
+    optimizer_hints = {"url": ["rendered_file"]}
+
     def resolve_url(self, info):
-        if not self.rendered_file:
-            return ""
-        return self.rendered_file.url
+        return get_loaders(info).file_urls.load_for(self.rendered_file)
@@ -0,0 +1,341 @@
+from django.contrib.contenttypes.fields import GenericRelation
+from django.db.models import F, Manager, Prefetch, QuerySet, Window
+from django.db.models.expressions import RawSQL
+from django.db.models.functions import RowNumber
+from graphene import Dynamic
+from graphene.relay import Connection
+from graphene.utils.str_converters import to_snake_case
+from graphql_relay.connection.arrayconnection import cursor_to_offset
+from graphene_django import DjangoConnectionField, DjangoObjectType
+from graphene_django.filter import DjangoFilterConnectionField
+from graphql.execution.values import get_argument_values
+from graphql.language.ast import Field, FragmentSpread, InlineFragment, Variable
+from graphql.type.definition import get_named_type
+from promise import Promise
+
+CONNECTION_ARGS = {"first", "last", "before", "after", "offset"}
+
+
+def optimize(queryset, info):
+    """
+    Applies select_related/prefetch_related/only to a root queryset based on
+    the fields selected below the field currently being resolved.
+    """
+    node_type, selections = _node_selections(
+        info.return_type, info.field_asts, info.fragments
+    )
+    if node_type is None:
+        return queryset
+    plan = _QueryPlan(queryset.model, node_type, selections, info)
+    return plan.apply(queryset)
+
+
+def _fields(selection_asts, fragments):
+    """
+    Flattens fragments and groups the selected fields by response name.
+    """
+    fields = {}
+    for ast in selection_asts:
+        if ast.selection_set is None:
+            continue
+        for selection in ast.selection_set.selections:
+            if isinstance(selection, Field):
+                fields.setdefault(selection.name.value, []).append(selection)
+            elif isinstance(selection, FragmentSpread):
+                fragment = fragments[selection.name.value]
+                for name, asts in _fields([fragment], fragments).items():
+                    fields.setdefault(name, []).extend(asts)
+            elif isinstance(selection, InlineFragment):
+                for name, asts in _fields([selection], fragments).items():
+                    fields.setdefault(name, []).extend(asts)
+    return fields
+
+
+def _node_selections(graphql_type, field_asts, fragments):
+    """
+    Resolves a field to the DjangoObjectType it returns and the ASTs selected
+    on it, looking through edges { node } for connections.
+    """
+    graphql_type = get_named_type(graphql_type)
+    graphene_type = getattr(graphql_type, "graphene_type", None)
+    if graphene_type is None:
+        return None, []
+    if issubclass(graphene_type, Connection):
+        edges = _fields(field_asts, fragments).get("edges")
+        if not edges:
+            return None, []
+        edge_type = get_named_type(graphql_type.fields["edges"].type)
+        nodes = _fields(edges, fragments).get("node")
+        if not nodes:
+            return None, []
+        return _node_selections(edge_type.fields["node"].type, nodes, fragments)
+    if issubclass(graphene_type, DjangoObjectType):
+        return graphql_type, field_asts
+    return None, []
+
+
+def _model_fields(model):
+    fields = {}
+    for field in model._meta.get_fields():
+        if field.auto_created and not field.concrete:
+            fields[field.get_accessor_name()] = field
+        else:
+            fields[field.name] = field
+    return fields
+
+
+def _is_filtered(field_asts, variables):
+    for ast in field_asts:
+        for argument in ast.arguments or []:
+            if argument.name.value in CONNECTION_ARGS:
+                continue
+            if isinstance(argument.value, Variable):
+                if variables.get(argument.value.name.value) is None:
+                    continue
+            return True
+    return False
+
+
+def _node_field(node, field_name):
+    field = node._meta.fields.get(field_name)
+    if isinstance(field, Dynamic):
+        field = field.get_type()
+    return field
+
+
+def _uses_prefetch_cache(node, field_name):
+    """
+    Plain lists read prefetched rows through the related manager, but a
+    connection only does so if it is an OptimizedConnectionField.
+    """
+    field = _node_field(node, field_name)
+    if isinstance(field, DjangoConnectionField):
+        return isinstance(field, OptimizedConnectionField)
+    return True
+
+
+def _page_limit(field, field_def, asts, variables):
+    """
+    How many rows per parent a prefetched connection needs for the pages
+    these ASTs select: everything up to the end of the page, plus one to
+    tell whether there is a next page. None if a page may need every row
+    (last, before, or a cursor that is not an offset).
+    """
+    if not isinstance(field, OptimizedConnectionField):
+        return None
+    limit = 0
+    for ast in asts:
+        args = get_argument_values(field_def.args, ast.arguments, variables)
+        if args.get("last") is not None or args.get("before") is not None:
+            return None
+        first = args.get("first")
+        if first is None:
+            first = field.max_limit
+        if first is None:
+            return None
+        start = args.get("offset") or 0
+        if args.get("after") is not None:
+            after = cursor_to_offset(args["after"])
+            if after is None:
+                return None
+            start += after + 1
+        limit = max(limit, start + first + 1)
+    return limit
+
+
+class _QueryPlan:
+    def __init__(self, model, graphql_type, selection_asts, info, prefix=""):
+        self.select_related = []
+        self.prefetch_related = []
+        # None means some selected field needs columns we can't name, so every
+        # column gets loaded.
+        self.only = {prefix + model._meta.pk.name}
+        node = graphql_type.graphene_type
+        hints = getattr(node, "optimizer_hints", {})
+        model_fields = _model_fields(model)
+        fragments = info.fragments
+
+        for name, asts in _fields(selection_asts, fragments).items():
+            if name.startswith("__"):
+                continue
+            field_name = to_snake_case(name)
+            if field_name in hints:
+                self._add_only(prefix, hints[field_name])
+                continue
+            if field_name == "id":
+                continue
+            field = model_fields.get(field_name)
+            if field is None:
+                self.only = None
+                continue
+            if not field.is_relation:
+                self._add_only(prefix, [field.name])
+                continue
+            related_type, related_asts = _node_selections(
+                graphql_type.fields[name].type, asts, fragments
+            )
+            if related_type is None:
+                self._add_only(prefix, [field.name] if field.concrete else [])
+                continue
+            if field.concrete and (field.many_to_one or field.one_to_one):
+                self._add_only(prefix, [field.name])
+                self._add_select_related(
+                    _QueryPlan(
+                        field.related_model,
+                        related_type,
+                        related_asts,
+                        info,
+                        prefix=f"{prefix}{field.name}__",
+                    ),
+                    prefix + field.name,
+                )
+                continue
+            if _is_filtered(asts, info.variable_values or {}):
+                continue
+            if not _uses_prefetch_cache(node, field_name):
+                continue
+            plan = _QueryPlan(field.related_model, related_type, related_asts, info)
+            join_fields = _reverse_join_fields(field)
+            plan._add_only("", join_fields)
+            queryset = plan.apply(field.related_model._default_manager.all())
+            limit = _page_limit(
+                _node_field(node, field_name),
+                graphql_type.fields[name],
+                asts,
+                info.variable_values or {},
+            )
+            if limit is not None and join_fields:
+                queryset = limit_per_parent(queryset, join_fields, limit)
+            self.prefetch_related.append(Prefetch(prefix + field_name, queryset))
+
+    def _add_only(self, prefix, names):
+        if self.only is not None:
+            self.only.update(prefix + name for name in names)
+
+    def _add_select_related(self, plan, lookup):
+        self.select_related.append(lookup)
+        self.select_related.extend(plan.select_related)
+        self.prefetch_related.extend(plan.prefetch_related)
+        if plan.only is None:
+            self.only = None
+        else:
+            self._add_only("", plan.only)
+
+    def apply(self, queryset):
+        if self.select_related:
+            queryset = queryset.select_related(*self.select_related)
+        if self.prefetch_related:
+            queryset = queryset.prefetch_related(*self.prefetch_related)
+        if self.only is not None:
+            queryset = queryset.only(*self.only)
+        return queryset
+
+
+def _reverse_join_fields(field):
+    """
+    Columns a prefetched queryset must keep so Django can match its rows back
+    to their parents.
+    """
+    if isinstance(field, GenericRelation):
+        return [field.content_type_field_name, field.object_id_field_name]
+    if field.one_to_many or field.one_to_one:
+        return [field.field.name]
+    return []
+
+
+class PerParentLimitQuerySet(QuerySet):
+    """
+    Prefetch queryset loading at most `limit` rows for each value of the
+    `partition` columns. Once the prefetcher has restricted it to its
+    parents, the rows are numbered per parent with ROW_NUMBER() and only
+    the first ones are fetched, instead of loading all of them to slice
+    the pages in Python.
+    """
+
+    partition = ()
+    limit = None
+
+    def _clone(self):
+        clone = super()._clone()
+        clone.partition = self.partition
+        clone.limit = self.limit
+        return clone
+
+    def _ordering(self):
+        ordering = list(self.query.order_by or self.model._meta.ordering or [])
+        if not all(isinstance(field, str) for field in ordering):
+            return None
+        return ordering + ["pk"]
+
+    def _fetch_all(self):
+        ordering = self._ordering()
+        if self._result_cache is not None or self.limit is None or ordering is None:
+            return super()._fetch_all()
+        rows = QuerySet(self.model, self.query.chain(), self._db, self._hints)
+        ranked = (
+            rows.order_by()
+            .annotate(
+                prefetch_pk=F("pk"),
+                prefetch_rank=Window(
+                    RowNumber(),
+                    partition_by=[F(field) for field in self.partition],
+                    order_by=[
+                        F(field[1:]).desc() if field.startswith("-") else F(field)
+                        for field in ordering
+                    ],
+                ),
+            )
+            .values("prefetch_pk", "prefetch_rank")
+        )
+        sql, params = ranked.query.get_compiler(self.db).as_sql()
+        rows = rows.filter(
+            pk__in=RawSQL(
+                f"SELECT prefetch_pk FROM ({sql}) ranked WHERE prefetch_rank <= %s",
+                (*params, self.limit),
+            )
+        ).order_by(*ordering)
+        rows._prefetch_related_lookups = self._prefetch_related_lookups
+        self._result_cache = list(rows)
+        self._prefetch_done = True
+
+
+def limit_per_parent(queryset, partition, limit):
+    limited = PerParentLimitQuerySet(
+        queryset.model, queryset.query.chain(), queryset._db, queryset._hints
+    )
+    limited._prefetch_related_lookups = queryset._prefetch_related_lookups
+    limited.partition = partition
+    limited.limit = limit
+    return limited
+
+
+def _prefetched(iterable):
+    if isinstance(iterable, Manager):
+        iterable = iterable.get_queryset()
+    if isinstance(iterable, QuerySet) and iterable._result_cache is not None:
+        return list(iterable)
+    return None
+
+
+class OptimizedConnectionField(DjangoFilterConnectionField):
+    """
+    DjangoFilterConnectionField that runs the filtered queryset through the
+    selection-set optimizer before it is paginated, and serves unfiltered
+    pages straight from prefetched rows when the parent query loaded them.
+    """
+
+    @classmethod
+    def resolve_queryset(
+        cls, connection, iterable, info, args, filtering_args, **kwargs
+    ):
+        if Promise.is_thenable(iterable):
+            return iterable
+        filtered = any(v is not None for k, v in args.items() if k in filtering_args)
+        if not filtered:
+            prefetched = _prefetched(iterable)
+            if prefetched is not None:
+                return prefetched
+        queryset = super().resolve_queryset(
+            connection, iterable, info, args, filtering_args=filtering_args, **kwargs
+        )
+        return optimize(queryset, info)
@@ -0,0 +1,218 @@
+import hashlib
+import json
+import re
+import threading
+from collections import OrderedDict
+from functools import partial
+
+from django.conf import settings
+from django.core.cache import caches
+from graphql.backend.base import GraphQLDocument
+from graphql.backend.core import GraphQLCoreBackend
+from graphql.error import GraphQLError
+from graphql.execution import ExecutionResult, execute
+from graphql.language import ast
+from graphql.language.base import parse, print_ast
+from graphql.validation import validate
+
+GQL_TEMPLATE_RE = re.compile(r"gql`(.*?)`", re.S)
+
+
+def query_hash(query):
+    return hashlib.sha256(query.encode()).hexdigest()
+
+
+def extract_queries(source):
+    """
+    The documents of the gql`...` templates in a frontend source file.
+    """
+    return [match.strip() for match in GQL_TEMPLATE_RE.findall(source)]
+
+
+class DocumentCache:
+    """
+    Process-wide LRU of parsed and validated documents keyed by the hash of
+    their query string.
+    """
+
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+            return entry
+
+    def set(self, key, document):
+        with self._lock:
+            self._entries[key] = document
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+
+class CachedDocumentBackend(GraphQLCoreBackend):
+    """
+    GraphQLCoreBackend that parses and validates each distinct query string
+    once, instead of on every request. Invalid documents are not cached.
+    """
+
+    def __init__(self, cache, executor=None):
+        super().__init__(executor=executor)
+        self.cache = cache
+
+    def document_from_string(self, schema, document_string):
+        if isinstance(document_string, ast.Document):
+            return super().document_from_string(schema, document_string)
+        key = (id(schema), query_hash(document_string))
+        document = self.cache.get(key)
+        if document is not None:
+            return document
+        document_ast = parse(document_string)
+        errors = validate(schema, document_ast)
+        if errors:
+            result = ExecutionResult(errors=errors, invalid=True)
+            execute_document = lambda *args, **kwargs: result
+        else:
+            execute_document = partial(
+                execute, schema, document_ast, **self.execute_params
+            )
+        document = GraphQLDocument(
+            schema=schema,
+            document_string=document_string,
+            document_ast=document_ast,
+            execute=execute_document,
+        )
+        if not errors:
+            self.cache.set(key, document)
+        return document
+
+
+document_cache = DocumentCache(getattr(settings, "GRAPHQL_DOCUMENT_CACHE_SIZE", 256))
+cached_backend = CachedDocumentBackend(document_cache)
+
+
+class PreparedBackend:
+    """
+    Backend handing back a document already built for this request, so
+    GraphQLView does not parse and validate the same query string again.
+    Other query strings go to the wrapped backend.
+    """
+
+    def __init__(self, backend, document):
+        self.backend = backend
+        self.document = document
+
+    def document_from_string(self, schema, document_string):
+        if (
+            schema is self.document.schema
+            and document_string == self.document.document_string
+        ):
+            return self.document
+        return self.backend.document_from_string(schema, document_string)
+
+
+class PersistedQueries:
+    """
+    Query strings by sha256, for automatic persisted queries: the ones in
+    the manifest, plus those clients registered at runtime in the
+    PERSISTED_QUERIES_CACHE. Runtime registrations are shared between
+    workers only if that cache is (Redis, Memcached, database); with a
+    local-memory cache each worker process keeps its own, and clients
+    register a query again with every worker that has not seen it.
+    """
+
+    def __init__(self):
+        self._manifest = None
+        self._lock = threading.Lock()
+
+    @property
+    def manifest(self):
+        if self._manifest is None:
+            with self._lock:
+                if self._manifest is None:
+                    self._manifest = self._load_manifest()
+        return self._manifest
+
+    def _load_manifest(self):
+        path = getattr(settings, "PERSISTED_QUERIES_MANIFEST", None)
+        try:
+            with open(path) as f:
+                return json.load(f)
+        except (TypeError, FileNotFoundError):
+            return {}
+
+    @property
+    def cache(self):
+        return caches[getattr(settings, "PERSISTED_QUERIES_CACHE", "default")]
+
+    def get(self, sha256):
+        query = self.manifest.get(sha256)
+        if query is None:
+            query = self.cache.get(f"persisted-query:{sha256}")
+        return query
+
+    def register(self, sha256, query):
+        if sha256 not in self.manifest:
+            self.cache.set(f"persisted-query:{sha256}", query, timeout=None)
+
+
+persisted_queries = PersistedQueries()
+
+
+def build_manifest(sources, schema):
+    """
+    {sha256: query} for the valid queries in frontend sources, and the
+    [(query, errors)] that do not validate against schema.
+
+    Queries are normalized by graphql-core's print_ast, and a client only
+    hits the manifest if it hashes exactly that text. Apollo Client hashes
+    graphql-js' printer output after adding __typename to every selection,
+    which differs; for it, use load_client_manifest on the manifest its
+    build generates instead.
+    """
+    manifest, invalid = {}, []
+    for source in sources:
+        for query in extract_queries(source):
+            document_ast = parse(query)
+            errors = validate(schema, document_ast)
+            if errors:
+                invalid.append((query, errors))
+                continue
+            printed = print_ast(document_ast)
+            manifest[query_hash(printed)] = printed
+    return manifest, invalid
+
+
+def load_client_manifest(data, schema):
+    """
+    {sha256: query} from a persisted query manifest generated by the client
+    build (Apollo's format: {"operations": [{"id": ..., "body": ...}]}), so
+    the keys are the hashes of the very query strings the client sends, and
+    the [(query, errors)] that do not validate against schema or whose id is
+    not the sha256 of their body.
+    """
+    manifest, invalid = {}, []
+    for operation in data["operations"]:
+        query = operation["body"]
+        if operation["id"] != query_hash(query):
+            error = GraphQLError(f"id {operation['id']} is not the sha256 of the body")
+            invalid.append((query, [error]))
+            continue
+        errors = validate(schema, parse(query))
+        if errors:
+            invalid.append((query, errors))
+            continue
+        manifest[operation["id"]] = query
+    return manifest, invalid
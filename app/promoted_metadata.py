@@ -0,0 +1,144 @@
+from django.db import migrations, models
+from django.db.models import Transform
+from django.db.models.expressions import Col
+from django.db.models.fields.json import KeyTransform, compile_json_path
+
+PROMOTED_KEY_LENGTH = 255
+
+
+def promoted_column(field_column, key):
+    return f"{field_column}_{key}"
+
+
+class PromotedKey(Transform):
+    """
+    metadata__<key> for a promoted key. Compares the key's value as text, so
+    on MySQL/MariaDB it reads the indexed generated column instead of
+    extracting the key from every row's document. Elsewhere it extracts it.
+    """
+
+    output_field = models.CharField(max_length=PROMOTED_KEY_LENGTH)
+
+    def __init__(self, key_name, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.key_name = key_name
+
+    def get_transform(self, name):
+        transform = super().get_transform(name)
+        if transform is not None:
+            return transform
+        return NestedKeyFactory(name)
+
+    def as_mysql(self, compiler, connection):
+        if not isinstance(self.lhs, Col):
+            lhs, params = self.as_sql(compiler, connection)
+            return f"JSON_UNQUOTE({lhs})", params
+        column = promoted_column(self.lhs.target.column, self.key_name)
+        return (
+            f"{compiler.quote_name_unless_alias(self.lhs.alias)}."
+            f"{connection.ops.quote_name(column)}",
+            [],
+        )
+
+    def as_sql(self, compiler, connection):
+        lhs, params = compiler.compile(self.lhs)
+        return f"JSON_EXTRACT({lhs}, %s)", [
+            *params,
+            compile_json_path([self.key_name]),
+        ]
+
+
+class NestedKeyFactory:
+    """
+    metadata__<key>__<nested key>. Only the promoted key's text is stored in
+    its column, so paths below it are looked up in the document as for any
+    other JSONField key.
+    """
+
+    def __init__(self, key_name):
+        self.key_name = key_name
+
+    def __call__(self, promoted, *args, **kwargs):
+        return KeyTransform(
+            self.key_name,
+            KeyTransform(promoted.key_name, promoted.lhs),
+            *args,
+            **kwargs,
+        )
+
+
+class PromotedKeyFactory:
+    def __init__(self, key_name):
+        self.key_name = key_name
+
+    def __call__(self, *args, **kwargs):
+        return PromotedKey(self.key_name, *args, **kwargs)
+
+
+class PromotedJSONField(models.JSONField):
+    """
+    A JSONField whose promoted_keys are mirrored into stored, indexed
+    generated columns (<column>_<key>) on MySQL/MariaDB, which filters like
+    metadata__type="item" use transparently. Promoted keys are compared as
+    text of at most PROMOTED_KEY_LENGTH characters, so they suit short string
+    values such as types and tags.
+
+    The columns are created by promote_keys() migrations: adding a key here
+    needs a migration that promotes it.
+    """
+
+    def __init__(self, *args, promoted_keys=(), **kwargs):
+        self.promoted_keys = tuple(promoted_keys)
+        super().__init__(*args, **kwargs)
+
+    def deconstruct(self):
+        # the columns live outside the model state, see promote_keys()
+        name, _, args, kwargs = super().deconstruct()
+        return name, "django.db.models.JSONField", args, kwargs
+
+    def get_transform(self, name):
+        if name in self.promoted_keys:
+            return PromotedKeyFactory(name)
+        return super().get_transform(name)
+
+
+def promote_keys(model_name, field_name, keys):
+    """
+    Migration operation adding a stored generated column and an index for
+    each key on MySQL/MariaDB. Other databases have nothing to create.
+    """
+
+    def columns(apps, schema_editor):
+        model = apps.get_model("app", model_name)
+        field = model._meta.get_field(field_name)
+        quote = schema_editor.quote_name
+        for key in keys:
+            column = promoted_column(field.column, key)
+            yield quote(model._meta.db_table), quote(field.column), key, quote(
+                column
+            ), quote(f"{model._meta.db_table}_{column}_idx")
+
+    def forwards(apps, schema_editor):
+        if schema_editor.connection.vendor != "mysql":
+            return
+        for table, source, key, column, index in columns(apps, schema_editor):
+            path = compile_json_path([key]).replace("'", "''")
+            schema_editor.execute(
+                f"ALTER TABLE {table} ADD COLUMN {column} "
+                # binary collation keeps matches case-sensitive, as they are
+                # when comparing JSON values
+                f"VARCHAR({PROMOTED_KEY_LENGTH}) CHARACTER SET utf8mb4 "
+                f"COLLATE utf8mb4_bin GENERATED ALWAYS AS "
+                f"(LEFT(JSON_UNQUOTE(JSON_EXTRACT({source}, '{path}')), "
+                f"{PROMOTED_KEY_LENGTH})) STORED, ADD INDEX {index} ({column})"
+            )
+
+    def backwards(apps, schema_editor):
+        if schema_editor.connection.vendor != "mysql":
+            return
+        for table, _, _, column, index in columns(apps, schema_editor):
+            schema_editor.execute(
+                f"ALTER TABLE {table} DROP INDEX {index}, DROP COLUMN {column}"
+            )
+
+    return migrations.RunPython(forwards, backwards)
@@ -0,0 +1,264 @@
+import logging
+import time
+
+from django.conf import settings
+from django.core.cache import cache
+from graphene.relay import Connection
+from graphene_django.settings import graphene_settings
+from graphql.error import GraphQLError
+from graphql.language.ast import (
+    Field,
+    FragmentDefinition,
+    FragmentSpread,
+    InlineFragment,
+    IntValue,
+    ListValue,
+    OperationDefinition,
+    Variable,
+)
+from graphql.type.definition import GraphQLList, GraphQLNonNull, get_named_type
+
+logger = logging.getLogger(__name__)
+
+# Cost of resolving a field once, on top of its selections. Object fields
+# cost 1 and scalars 0 unless listed here as "Type.field" or "*.field".
+FIELD_COSTS = {
+    "Query.search": 10,
+    "Query.nodes": 5,
+    "ClientNode.invoiceCounts": 2,
+    "*.url": 1,
+    "*.imageUrl": 1,
+    "*.thumbnailUrl": 1,
+    "*.previewUrl": 1,
+}
+MUTATION_COST = 10
+# Fields resolving every item of a list argument, as "Type.field": argument.
+# Their cost, selections included, is multiplied by the argument's length.
+PER_ITEM_ARGUMENTS = {"Query.nodes": "uids"}
+
+
+class QueryCostError(GraphQLError):
+    pass
+
+
+class QueryThrottled(Exception):
+    pass
+
+
+class QueryCost:
+    """
+    Static cost and depth of one operation of a document, computed before
+    it runs. Connections and lists multiply the cost of their selections by
+    the number of items they may return: first/last, or the page size
+    limit when neither is given, and PER_ITEM_ARGUMENTS fields by the
+    length of their list argument. Connection edges/node levels do not
+    count towards depth.
+    """
+
+    def __init__(self, schema, document_ast, variables=None, operation_name=None):
+        self.schema = schema
+        self.variables = dict(variables or {})
+        self.fragments = {}
+        operations = []
+        for definition in document_ast.definitions:
+            if isinstance(definition, FragmentDefinition):
+                self.fragments[definition.name.value] = definition
+            elif isinstance(definition, OperationDefinition):
+                operations.append(definition)
+        self.operation = self._select_operation(operations, operation_name)
+        self.cost, self.depth = 0, 0
+        if self.operation is None:
+            return
+        for definition in self.operation.variable_definitions or []:
+            name = definition.variable.name.value
+            default = definition.default_value
+            if self.variables.get(name) is None and isinstance(default, IntValue):
+                self.variables[name] = int(default.value)
+        root_type = {
+            "query": schema.get_query_type(),
+            "mutation": schema.get_mutation_type(),
+            "subscription": schema.get_subscription_type(),
+        }[self.operation.operation]
+        self.cost, self.depth = self._selections_cost(
+            root_type, self.operation.selection_set, 0, frozenset()
+        )
+
+    @staticmethod
+    def _select_operation(operations, operation_name):
+        if operation_name:
+            for operation in operations:
+                if operation.name and operation.name.value == operation_name:
+                    return operation
+            return None
+        return operations[0] if len(operations) == 1 else None
+
+    def _selections_cost(self, parent_type, selection_set, depth, fragments_seen):
+        cost, max_depth = 0, depth
+        for selection in selection_set.selections:
+            if isinstance(selection, Field):
+                field_cost, field_depth = self._field_cost(
+                    parent_type, selection, depth, fragments_seen
+                )
+            else:
+                if isinstance(selection, FragmentSpread):
+                    name = selection.name.value
+                    fragment = self.fragments.get(name)
+                    if fragment is None or name in fragments_seen:
+                        continue
+                    fragments_seen = fragments_seen | {name}
+                else:
+                    fragment = selection
+                fragment_type = parent_type
+                if fragment.type_condition is not None:
+                    fragment_type = self.schema.get_type(
+                        fragment.type_condition.name.value
+                    )
+                if fragment_type is None:
+                    continue
+                field_cost, field_depth = self._selections_cost(
+                    fragment_type, fragment.selection_set, depth, fragments_seen
+                )
+            cost += field_cost
+            max_depth = max(max_depth, field_depth)
+        return cost, max_depth
+
+    def _field_cost(self, parent_type, field, depth, fragments_seen):
+        name = field.name.value
+        field_def = getattr(parent_type, "fields", {}).get(name)
+        if name.startswith("__") or field_def is None:
+            return 0, depth
+        field_type = get_named_type(field_def.type)
+        # edges { node } inside a connection: each node counts, the levels don't
+        wrapper = _is_connection_part(parent_type)
+        if not wrapper:
+            depth += 1
+        if wrapper and name != "node":
+            cost = 0
+        elif parent_type is self.schema.get_mutation_type():
+            cost = MUTATION_COST
+        else:
+            cost = FIELD_COSTS.get(
+                f"{parent_type.name}.{name}",
+                FIELD_COSTS.get(f"*.{name}", 1 if field.selection_set else 0),
+            )
+        per_item = PER_ITEM_ARGUMENTS.get(f"{parent_type.name}.{name}")
+        if field.selection_set is None:
+            children, max_depth = 0, depth
+        else:
+            children, max_depth = self._selections_cost(
+                field_type, field.selection_set, depth, fragments_seen
+            )
+        if per_item is not None:
+            return self._argument_length(field, per_item) * (cost + children), max_depth
+        items = 1 if wrapper else self._items(field, field_def)
+        return cost + items * children, max_depth
+
+    def _argument_value(self, field, name):
+        for argument in field.arguments or []:
+            if argument.name.value != name:
+                continue
+            value = argument.value
+            if isinstance(value, Variable):
+                return self.variables.get(value.name.value)
+            return value
+        return None
+
+    def _argument_length(self, field, name):
+        value = self._argument_value(field, name)
+        if isinstance(value, ListValue):
+            return len(value.values)
+        if isinstance(value, (list, tuple)):
+            return len(value)
+        # a single value is coerced to a list of one
+        return 0 if value is None else 1
+
+    def _items(self, field, field_def):
+        field_type = field_def.type
+        if isinstance(field_type, GraphQLNonNull):
+            field_type = field_type.of_type
+        many = isinstance(field_type, GraphQLList) or _is_connection_part(
+            get_named_type(field_type)
+        )
+        if not many:
+            return 1
+        max_limit = graphene_settings.RELAY_CONNECTION_MAX_LIMIT or 100
+        for name in ("first", "last"):
+            value = self._argument_value(field, name)
+            if isinstance(value, IntValue):
+                value = int(value.value)
+            if isinstance(value, int):
+                return max(0, min(value, max_limit))
+        return max_limit
+
+
+def _is_connection_part(graphql_type):
+    """
+    Whether a type is a relay connection or one of their edge types.
+    """
+    graphene_type = getattr(graphql_type, "graphene_type", None)
+    if not isinstance(graphene_type, type):
+        return False
+    if issubclass(graphene_type, Connection):
+        return True
+    fields = getattr(getattr(graphene_type, "_meta", None), "fields", None) or {}
+    return "node" in fields and "cursor" in fields
+
+
+def _client_key(request):
+    user = getattr(request, "user", None)
+    if user is not None and user.is_authenticated:
+        return f"user:{user.pk}"
+    return f"ip:{request.META.get('REMOTE_ADDR')}"
+
+
+def charge(request, cost):
+    """
+    Counts cost against the client's per-minute budget, raising
+    QueryThrottled once it is spent.
+    """
+    budget = getattr(settings, "GRAPHQL_COST_PER_MINUTE", None)
+    if not budget or request is None:
+        return
+    window = int(time.time() // 60)
+    key = f"graphql-cost:{_client_key(request)}:{window}"
+    cache.add(key, 0, timeout=60)
+    try:
+        spent = cache.incr(key, cost)
+    except ValueError:
+        # expired between add() and incr()
+        cache.set(key, cost, timeout=60)
+        spent = cost
+    if spent > budget:
+        retry = 60 - int(time.time() % 60)
+        raise QueryThrottled(
+            f"Query cost budget of {budget} per minute is used up, "
+            f"retry in {retry} seconds"
+        )
+
+
+def check_query_cost(schema, document_ast, variables, operation_name, request=None):
+    """
+    Rejects operations deeper than GRAPHQL_MAX_DEPTH or costlier than
+    GRAPHQL_MAX_COST, and throttles clients over GRAPHQL_COST_PER_MINUTE.
+    Returns the QueryCost.
+    """
+    query_cost = QueryCost(schema, document_ast, variables, operation_name)
+    logger.info(
+        "graphql operation=%s cost=%d depth=%d",
+        operation_name or "-",
+        query_cost.cost,
+        query_cost.depth,
+    )
+    max_depth = getattr(settings, "GRAPHQL_MAX_DEPTH", None)
+    if max_depth and query_cost.depth > max_depth:
+        raise QueryCostError(
+            f"Query depth {query_cost.depth} exceeds the limit of {max_depth}"
+        )
+    max_cost = getattr(settings, "GRAPHQL_MAX_COST", None)
+    if max_cost and query_cost.cost > max_cost:
+        raise QueryCostError(
+            f"Query cost {query_cost.cost} exceeds the limit of {max_cost}; "
+            "request fewer items with first/last or fewer nested connections"
+        )
+    charge(request, query_cost.cost)
+    return query_cost
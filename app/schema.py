@@ -1,9 +1,19 @@
+import mimetypes
+import os
+from collections import defaultdict
+from datetime import datetime
+
 from graphene_django import DjangoObjectType
+from graphene_django.registry import get_global_registry
 import graphene
 from graphene import relay
 from graphene.types import generic
 from graphene_django.filter import DjangoFilterConnectionField
 import django_filters
+from django.core import signing
+from django.db import transaction
+from django.db.models import Q
+from django.utils.text import get_valid_filename
 
 from app.metadata import (
     SKUMetadataSchema,
@@ -29,11 +39,21 @@ from app.models import (
     ServiceSKU as ServiceSKUModel,
     TransportationSKU as TransportationSKUModel,
     Attachment as AttachmentModel,
+    AttachmentBlob as AttachmentBlobModel,
     FormTemplate as FormTemplateModel,
+    ObjectUid as ObjectUidModel,
+    SearchToken as SearchTokenModel,
     RenderedForm as RenderedFormModel,
+    schedule_derivation,
 )
 
 from app.nodes import *
+from app.tasks import render_form
+from app.keyset import KeysetConnectionField
+from app.optimizer import OptimizedConnectionField, optimize
+from app.file_urls import file_url
+from app.json_patch import MetadataPatch, patch_many, replace_document
+from app.uploads import CONFIRM_UPLOAD_MAX_AGE, CONFIRM_UPLOAD_SALT, get_upload_backend
 
 
 class ModifyFormTemplateMutation(graphene.Mutation):
@@ -47,18 +67,16 @@ class ModifyFormTemplateMutation(graphene.Mutation):
 
     @classmethod
     def mutate(cls, root, info, uid, name=None, fields=None, update_fields=False):
-        template = FormTemplateModel.objects.get(pk=uid)
-        if name:
-            template.name = name
+        templates = FormTemplateModel.objects.filter(pk=uid)
+        updates = {"name": name} if name else {}
+        patch = MetadataPatch()
         if fields:
-            original = template.fields
             if update_fields:
-                original.update(fields)
-                template.fields = original
+                patch = MetadataPatch.update(fields)
             else:
-                template.fields = fields
-            template.save()
-        return ModifyFormTemplateMutation(form_template=template)
+                updates["fields"] = fields
+        patch.apply(templates, field="fields", **updates)
+        return ModifyFormTemplateMutation(form_template=templates.get())
 
 
 class RenderFormTemplateMutation(graphene.Mutation):
@@ -66,19 +84,73 @@ class RenderFormTemplateMutation(graphene.Mutation):
         uid = graphene.UUID()
         fields = generic.GenericScalar()
         metadata = generic.GenericScalar()
+        async_render = graphene.Boolean()
+        bypass_cache = graphene.Boolean()
 
     rendered_form = graphene.Field(RenderedFormNode)
 
     @classmethod
-    def mutate(cls, root, info, uid, fields, metadata=None):
+    def mutate(
+        cls,
+        root,
+        info,
+        uid,
+        fields,
+        metadata=None,
+        async_render=False,
+        bypass_cache=False,
+    ):
         template = FormTemplateModel.objects.get(pk=uid)
-        rendered_form = template.render_with_data(fields)
-        if metadata:
-            rendered_form.metadata = metadata
-            rendered_form.save()
+        if async_render:
+            rendered_form = None
+            if not bypass_cache:
+                content_hash = template.content_hash(fields)
+                rendered_form = template.find_rendered([content_hash]).get(content_hash)
+            if rendered_form is None:
+                rendered_form = RenderedFormModel.objects.create(
+                    template=template,
+                    rendering_data=fields,
+                    metadata=metadata,
+                    status=RenderedFormModel.RenderStatus.PENDING,
+                )
+                transaction.on_commit(lambda: render_form.delay(rendered_form.uid))
+                return RenderFormTemplateMutation(rendered_form=rendered_form)
+        else:
+            rendered_form = template.render_with_data(
+                fields, use_cache=not bypass_cache
+            )
+        if metadata and rendered_form.metadata != metadata:
+            if rendered_form.metadata is None:
+                rendered_form.metadata = metadata
+                rendered_form.save()
+            else:
+                # a reused form already carries someone else's metadata, so
+                # give this render its own row pointing at the same file
+                rendered_form = RenderedFormModel.objects.create(
+                    template=template,
+                    rendering_data=rendered_form.rendering_data,
+                    rendered_file=rendered_form.rendered_file.name,
+                    content_hash=rendered_form.content_hash,
+                    metadata=metadata,
+                )
         return RenderFormTemplateMutation(rendered_form=rendered_form)
 
 
+class RenderFormBatchMutation(graphene.Mutation):
+    class Arguments:
+        uid = graphene.UUID()
+        rows = graphene.List(generic.GenericScalar, required=True)
+        bypass_cache = graphene.Boolean()
+
+    rendered_forms = graphene.List(RenderedFormNode)
+
+    @classmethod
+    def mutate(cls, root, info, uid, rows, bypass_cache=False):
+        template = FormTemplateModel.objects.get(pk=uid)
+        rendered_forms = template.render_many(rows, use_cache=not bypass_cache)
+        return RenderFormBatchMutation(rendered_forms=rendered_forms)
+
+
 class ContactInput(graphene.InputObjectType):
     first_name = graphene.String()
     last_name = graphene.String()
@@ -323,6 +395,9 @@ class ModifySKUMutation(graphene.Mutation):
         try:
             SKUModel.objects.filter(pk=uid).update(**sku_kwargs)
             sku = SKUModel.objects.get(pk=uid)
+            # update() sends no post_save, which keeps the index current
+            if set(sku_kwargs) & set(SKUModel.search_fields):
+                SearchTokenModel.objects.index([sku])
         except SKUModel.DoesNotExist:
             sku = SKUModel.objects.create(**sku_kwargs)
         return ModifySKUMutation(sku=sku)
@@ -366,15 +441,18 @@ class SetInvoiceMetadataMutation(graphene.Mutation):
     class Arguments:
         uid = graphene.UUID(required=True)
         metadata = generic.GenericScalar(required=True)
+        merge = graphene.Boolean()
 
     invoice = graphene.Field(InvoiceNode)
 
     @classmethod
-    def mutate(cls, root, info, uid, metadata):
-        invoice = Invoice.models.get(pk=uid)
-        invoice.metadata = metadata
-        invoice.save()
-        return SetInvoiceMetadataMutation(invoice=invoice)
+    def mutate(cls, root, info, uid, metadata, merge=False):
+        invoices = InvoiceModel.objects.filter(pk=uid)
+        if merge:
+            MetadataPatch().merge(metadata).apply(invoices)
+        else:
+            replace_document(invoices, metadata)
+        return SetInvoiceMetadataMutation(invoice=invoices.get())
 
 
 class AddLineItemMutation(graphene.Mutation):
@@ -394,10 +472,44 @@ class AddLineItemMutation(graphene.Mutation):
         if quantity:
             li_kwargs["quantity"] = quantity
         invoice = InvoiceModel.objects.get(pk=invoice_uid)
-        sku = SKU.objects.get(pk=sku_uid)
-        sku.add_to_invoice(invoice, **li_kwargs)
-        invoice.update_balances()
-        return AddLineItemMutation(invoice=invoice)
+        sku = SKUModel.objects.get(pk=sku_uid)
+        line_item = sku.add_to_invoice(invoice, **li_kwargs)
+        return AddLineItemMutation(line_item=line_item)
+
+
+class LineItemInput(graphene.InputObjectType):
+    sku_uid = graphene.UUID(required=True)
+    price = graphene.Float()
+    quantity = graphene.Float()
+
+
+class AddLineItemsMutation(graphene.Mutation):
+    class Arguments:
+        invoice_uid = graphene.UUID(required=True)
+        line_items = graphene.List(graphene.NonNull(LineItemInput), required=True)
+
+    invoice = graphene.Field(InvoiceNode)
+    line_items = graphene.List(LineItemNode)
+
+    @classmethod
+    def mutate(cls, root, info, invoice_uid, line_items):
+        invoice = InvoiceModel.objects.get(pk=invoice_uid)
+        skus = SKUModel.objects.in_bulk({li.sku_uid for li in line_items})
+        new_line_items = []
+        for li in line_items:
+            try:
+                sku = skus[li.sku_uid]
+            except KeyError:
+                raise Exception(f"SKU with UUID {li.sku_uid} not found")
+            li_kwargs = {}
+            if li.price:
+                li_kwargs["price"] = li.price
+            if li.quantity:
+                li_kwargs["quantity"] = li.quantity
+            new_line_items.append(sku.build_line_item(invoice, **li_kwargs))
+        created = LineItemModel.objects.bulk_add_to_invoice(invoice, new_line_items)
+        invoice.refresh_balances()
+        return AddLineItemsMutation(invoice=invoice, line_items=created)
 
 
 class DeleteLineItemMutation(graphene.Mutation):
@@ -412,7 +524,7 @@ class DeleteLineItemMutation(graphene.Mutation):
         invoice_uid = li.invoice.uid
         invoice = InvoiceModel.objects.get(pk=invoice_uid)
         li.delete()
-        invoice.update_balances()
+        invoice.refresh_balances()
         return DeleteLineItemMutation(invoice=invoice)
 
 
@@ -474,11 +586,19 @@ METADATA_MODELS = (
 )
 
 
+def metadata_model(uid):
+    model = ObjectUidModel.objects.models_for([uid], METADATA_MODELS).get(uid)
+    if model is None or not issubclass(model, METADATA_MODELS):
+        raise Exception(f"Object with UUID {uid} not found")
+    return model
+
+
 class ModifyMetadataMutation(graphene.Mutation):
     class Arguments:
         uid = graphene.UUID(required=True)
-        metadata = generic.GenericScalar(required=True)
+        metadata = generic.GenericScalar()
         mode = graphene.String()
+        operations = generic.GenericScalar()
 
     metadata = generic.GenericScalar()
     uid = graphene.UUID()
@@ -486,26 +606,193 @@ class ModifyMetadataMutation(graphene.Mutation):
     mode = graphene.String()
 
     @classmethod
-    def mutate(cls, root, info, uid, metadata, mode="update"):
-        for m in METADATA_MODELS:
-            try:
-                o = m.objects.get(pk=uid)
-                break
-            except m.DoesNotExist:
-                pass
+    def mutate(cls, root, info, uid, metadata=None, mode="update", operations=None):
+        """
+        mode is one of
+            update: sets the top-level keys in metadata (like dict.update)
+            merge: applies metadata as a JSON merge patch
+            replace: replaces metadata entirely
+            patch: applies operations, a list of
+                {"op": "set"|"merge"|"remove"|"append", "path": ..., "value": ...}
+        Edits are applied by the database, so concurrent edits to different
+        keys do not overwrite each other.
+        """
+        model = metadata_model(uid)
+        objects = model.objects.filter(pk=uid)
+        if mode == "replace":
+            replace_document(objects, metadata)
         else:
-            raise Exception(f"Object with UUID {uid} not found")
-        initial = o.metadata
-        if mode == "update":
-            initial.update(metadata)
-            o.metadata = initial
-        elif mode == "replace":
-            o.metadata = metadata
-        o.save()
-        final = o.metadata
+            if mode == "update":
+                patch = MetadataPatch.update(metadata or {})
+            elif mode == "merge":
+                patch = MetadataPatch().merge(metadata or {})
+            elif mode == "patch":
+                patch = MetadataPatch(operations or [])
+            else:
+                raise Exception(f"Unknown mode {mode}")
+            patch.apply(objects)
+        final = objects.values_list("metadata", flat=True).get()
         return ModifyMetadataMutation(
-            uid=uid, metadata=final, parent_type=o.__class__.__name__, mode=mode
+            uid=uid, metadata=final, parent_type=model.__name__, mode=mode
+        )
+
+
+class PatchMetadataInput(graphene.InputObjectType):
+    uid = graphene.UUID(required=True)
+    operations = generic.GenericScalar(required=True)
+
+
+class PatchMetadataMutation(graphene.Mutation):
+    """
+    Applies metadata patches to many objects at once, with one UPDATE per
+    model involved.
+    """
+
+    class Arguments:
+        patches = graphene.List(PatchMetadataInput, required=True)
+
+    uids = graphene.List(graphene.UUID)
+
+    @classmethod
+    def mutate(cls, root, info, patches):
+        models_by_uid = ObjectUidModel.objects.models_for(
+            [p.uid for p in patches], METADATA_MODELS
         )
+        by_model = defaultdict(dict)
+        for p in patches:
+            model = models_by_uid.get(p.uid)
+            if model is None or not issubclass(model, METADATA_MODELS):
+                raise Exception(f"Object with UUID {p.uid} not found")
+            by_model[model][p.uid] = MetadataPatch(p.operations)
+        with transaction.atomic():
+            for model, model_patches in by_model.items():
+                patch_many(model, model_patches)
+        return PatchMetadataMutation(uids=[p.uid for p in patches])
+
+
+class UploadTarget(graphene.Enum):
+    INVOICE_ATTACHMENT = "invoice_attachment"
+    CLIENT_ATTACHMENT = "client_attachment"
+    CONTACT_ATTACHMENT = "contact_attachment"
+    CLIENT_IMAGE = "client_image"
+    CONTACT_IMAGE = "contact_image"
+    SKU_IMAGE = "sku_image"
+    VESSEL_IMAGE = "vessel_image"
+
+
+# target -> (model, file field the upload ends up in, storage path prefix)
+UPLOAD_TARGETS = {
+    "invoice_attachment": (InvoiceModel, "attachments", "attachments/invoice"),
+    "client_attachment": (ClientModel, "attachments", "attachments/client"),
+    "contact_attachment": (ContactModel, "attachments", "attachments/contact"),
+    "client_image": (ClientModel, "image", "images/client"),
+    "contact_image": (ContactModel, "image", "images/contact"),
+    "sku_image": (SKUModel, "image", "images/sku"),
+    "vessel_image": (VesselModel, "image", "images/vessel"),
+}
+
+
+def upload_storage(model, field):
+    if field == "attachments":
+        return AttachmentModel._meta.get_field("attached_file").storage
+    return model._meta.get_field(field).storage
+
+
+class RequestUploadMutation(graphene.Mutation):
+    """
+    Issues a short-lived URL the client PUTs the file to directly, and a
+    token to pass to confirmUpload once the PUT has succeeded.
+    """
+
+    class Arguments:
+        target = UploadTarget(required=True)
+        uid = graphene.UUID(required=True)
+        filename = graphene.String(required=True)
+        content_type = graphene.String()
+
+    upload_url = graphene.String()
+    headers = generic.GenericScalar()
+    token = graphene.String()
+
+    @classmethod
+    def mutate(cls, root, info, target, uid, filename, content_type=None):
+        model, field, prefix = UPLOAD_TARGETS[target]
+        if not model.objects.filter(pk=uid).exists():
+            raise Exception(f"Object with UUID {uid} not found")
+        safe_name = get_valid_filename(os.path.basename(filename))
+        if field == "attachments":
+            name = f"{prefix}/{uid}/{datetime.now().isoformat()}/{safe_name}"
+        else:
+            name = f"{prefix}/{uid}/{safe_name}"
+        content_type = (
+            content_type
+            or mimetypes.guess_type(safe_name)[0]
+            or "application/octet-stream"
+        )
+        backend = get_upload_backend(upload_storage(model, field))
+        name = backend.reserve_name(name)
+        upload_url = backend.presigned_put_url(name, content_type)
+        if info.context is not None:
+            upload_url = info.context.build_absolute_uri(upload_url)
+        token = signing.dumps(
+            {"target": target, "uid": str(uid), "name": name, "filename": filename},
+            salt=CONFIRM_UPLOAD_SALT,
+        )
+        return RequestUploadMutation(
+            upload_url=upload_url,
+            headers={"Content-Type": content_type},
+            token=token,
+        )
+
+
+class ConfirmUploadMutation(graphene.Mutation):
+    """
+    Registers a file uploaded through requestUpload as an Attachment or as the
+    target's image. Attachment content that is already stored is deduplicated
+    and the uploaded copy deleted.
+    """
+
+    class Arguments:
+        token = graphene.String(required=True)
+        metadata = generic.GenericScalar()
+
+    attachment = graphene.Field(AttachmentNode)
+    image_url = graphene.String()
+
+    @classmethod
+    def mutate(cls, root, info, token, metadata=None):
+        try:
+            upload = signing.loads(
+                token, salt=CONFIRM_UPLOAD_SALT, max_age=CONFIRM_UPLOAD_MAX_AGE
+            )
+        except signing.BadSignature:
+            raise Exception("Upload token is invalid or has expired")
+        model, field, prefix = UPLOAD_TARGETS[upload["target"]]
+        obj = model.objects.get(pk=upload["uid"])
+        if field == "attachments":
+            attachment = obj.attachments.filter(
+                Q(upload_name=upload["name"]) | Q(attached_file=upload["name"])
+            ).first()
+            if attachment is not None:
+                return ConfirmUploadMutation(attachment=attachment)
+        storage = upload_storage(model, field)
+        # local storage reserves the name with an empty file until the PUT
+        if not storage.exists(upload["name"]) or not storage.size(upload["name"]):
+            raise Exception(f"Upload {upload['name']} not found")
+        if field == "attachments":
+            blob = AttachmentBlobModel.objects.adopt(upload["name"])
+            attachment = obj.attachments.create(
+                name=upload["filename"],
+                metadata=metadata or {},
+                blob=blob,
+                attached_file=blob.file.name,
+                upload_name=upload["name"],
+            )
+            return ConfirmUploadMutation(attachment=attachment)
+        setattr(obj, field, upload["name"])
+        obj.save()
+        schedule_derivation(upload["name"])
+        return ConfirmUploadMutation(image_url=file_url(getattr(obj, field)))
 
 
 class Mutations(graphene.ObjectType):
@@ -519,6 +806,7 @@ class Mutations(graphene.ObjectType):
     modify_job = ModifyJobMutation.Field()
     modify_sku = ModifySKUMutation.Field()
     modify_metadata = ModifyMetadataMutation.Field()
+    patch_metadata = PatchMetadataMutation.Field()
 
     begin_invoice = BeginInvoiceMutation.Field()
     set_invoice_state = SetInvoiceStateMutation.Field()
@@ -526,6 +814,7 @@ class Mutations(graphene.ObjectType):
     get_invoice_pdf_preview = GenerateInvoicePreviewMutation.Field()
 
     add_line_item = AddLineItemMutation.Field()
+    add_line_items = AddLineItemsMutation.Field()
     delete_line_item = DeleteLineItemMutation.Field()
 
     apply_credit = ApplyCreditMutation.Field()
@@ -533,37 +822,103 @@ class Mutations(graphene.ObjectType):
 
     modify_form_template = ModifyFormTemplateMutation.Field()
     render_form = RenderFormTemplateMutation.Field()
+    render_form_batch = RenderFormBatchMutation.Field()
+
+    request_upload = RequestUploadMutation.Field()
+    confirm_upload = ConfirmUploadMutation.Field()
+
+
+class SearchType(graphene.Enum):
+    CONTACT = "contact"
+    CLIENT = "client"
+    VESSEL = "vessel"
+    SKU = "sku"
+
+
+SEARCH_TYPES = {
+    "contact": ContactModel,
+    "client": ClientModel,
+    "vessel": VesselModel,
+    "sku": SKUModel,
+}
+MAX_SEARCH_RESULTS = 100
+
+
+class SearchResult(graphene.ObjectType):
+    score = graphene.Int()
+    node = graphene.Field(relay.Node)
+
+
+def resolve_nodes(uids):
+    """
+    Looks objects of any node type up by uid, in order; None for uids that
+    do not exist or belong to a model with no node.
+    """
+    objects = ObjectUidModel.objects.resolve_uids(uids)
+    registry = get_global_registry()
+    return [
+        o if o is not None and registry.get_type_for_model(type(o)) else None
+        for o in (objects.get(uid) for uid in uids)
+    ]
 
 
 class Query(graphene.ObjectType):
-    invoices = DjangoFilterConnectionField(InvoiceNode)
-    skus = DjangoFilterConnectionField(SKUNode)
-    clients = DjangoFilterConnectionField(ClientNode)
-    contacts = DjangoFilterConnectionField(ContactNode)
-    attachments = DjangoFilterConnectionField(AttachmentNode)
-    form_templates = DjangoFilterConnectionField(FormTemplateNode)
-    rendered_forms = DjangoFilterConnectionField(RenderedFormNode)
+    invoices = KeysetConnectionField(InvoiceNode)
+    line_items = KeysetConnectionField(LineItemNode)
+    skus = OptimizedConnectionField(SKUNode)
+    clients = OptimizedConnectionField(ClientNode)
+    contacts = OptimizedConnectionField(ContactNode)
+    attachments = KeysetConnectionField(AttachmentNode)
+    form_templates = OptimizedConnectionField(FormTemplateNode)
+    rendered_forms = KeysetConnectionField(RenderedFormNode)
 
     invoice = graphene.Field(InvoiceNode, uid=graphene.UUID(required=True))
     sku = graphene.Field(SKUNode, uid=graphene.UUID(required=True))
     client = graphene.Field(ClientNode, uid=graphene.UUID(required=True))
     contact = graphene.Field(ContactNode, uid=graphene.UUID(required=True))
     attachment = graphene.Field(AttachmentNode, uid=graphene.UUID(required=True))
+    rendered_form = graphene.Field(RenderedFormNode, uid=graphene.UUID(required=True))
+    search = graphene.List(
+        SearchResult,
+        query=graphene.String(required=True),
+        types=graphene.List(SearchType),
+        first=graphene.Int(default_value=20),
+    )
+    node = graphene.Field(relay.Node, uid=graphene.UUID(required=True))
+    nodes = graphene.List(relay.Node, uids=graphene.List(graphene.UUID, required=True))
 
     def resolve_invoice(root, info, uid):
-        return InvoiceModel.objects.get(pk=uid)
+        return optimize(InvoiceModel.objects.all(), info).get(pk=uid)
 
     def resolve_sku(root, info, uid):
-        return SKUModel.objects.get(pk=uid)
+        return optimize(SKUModel.objects.all(), info).get(pk=uid)
 
     def resolve_client(root, info, uid):
-        return ClientModel.objects.get(pk=uid)
+        return optimize(ClientModel.objects.all(), info).get(pk=uid)
 
     def resolve_contact(root, info, uid):
-        return ContactModel.objects.get(pk=uid)
+        return optimize(ContactModel.objects.all(), info).get(pk=uid)
 
     def resolve_attachment(root, info, uid):
-        return AttachmentModel.objects.get(pk=uid)
+        return optimize(AttachmentModel.objects.all(), info).get(pk=uid)
+
+    def resolve_rendered_form(root, info, uid):
+        return optimize(RenderedFormModel.objects.all(), info).get(pk=uid)
+
+    def resolve_search(root, info, query, types=None, first=20):
+        if first < 0:
+            raise Exception(f"first must not be negative, got {first}")
+        types = [SEARCH_TYPES[t] for t in types or []]
+        hits = SearchTokenModel.objects.search(
+            query, types=types, first=min(first, MAX_SEARCH_RESULTS)
+        )
+        return [SearchResult(score=score, node=o) for o, score in hits]
+
+    def resolve_node(root, info, uid):
+        return resolve_nodes([uid])[0]
+
+    def resolve_nodes(root, info, uids):
+        return resolve_nodes(uids)
 
 
 schema = graphene.Schema(query=Query, mutation=Mutations)
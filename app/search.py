@@ -0,0 +1,31 @@
+import re
+import unicodedata
+
+MAX_TOKEN_LENGTH = 64
+# shorter query terms only match whole tokens, so a single keystroke does not
+# pull in a large share of the index
+MIN_PREFIX_LENGTH = 3
+MAX_QUERY_TERMS = 8
+
+TOKEN_RE = re.compile(r"\w+")
+
+
+def tokenize(text):
+    """
+    Splits text into lowercase, accent-free word tokens:
+    "Jürgen O'Neil <j.oneil@example.com>" ->
+        ["jurgen", "o", "neil", "j", "oneil", "example", "com"]
+    """
+    if not text:
+        return []
+    text = unicodedata.normalize("NFKD", str(text))
+    text = "".join(c for c in text if not unicodedata.combining(c)).lower()
+    return [token[:MAX_TOKEN_LENGTH] for token in TOKEN_RE.findall(text)]
+
+
+def query_terms(query):
+    terms = []
+    for token in tokenize(query):
+        if token not in terms:
+            terms.append(token)
+    return terms[:MAX_QUERY_TERMS]
@@ -0,0 +1,18 @@
+from celery import shared_task
+
+from app.models import FileDerivative, RenderedForm
+
+
+@shared_task
+def render_form(rendered_form_uid):
+    rendered_form = RenderedForm.objects.select_related("template").get(
+        pk=rendered_form_uid
+    )
+    rendered_form.template.render_pending(rendered_form)
+    return str(rendered_form.uid)
+
+
+@shared_task
+def derive_file(source_name):
+    derivatives = FileDerivative.objects.derive(source_name)
+    return [derivative.kind for derivative in derivatives]
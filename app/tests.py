@@ -1,3 +1,1271 @@
-from django.test import TestCase
+import base64
+import importlib
+import io
+import json
+import shutil
+import tempfile
+import uuid
+import zipfile
+from decimal import Decimal
+from unittest import mock
 
-# Create your tests here.
+import pdfrw
+from django.apps import apps
+from django.conf import settings
+from django.contrib.contenttypes.models import ContentType
+from django.core.cache import cache
+from django.core.files.base import ContentFile
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.db import IntegrityError, connection, transaction
+from django.db.models import F
+from django.db.models.fields.json import KeyTransform
+from django.db.models.signals import post_init
+from django.test import RequestFactory, TestCase, TransactionTestCase
+from django.test.utils import CaptureQueriesContext, override_settings
+from django.utils import timezone
+from graphql.language.parser import parse
+from graphql_relay.connection.arrayconnection import offset_to_cursor
+from PIL import Image
+from reportlab.pdfgen import canvas
+
+from app import instrumentation
+from app import persisted_queries as persisted_queries_module
+from app.exports import EXPORT_CHUNK_SIZE
+from app.factories import ClientFactory
+from app.models import (
+    SKU,
+    Attachment,
+    AttachmentBlob,
+    Client,
+    Credit,
+    FileDerivative,
+    FormTemplate,
+    Invoice,
+    LineItem,
+    ObjectUid,
+    RenderedForm,
+    ItemSKU,
+    SearchToken,
+    UploadSession,
+)
+from app.instrumentation import ResolverTimingMiddleware, Trace
+from app.keyset import (
+    CURSOR_ANNOTATION,
+    decode_cursor,
+    encode_cursor,
+    keyset_fields,
+)
+from app.persisted_queries import document_cache, load_client_manifest, query_hash
+from app.promoted_metadata import PromotedKey
+from app.query_cost import FIELD_COSTS, QueryCost
+from app.rendering import template_cache
+from app.schema import schema
+from app.tasks import derive_file, render_form
+
+
+def execute(document, **variables):
+    return schema.execute(
+        document, context_value=RequestFactory().post("/graphql"), variables=variables
+    )
+
+
+CLIENTS_WITH_COUNTS = """
+query {
+  clients {
+    edges {
+      node {
+        uid
+        invoiceCounts
+        attachments {
+          edges {
+            node {
+              uid
+              attachedTo
+            }
+          }
+        }
+      }
+    }
+  }
+}
+"""
+
+
+class BatchedResolverTests(TestCase):
+    def setUp(self):
+        self.clients = ClientFactory.create_batch(10)
+        for client in self.clients:
+            Invoice.objects.create(client=client, state=Invoice.InvoiceState.OPEN)
+            Invoice.objects.create(client=client, state=Invoice.InvoiceState.VOID)
+            client.attachments.create(name="cert.pdf", attached_file="cert.pdf")
+
+    def execute(self, query, **variables):
+        request = RequestFactory().post("/graphql")
+        result = schema.execute(query, context_value=request, variables=variables)
+        self.assertIsNone(result.errors)
+        return result.data
+
+    def test_client_page_query_count(self):
+        # page + grouped invoice counts + attachments + attached_to targets
+        with self.assertNumQueries(5):
+            data = self.execute(CLIENTS_WITH_COUNTS)
+        edges = data["clients"]["edges"]
+        self.assertEqual(len(edges), 10)
+        for edge in edges:
+            node = edge["node"]
+            self.assertEqual(node["invoiceCounts"]["open"], 1)
+            self.assertEqual(node["invoiceCounts"]["void"], 1)
+            self.assertEqual(node["invoiceCounts"]["drafts"], 0)
+            attachments = node["attachments"]["edges"]
+            self.assertEqual(len(attachments), 1)
+            self.assertEqual(attachments[0]["node"]["attachedTo"], "Client")
+
+    def test_filtered_attachments_bypass_loader(self):
+        client = self.clients[0]
+        client.attachments.create(name="logbook.txt", attached_file="logbook.txt")
+        query = """
+        query($uid: UUID!) {
+          client(uid: $uid) {
+            attachments(extension: "txt") { edges { node { name } } }
+          }
+        }
+        """
+        data = self.execute(query, uid=str(client.uid))
+        edges = data["client"]["attachments"]["edges"]
+        self.assertEqual([e["node"]["name"] for e in edges], ["logbook.txt"])
+
+
+ADD_LINE_ITEMS = """
+mutation($invoice: UUID!, $lineItems: [LineItemInput!]!) {
+  addLineItems(invoiceUid: $invoice, lineItems: $lineItems) {
+    invoice { initialBalance }
+    lineItems { subtotal }
+  }
+}
+"""
+
+
+class InvoiceBalanceTests(TestCase):
+    def setUp(self):
+        self.invoice = Invoice.objects.create()
+
+    def add_line_item(self, price, quantity=1):
+        return LineItem.objects.create(
+            invoice=self.invoice, price=price, quantity=quantity, subtotal=0
+        )
+
+    def assertBalances(self, initial, paid):
+        self.invoice.refresh_balances()
+        self.assertEqual(self.invoice.initial_balance, Decimal(initial))
+        self.assertEqual(self.invoice.paid_balance, Decimal(paid))
+        self.assertFalse(Invoice.objects.out_of_balance().exists())
+
+    def test_update_applies_difference(self):
+        line_item = self.add_line_item("10.00", 2)
+        line_item.quantity = 3
+        line_item.save()
+        credit = Credit.objects.create(invoice=self.invoice, amount="5.00")
+        credit.amount = "7.50"
+        credit.save()
+        self.assertBalances("30.00", "7.50")
+
+    def test_stale_instance_delete_removes_stored_value(self):
+        line_item = self.add_line_item("10.00")
+        stale = LineItem.objects.get(pk=line_item.pk)
+        line_item.price = "25.00"
+        line_item.save()
+        stale.delete()
+        credit = Credit.objects.create(invoice=self.invoice, amount="5.00")
+        stale_credit = Credit.objects.get(pk=credit.pk)
+        credit.amount = "8.00"
+        credit.save()
+        stale_credit.delete()
+        self.assertBalances("0.00", "0.00")
+
+    def test_queryset_delete_adjusts_balance(self):
+        for price in ("10.00", "20.00", "30.00"):
+            self.add_line_item(price)
+        Credit.objects.create(invoice=self.invoice, amount="5.00")
+        self.invoice.line_items.filter(price__gt=15).delete()
+        self.invoice.credits.all().delete()
+        self.assertBalances("10.00", "0.00")
+
+    def test_queryset_delete_updates_each_invoice_once(self):
+        for price in ("10.00", "20.00", "30.00"):
+            self.add_line_item(price)
+        with CaptureQueriesContext(connection) as queries:
+            LineItem.objects.filter(invoice=self.invoice).delete()
+        updates = [q for q in queries if q["sql"].startswith('UPDATE "app_invoice"')]
+        self.assertEqual(len(updates), 1)
+        self.assertBalances("0.00", "0.00")
+
+    def test_invoice_delete_skips_balance_updates(self):
+        for price in ("10.00", "20.00"):
+            self.add_line_item(price)
+        Credit.objects.create(invoice=self.invoice, amount="5.00")
+        with CaptureQueriesContext(connection) as queries:
+            self.invoice.delete()
+        self.assertFalse(
+            [q for q in queries if q["sql"].startswith('UPDATE "app_invoice"')]
+        )
+        self.assertFalse(LineItem.objects.exists())
+
+    def test_add_line_items_inserts_batch_at_once(self):
+        first = SKU.objects.create(default_price="12.50", default_quantity=2)
+        second = SKU.objects.create(default_price="3.00")
+        with CaptureQueriesContext(connection) as queries:
+            result = execute(
+                ADD_LINE_ITEMS,
+                invoice=str(self.invoice.pk),
+                lineItems=[
+                    {"skuUid": str(first.pk)},
+                    {"skuUid": str(second.pk), "quantity": 4},
+                    {"skuUid": str(second.pk), "price": 1.25},
+                ],
+            )
+        self.assertIsNone(result.errors)
+        inserts = [
+            q for q in queries if q["sql"].startswith('INSERT INTO "app_lineitem"')
+        ]
+        self.assertEqual(len(inserts), 1)
+        subtotals = [li["subtotal"] for li in result.data["addLineItems"]["lineItems"]]
+        self.assertEqual(subtotals, ["25.00", "12.00", "1.25"])
+        self.assertEqual(
+            result.data["addLineItems"]["invoice"]["initialBalance"], "38.25"
+        )
+        self.assertBalances("38.25", "0.00")
+
+    def test_add_line_items_rejects_unknown_sku(self):
+        result = execute(
+            ADD_LINE_ITEMS,
+            invoice=str(self.invoice.pk),
+            lineItems=[{"skuUid": str(uuid.uuid4())}],
+        )
+        self.assertIn("not found", result.errors[0].message)
+        self.assertFalse(LineItem.objects.exists())
+
+
+class NestedConnectionPrefetchTests(TestCase):
+    def setUp(self):
+        for client in ClientFactory.create_batch(3):
+            for _ in range(10):
+                Invoice.objects.create(client=client, state=Invoice.InvoiceState.OPEN)
+
+    def test_prefetch_loads_only_the_page_per_parent(self):
+        query = """
+        query($after: String) {
+          clients {
+            edges {
+              node {
+                uid
+                invoices(first: 2, after: $after) {
+                  edges { node { uid } }
+                  pageInfo { hasNextPage }
+                }
+              }
+            }
+          }
+        }
+        """
+        loaded = []
+        receiver = lambda instance, **kwargs: loaded.append(instance.pk)
+        post_init.connect(receiver, sender=Invoice)
+        self.addCleanup(post_init.disconnect, receiver, sender=Invoice)
+        result = execute(query, after=offset_to_cursor(3))
+        self.assertIsNone(result.errors)
+        # rows 0-3 precede the cursor, 4-5 are the page and 6 tells there is more
+        self.assertEqual(len(loaded), 3 * 7)
+        for edge in result.data["clients"]["edges"]:
+            client_uid = edge["node"]["uid"]
+            invoices = edge["node"]["invoices"]
+            expected = Invoice.objects.filter(client_id=client_uid).order_by("pk")
+            self.assertEqual(
+                [e["node"]["uid"] for e in invoices["edges"]],
+                [str(invoice.pk) for invoice in expected[4:6]],
+            )
+            self.assertTrue(invoices["pageInfo"]["hasNextPage"])
+
+
+INVOICE_PAGE = """
+query($first: Int, $after: String, $offset: Int) {
+  invoices(first: $first, after: $after, offset: $offset) {
+    edges { node { uid } }
+    pageInfo { endCursor hasNextPage }
+  }
+}
+"""
+
+
+class KeysetPaginationTests(TestCase):
+    def setUp(self):
+        client = ClientFactory()
+        self.invoices = [Invoice.objects.create(client=client) for _ in range(7)]
+        # four rows tie on created_at, so only the uid tells them apart
+        tied = timezone.now()
+        Invoice.objects.filter(pk__in=[i.pk for i in self.invoices[2:6]]).update(
+            created_at=tied
+        )
+        self.ordered = [
+            str(uid)
+            for uid in Invoice.objects.order_by("created_at", "pk").values_list(
+                "pk", flat=True
+            )
+        ]
+
+    def page(self, **variables):
+        result = execute(INVOICE_PAGE, **variables)
+        self.assertIsNone(result.errors)
+        return result.data["invoices"]
+
+    def test_cursors_walk_every_row_once_across_ties(self):
+        seen, after = [], None
+        while True:
+            page = self.page(first=2, after=after)
+            seen.extend(edge["node"]["uid"] for edge in page["edges"])
+            if not page["pageInfo"]["hasNextPage"]:
+                break
+            after = page["pageInfo"]["endCursor"]
+        self.assertEqual(seen, self.ordered)
+
+    def test_cursor_round_trips(self):
+        fields = keyset_fields(Invoice)
+        invoice = Invoice.objects.annotate(**{CURSOR_ANNOTATION: F("created_at")})[0]
+        cursor = encode_cursor(invoice, fields)
+        self.assertEqual(
+            decode_cursor(cursor, fields), [invoice.created_at, invoice.pk]
+        )
+
+    def test_malformed_cursors_are_rejected(self):
+        valid = self.page(first=1)["pageInfo"]["endCursor"]
+        wrong_arity = base64.urlsafe_b64encode(b'["x"]').decode()
+        for cursor in ["garbage", valid[:-4], wrong_arity]:
+            result = execute(INVOICE_PAGE, first=1, after=cursor)
+            self.assertEqual(result.errors[0].message, f"Invalid cursor {cursor}")
+
+    def test_deprecated_offset_still_skips_rows(self):
+        page = self.page(first=2, offset=3)
+        self.assertEqual(
+            [edge["node"]["uid"] for edge in page["edges"]], self.ordered[3:5]
+        )
+
+
+MODIFY_METADATA = """
+mutation(
+  $uid: UUID!
+  $metadata: GenericScalar
+  $mode: String
+  $operations: GenericScalar
+) {
+  modifyMetadata(
+    uid: $uid
+    metadata: $metadata
+    mode: $mode
+    operations: $operations
+  ) {
+    metadata
+    parentType
+  }
+}
+"""
+
+
+SET_INVOICE_METADATA = """
+mutation($uid: UUID!, $metadata: GenericScalar!, $merge: Boolean) {
+  setInvoiceMetadata(uid: $uid, metadata: $metadata, merge: $merge) {
+    invoice { metadata }
+  }
+}
+"""
+
+
+class MetadataMutationTests(TestCase):
+    def setUp(self):
+        self.client_obj = ClientFactory(metadata={"about": "tugs", "tags": ["a"]})
+        self.updated_at = self.client_obj.updated_at
+
+    def execute(self, query, **variables):
+        result = schema.execute(
+            query, context_value=RequestFactory().post("/graphql"), variables=variables
+        )
+        self.assertIsNone(result.errors)
+        return result.data
+
+    def modify(self, **variables):
+        data = self.execute(MODIFY_METADATA, uid=str(self.client_obj.pk), **variables)
+        return data["modifyMetadata"]
+
+    def assertStored(self, metadata):
+        self.client_obj.refresh_from_db()
+        self.assertEqual(self.client_obj.metadata, metadata)
+        self.assertGreater(self.client_obj.updated_at, self.updated_at)
+
+    def test_update_mode(self):
+        data = self.modify(metadata={"about": "barges", "port": "Kiel"})
+        expected = {"about": "barges", "tags": ["a"], "port": "Kiel"}
+        self.assertEqual(data["metadata"], expected)
+        self.assertStored(expected)
+
+    def test_merge_mode(self):
+        self.modify(metadata={"about": None, "hull": {"color": "red"}}, mode="merge")
+        self.assertStored({"tags": ["a"], "hull": {"color": "red"}})
+
+    def test_patch_mode(self):
+        operations = [
+            {"op": "append", "path": "tags", "value": "b"},
+            {"op": "remove", "path": "about"},
+            {"op": "set", "path": "port", "value": "Kiel"},
+        ]
+        self.modify(mode="patch", operations=operations)
+        self.assertStored({"tags": ["a", "b"], "port": "Kiel"})
+
+    def test_replace_mode(self):
+        self.modify(metadata={"port": "Kiel"}, mode="replace")
+        self.assertStored({"port": "Kiel"})
+
+    def test_set_invoice_metadata(self):
+        invoice = Invoice.objects.create(metadata={"po": "1", "vendor": "ACME"})
+        updated_at = invoice.updated_at
+        for metadata, merge, expected in (
+            ({"po": "2"}, True, {"po": "2", "vendor": "ACME"}),
+            ({"po": "3"}, False, {"po": "3"}),
+        ):
+            data = self.execute(
+                SET_INVOICE_METADATA,
+                uid=str(invoice.pk),
+                metadata=metadata,
+                merge=merge,
+            )
+            self.assertEqual(
+                data["setInvoiceMetadata"]["invoice"]["metadata"], expected
+            )
+            invoice.refresh_from_db()
+            self.assertGreater(invoice.updated_at, updated_at)
+            updated_at = invoice.updated_at
+
+    def test_object_missing_from_registry(self):
+        # rows written before the registry existed have no ObjectUid
+        ObjectUid.objects.filter(uid=self.client_obj.pk).delete()
+        data = self.modify(metadata={"port": "Kiel"})
+        self.assertEqual(data["parentType"], "Client")
+        self.assertEqual(data["metadata"]["port"], "Kiel")
+        self.assertTrue(ObjectUid.objects.filter(uid=self.client_obj.pk).exists())
+
+
+SEARCH = """
+query($query: String!, $first: Int) {
+  search(query: $query, first: $first) {
+    score
+    node { ... on SKUNode { name } }
+  }
+}
+"""
+
+
+class SearchTests(TestCase):
+    def setUp(self):
+        self.sku = SKU.objects.create(name="Anchor shackle")
+
+    def search(self, query, first=20):
+        result = execute(SEARCH, query=query, first=first)
+        self.assertIsNone(result.errors)
+        return [hit["node"]["name"] for hit in result.data["search"]]
+
+    def test_prefix_and_whole_token_matches(self):
+        self.assertEqual(self.search("anch sha"), ["Anchor shackle"])
+        self.assertEqual(self.search("anchor"), ["Anchor shackle"])
+        self.assertEqual(self.search("anchor chain"), [])
+
+    def test_short_terms_match_whole_tokens_only(self):
+        self.assertEqual(self.search("an"), [])
+
+    def test_modify_sku_reindexes(self):
+        result = execute(
+            """
+            mutation($uid: UUID!) {
+              modifySku(uid: $uid, data: {name: "Anchor chain"}) { sku { name } }
+            }
+            """,
+            uid=str(self.sku.pk),
+        )
+        self.assertIsNone(result.errors)
+        self.assertEqual(self.search("chain"), ["Anchor chain"])
+        self.assertEqual(self.search("shackle"), [])
+        self.assertFalse(SearchToken.objects.filter(token="shackle").exists())
+
+    def test_negative_first_is_an_error(self):
+        result = execute(SEARCH, query="anchor", first=-1)
+        self.assertEqual(len(result.errors), 1)
+        self.assertIn("first", str(result.errors[0]))
+
+
+class ObjectUidRegistryTests(TestCase):
+    def test_proxies_register_their_concrete_model(self):
+        sku = ItemSKU.objects.create(name="Bollard")
+        entry = ObjectUid.objects.get(uid=sku.pk)
+        self.assertEqual(entry.content_type.model_class(), SKU)
+
+    def test_internal_models_are_not_registered(self):
+        client = ClientFactory()
+        session = UploadSession.objects.create(
+            content_type=ContentType.objects.get_for_model(client),
+            object_id=client.pk,
+            name="logbook.txt",
+            storage_name="uploads/logbook.txt",
+            size=1,
+        )
+        self.assertFalse(ObjectUid.objects.filter(uid=session.pk).exists())
+
+    def test_backfill_migration(self):
+        migration = importlib.import_module("app.migrations.0020_backfill_object_uid")
+        skus = [SKU.objects.create(name="Fender"), ItemSKU.objects.create()]
+        client = ClientFactory()
+        ObjectUid.objects.all().delete()
+        migration.backfill(apps, None)
+        sku_type = ContentType.objects.get_for_model(SKU)
+        for sku in skus:
+            self.assertEqual(ObjectUid.objects.get(uid=sku.pk).content_type, sku_type)
+        self.assertTrue(ObjectUid.objects.filter(uid=client.pk).exists())
+        self.assertEqual(ObjectUid.objects.count(), 3)
+
+
+REQUEST_UPLOAD = """
+mutation($uid: UUID!, $filename: String!, $target: UploadTarget = CLIENT_ATTACHMENT) {
+  requestUpload(target: $target, uid: $uid, filename: $filename) {
+    uploadUrl
+    token
+  }
+}
+"""
+
+CONFIRM_UPLOAD = """
+mutation($token: String!) {
+  confirmUpload(token: $token) {
+    attachment { uid }
+    imageUrl
+  }
+}
+"""
+
+
+class StorageTestMixin:
+    """
+    Points file storage at a temporary MEDIA_ROOT for each test.
+    """
+
+    def setUp(self):
+        super().setUp()
+        media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, media_root)
+        media = override_settings(MEDIA_ROOT=media_root)
+        media.enable()
+        self.addCleanup(media.disable)
+        self.storage = Attachment._meta.get_field("attached_file").storage
+
+    def graphql(self, document, **variables):
+        response = self.client.post(
+            "/graphql",
+            json.dumps({"query": document, "variables": variables}),
+            content_type="application/json",
+        )
+        return json.loads(response.content)
+
+
+class ChunkedUploadTests(StorageTestMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        self.client_obj = ClientFactory()
+
+    def start(self, size):
+        response = self.client.post(
+            f"/upload/client-attachment/{self.client_obj.pk}/chunked",
+            {"filename": "logbook.txt", "size": size, "vessel": "Argo"},
+        )
+        self.assertEqual(response.status_code, 201)
+        return f"/upload/chunked/{response.json()['uid']}"
+
+    def send(self, url, offset, chunk):
+        return self.client.generic(
+            "PATCH",
+            url,
+            chunk,
+            content_type="application/offset+octet-stream",
+            HTTP_UPLOAD_OFFSET=str(offset),
+        )
+
+    def test_chunks_resume_and_complete(self):
+        content = b"0123456789" * 3
+        url = self.start(len(content))
+        self.assertEqual(self.send(url, 0, content[:10]).status_code, 204)
+        # the client lost track of where it was, asks, and resumes from there
+        offset = int(self.client.head(url)["Upload-Offset"])
+        self.assertEqual(offset, 10)
+        self.send(url, offset, content[10:20])
+        self.send(url, 20, content[20:])
+        response = self.client.post(url)
+        self.assertEqual(response.status_code, 201)
+        attachment = Attachment.objects.get(pk=response.json()["attachment"])
+        self.assertEqual(attachment.name, "logbook.txt")
+        self.assertEqual(attachment.metadata, {"vessel": "Argo"})
+        self.assertEqual(attachment.content_object, self.client_obj)
+        with self.storage.open(attachment.attached_file.name) as f:
+            self.assertEqual(f.read(), content)
+        # completing again returns the same attachment
+        self.assertEqual(self.client.post(url).json(), response.json())
+
+    def test_out_of_order_chunk_is_rejected(self):
+        url = self.start(20)
+        response = self.send(url, 10, b"x" * 10)
+        self.assertEqual(response.status_code, 409)
+        self.assertEqual(response["Upload-Offset"], "0")
+        self.send(url, 0, b"y" * 10)
+        # a repeated chunk is out of order too
+        self.assertEqual(self.send(url, 0, b"y" * 10).status_code, 409)
+        self.assertEqual(self.client.head(url)["Upload-Offset"], "10")
+
+    def test_completing_with_missing_chunks_is_rejected(self):
+        url = self.start(20)
+        self.send(url, 0, b"z" * 10)
+        response = self.client.post(url)
+        self.assertEqual(response.status_code, 409)
+        self.assertEqual(response["Upload-Offset"], "10")
+        self.assertFalse(Attachment.objects.exists())
+        self.assertEqual(self.send(url, 10, b"z" * 11).status_code, 413)
+
+
+class MultiAttachmentTests(StorageTestMixin, TransactionTestCase):
+    def setUp(self):
+        super().setUp()
+        self.client_obj = ClientFactory()
+        self.url = f"/upload/attachments/client/{self.client_obj.pk}"
+
+    def post(self, *files, **fields):
+        uploads = [SimpleUploadedFile(name, content) for name, content in files]
+        with mock.patch.object(derive_file, "delay"):
+            return self.client.post(self.url, {"attachment_files": uploads, **fields})
+
+    def stored_files(self):
+        if not self.storage.exists("blobs"):
+            return []
+        prefixes, _ = self.storage.listdir("blobs")
+        return [
+            name
+            for prefix in prefixes
+            for name in self.storage.listdir(f"blobs/{prefix}")[1]
+        ]
+
+    def test_files_are_attached_and_deduplicated(self):
+        response = self.post(
+            ("a.pdf", b"%PDF same"),
+            ("b.pdf", b"%PDF same"),
+            ("c.txt", b"other"),
+            vessel="Argo",
+        )
+        self.assertEqual(response.status_code, 200)
+        attachments = Attachment.objects.filter(pk__in=response.json()["attachments"])
+        self.assertEqual(
+            sorted(a.name for a in attachments), ["a.pdf", "b.pdf", "c.txt"]
+        )
+        self.assertTrue(all(a.metadata == {"vessel": "Argo"} for a in attachments))
+        self.assertEqual(
+            sorted(AttachmentBlob.objects.values_list("ref_count", flat=True)), [1, 2]
+        )
+        self.assertEqual(len(self.stored_files()), 2)
+
+    def test_conflicting_names_attach_nothing(self):
+        self.client_obj.attachments.create(name="a.pdf", attached_file="a.pdf")
+        response = self.post(("a.pdf", b"new"), ("b.pdf", b"1"), ("b.pdf", b"2"))
+        self.assertEqual(response.status_code, 420)
+        self.assertEqual(response.json(), {"conflicts": ["a.pdf", "b.pdf"]})
+        self.assertFalse(AttachmentBlob.objects.exists())
+
+    def test_failed_insert_rolls_back_blobs_and_files(self):
+        with mock.patch.object(
+            Attachment.objects, "bulk_create", side_effect=IntegrityError("boom")
+        ):
+            with self.assertRaises(IntegrityError):
+                self.post(("a.pdf", b"%PDF one"), ("b.pdf", b"%PDF two"))
+        self.assertFalse(AttachmentBlob.objects.exists())
+        self.assertEqual(self.stored_files(), [])
+
+
+def blank_pdf(pages=1, fields=()):
+    data = io.BytesIO()
+    pdf = canvas.Canvas(data)
+    for i, name in enumerate(fields):
+        pdf.acroForm.textfield(name=name, x=50, y=700 - 40 * i, width=200, height=20)
+    for _ in range(pages):
+        pdf.showPage()
+    pdf.save()
+    return data.getvalue()
+
+
+class FormTemplateMixin(StorageTestMixin):
+    def setUp(self):
+        super().setUp()
+        template_cache.clear()
+        self.addCleanup(template_cache.clear)
+
+    def make_template(self, fields=(), **kwargs):
+        template = FormTemplate(name="survey", **kwargs)
+        template.template_file.save("survey.pdf", ContentFile(blank_pdf(1, fields)))
+        if fields:
+            template.write_parsed_annotations()
+        return template
+
+    def field_values(self, rendered_form):
+        with rendered_form.rendered_file.open() as f:
+            pdf = pdfrw.PdfReader(fdata=f.read())
+        return {
+            FormTemplate.make_annotation_key_valid_json_key(
+                annotation.T
+            ): annotation.V.to_unicode()
+            for annotation in pdf.pages[0].Annots or []
+            if annotation.V.to_unicode()
+        }
+
+
+class DirectUploadTests(StorageTestMixin, TransactionTestCase):
+    def setUp(self):
+        super().setUp()
+        self.client_obj = ClientFactory()
+
+    def upload(self, content, filename="cert.pdf", target="CLIENT_ATTACHMENT"):
+        data = self.graphql(
+            REQUEST_UPLOAD,
+            uid=str(self.client_obj.pk),
+            filename=filename,
+            target=target,
+        )
+        upload = data["data"]["requestUpload"]
+        response = self.client.put(
+            upload["uploadUrl"], content, content_type="application/pdf"
+        )
+        self.assertEqual(response.status_code, 200)
+        return upload
+
+    def confirm(self, token):
+        data = self.graphql(CONFIRM_UPLOAD, token=token)
+        self.assertNotIn("errors", data)
+        return data["data"]["confirmUpload"]["attachment"]["uid"]
+
+    def test_confirming_twice_after_dedup(self):
+        self.confirm(self.upload(b"%PDF same bytes")["token"])
+        token = self.upload(b"%PDF same bytes")["token"]
+        first = self.confirm(token)
+        self.assertEqual(self.confirm(token), first)
+        self.assertEqual(Attachment.objects.count(), 2)
+        self.assertEqual(AttachmentBlob.objects.get().ref_count, 2)
+
+    def test_adopted_upload_moves_to_blob_name(self):
+        upload = self.upload(b"%PDF original")
+        attachment = Attachment.objects.get(pk=self.confirm(upload["token"]))
+        blob = attachment.blob
+        self.assertTrue(blob.file.name.startswith(f"blobs/{blob.sha256[:2]}/"))
+        self.assertEqual(attachment.attached_file.name, blob.file.name)
+        self.assertFalse(self.storage.exists(attachment.upload_name))
+        # the upload URL is still valid, but no longer writes to the blob
+        self.client.put(upload["uploadUrl"], b"tampered", content_type="x/y")
+        with self.storage.open(blob.file.name) as f:
+            self.assertEqual(f.read(), b"%PDF original")
+
+    def test_image_upload_sets_the_image(self):
+        upload = self.upload(
+            b"\x89PNG logo", filename="logo.png", target="CLIENT_IMAGE"
+        )
+        with mock.patch.object(derive_file, "delay") as delay:
+            data = self.graphql(CONFIRM_UPLOAD, token=upload["token"])
+        self.client_obj.refresh_from_db()
+        self.assertEqual(
+            self.client_obj.image.name, f"images/client/{self.client_obj.pk}/logo.png"
+        )
+        self.assertEqual(
+            data["data"]["confirmUpload"]["imageUrl"], self.client_obj.image.url
+        )
+        delay.assert_called_once_with(self.client_obj.image.name)
+
+    def test_tampered_upload_url_is_refused(self):
+        data = self.graphql(
+            REQUEST_UPLOAD, uid=str(self.client_obj.pk), filename="cert.pdf"
+        )
+        url = data["data"]["requestUpload"]["uploadUrl"]
+        response = self.client.put(url[:-2], b"%PDF", content_type="application/pdf")
+        self.assertEqual(response.status_code, 403)
+
+    def test_confirming_needs_the_uploaded_file_and_a_valid_token(self):
+        data = self.graphql(
+            REQUEST_UPLOAD, uid=str(self.client_obj.pk), filename="cert.pdf"
+        )
+        token = data["data"]["requestUpload"]["token"]
+        data = self.graphql(CONFIRM_UPLOAD, token=token)
+        self.assertTrue(data["errors"][0]["message"].startswith("Upload attachments/"))
+        data = self.graphql(CONFIRM_UPLOAD, token=token[:-2])
+        self.assertEqual(
+            data["errors"][0]["message"], "Upload token is invalid or has expired"
+        )
+        self.assertFalse(Attachment.objects.exists())
+
+
+class PersistedQueryTests(TestCase):
+    def post(self, body):
+        response = self.client.post(
+            "/graphql", json.dumps(body), content_type="application/json"
+        )
+        return json.loads(response.content)
+
+    def test_client_manifest_keys_by_the_body_the_client_sends(self):
+        body = (
+            "query Clients { clients(first: 1) { edges { node { uid __typename } } } }"
+        )
+        manifest, invalid = load_client_manifest(
+            {
+                "operations": [
+                    {"id": query_hash(body), "body": body},
+                    {"id": "0" * 64, "body": "query Other { clients { totalCount } }"},
+                    {"id": query_hash("{ nope }"), "body": "{ nope }"},
+                ]
+            },
+            schema,
+        )
+        self.assertEqual(manifest, {query_hash(body): body})
+        self.assertEqual(len(invalid), 2)
+
+    def test_registered_query_is_served_by_hash(self):
+        query = "query Count { clients(first: 1) { edges { node { uid } } } }"
+        extensions = {"persistedQuery": {"version": 1, "sha256Hash": query_hash(query)}}
+        data = self.post({"extensions": extensions})
+        self.assertEqual(data["errors"][0]["message"], "PersistedQueryNotFound")
+        self.assertNotIn(
+            "errors", self.post({"query": query, "extensions": extensions})
+        )
+        self.assertNotIn("errors", self.post({"extensions": extensions}))
+
+    def test_invalid_query_is_validated_once(self):
+        document_cache.clear()
+        validate = mock.Mock(wraps=persisted_queries_module.validate)
+        with mock.patch.object(persisted_queries_module, "validate", validate):
+            data = self.post({"query": "{ clients { nope } }"})
+        self.assertIn("nope", data["errors"][0]["message"])
+        self.assertEqual(validate.call_count, 1)
+
+
+class InstrumentationTests(TestCase):
+    def post(self, document):
+        return self.client.post(
+            "/graphql", json.dumps({"query": document}), content_type="application/json"
+        )
+
+    def test_server_timing_header_follows_setting(self):
+        with override_settings(GRAPHQL_SERVER_TIMING=False):
+            self.assertNotIn(
+                "Server-Timing",
+                self.post("{ clients(first: 1) { edges { node { uid } } } }"),
+            )
+        with override_settings(GRAPHQL_SERVER_TIMING=True):
+            response = self.post("{ clients(first: 1) { edges { node { uid } } } }")
+        self.assertTrue(response["Server-Timing"].startswith("total;dur="))
+
+    def test_timed_resolvers_leave_querysets_lazy(self):
+        trace = Trace()
+        token = instrumentation._current_trace.set(trace)
+        self.addCleanup(instrumentation._current_trace.reset, token)
+        info = mock.Mock(path=["clients"], field_name="clients")
+        info.parent_type.name = "Query"
+        with self.assertNumQueries(0):
+            result = ResolverTimingMiddleware().resolve(
+                lambda root, info: Client.objects.all(), None, info
+            )
+        self.assertIsNone(result._result_cache)
+        self.assertEqual(trace.resolvers["clients"].calls, 1)
+
+
+RENDER_FORM = """
+mutation($uid: UUID!, $fields: GenericScalar!) {
+  renderForm(uid: $uid, fields: $fields, asyncRender: true) {
+    renderedForm { uid }
+  }
+}
+"""
+
+
+class AsyncRenderTests(FormTemplateMixin, TransactionTestCase):
+    def test_async_render_is_dispatched_on_commit(self):
+        template = self.make_template()
+        statuses = []
+
+        def delay(uid):
+            # runs after the mutation's transaction committed
+            statuses.append(RenderedForm.objects.get(pk=uid).status)
+            return render_form.apply(args=(uid,))
+
+        with mock.patch.object(render_form, "delay", side_effect=delay):
+            with transaction.atomic():
+                data = self.graphql(
+                    RENDER_FORM, uid=str(template.pk), fields={"name": "Ada"}
+                )
+                self.assertEqual(statuses, [])
+        uid = data["data"]["renderForm"]["renderedForm"]["uid"]
+        self.assertEqual(statuses, [RenderedForm.RenderStatus.PENDING])
+        rendered = RenderedForm.objects.get(pk=uid)
+        self.assertEqual(rendered.status, RenderedForm.RenderStatus.DONE)
+        self.assertEqual(rendered.content_hash, template.content_hash({"name": "Ada"}))
+        self.assertTrue(self.storage.exists(rendered.rendered_file.name))
+
+
+CLIENTS_PAGE = "{ clients(first: 10) { edges { node { uid } } } }"
+
+
+class QueryCostTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.addCleanup(cache.clear)
+
+    def post(self, document, **variables):
+        return self.client.post(
+            "/graphql",
+            json.dumps({"query": document, "variables": variables}),
+            content_type="application/json",
+        )
+
+    def cost(self, document, **variables):
+        return QueryCost(schema, parse(document), variables).cost
+
+    def test_nodes_cost_scales_with_uids(self):
+        document = "query($uids: [UUID]!) { nodes(uids: $uids) { id } }"
+        one = self.cost(document, uids=[str(uuid.uuid4())])
+        self.assertEqual(one, FIELD_COSTS["Query.nodes"])
+        uids = [str(uuid.uuid4()) for _ in range(40)]
+        self.assertEqual(self.cost(document, uids=uids), 40 * one)
+        literal = "{ nodes(uids: [%s]) { id } }" % ", ".join(f'"{u}"' for u in uids)
+        self.assertEqual(self.cost(literal), 40 * one)
+
+    @override_settings(GRAPHQL_MAX_COST=50, GRAPHQL_MAX_DEPTH=3)
+    def test_costly_and_deep_queries_are_rejected(self):
+        response = self.post("{ clients(first: 60) { edges { node { uid } } } }")
+        message = json.loads(response.content)["errors"][0]["message"]
+        self.assertTrue(message.startswith("Query cost 61 exceeds the limit of 50"))
+        response = self.post(
+            "{ clients(first: 1) { edges { node { invoices(first: 1) { edges "
+            "{ node { lineItems(first: 1) { edges { node { uid } } } } } } } } } }"
+        )
+        message = json.loads(response.content)["errors"][0]["message"]
+        self.assertEqual(message, "Query depth 4 exceeds the limit of 3")
+        self.assertNotIn("errors", json.loads(self.post(CLIENTS_PAGE).content))
+
+    @override_settings(GRAPHQL_COST_PER_MINUTE=25)
+    def test_client_over_budget_is_throttled(self):
+        # costs 11 a time: the third request in a minute goes over 25
+        for _ in range(2):
+            self.assertEqual(self.post(CLIENTS_PAGE).status_code, 200)
+        response = self.post(CLIENTS_PAGE)
+        self.assertEqual(response.status_code, 429)
+        self.assertIn("budget of 25 per minute", response.content.decode())
+
+
+class TemplateCacheTests(FormTemplateMixin, TestCase):
+    def test_template_is_read_once_per_version(self):
+        template = self.make_template()
+        with mock.patch.object(
+            self.storage, "open", wraps=self.storage.open
+        ) as storage_open:
+            template.render_with_data({"name": "Ada"}, use_cache=False)
+            template.render_with_data({"name": "Grace"}, use_cache=False)
+            self.assertEqual(storage_open.call_count, 1)
+            # replacing the file bumps updated_at, which retires the entry
+            template.template_file.save("survey-v2.pdf", ContentFile(blank_pdf(2)))
+            form = template.build_form({})
+        self.assertEqual(storage_open.call_count, 2)
+        self.assertEqual(len(pdfrw.PdfReader(form).pages), 2)
+
+
+# parse_annotations keys fields by their raw PDF string, "(name)"
+NAME, PORT = "_name_", "_port_"
+
+
+class RenderManyTests(FormTemplateMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        self.template = self.make_template(fields=["name", "port"])
+
+    def test_rows_are_filled_and_repeats_share_a_form(self):
+        rows = [{NAME: "Ada"}, {NAME: "Grace", PORT: "Oslo"}, {NAME: "Ada"}]
+        forms = self.template.render_many(rows)
+        self.assertEqual(forms[0], forms[2])
+        self.assertEqual(RenderedForm.objects.count(), 2)
+        self.assertEqual(self.field_values(forms[0]), {NAME: "Ada"})
+        self.assertEqual(self.field_values(forms[1]), {NAME: "Grace", PORT: "Oslo"})
+        again = self.template.render_many([{NAME: "Grace", PORT: "Oslo"}])
+        self.assertEqual(again, [forms[1]])
+        self.assertEqual(RenderedForm.objects.count(), 2)
+        # the cached tree every row is copied from stays unfilled
+        self.assertEqual(self.field_values(self.template.render_with_data({})), {})
+
+    def test_rows_must_be_objects(self):
+        with self.assertRaisesMessage(ValueError, "Row 1 is not an object"):
+            self.template.render_many([{NAME: "Ada"}, None])
+        self.assertFalse(RenderedForm.objects.exists())
+
+    def test_failed_batch_deletes_uploaded_forms(self):
+        saved = []
+        original_save = self.storage.save
+
+        def save(name, content):
+            if len(saved) == 2:
+                raise OSError("storage unavailable")
+            saved.append(original_save(name, content))
+            return saved[-1]
+
+        rows = [{NAME: name} for name in ("Ada", "Grace", "Hedy")]
+        with mock.patch.object(self.storage, "save", side_effect=save):
+            with self.settings(FORM_RENDER_UPLOAD_WORKERS=1):
+                with self.assertRaises(OSError):
+                    self.template.render_many(rows)
+        self.assertEqual(len(saved), 2)
+        self.assertFalse(any(self.storage.exists(name) for name in saved))
+        self.assertFalse(RenderedForm.objects.exists())
+
+
+RENDER_FORM_WITH_METADATA = """
+mutation($uid: UUID!, $fields: GenericScalar!, $metadata: GenericScalar) {
+  renderForm(uid: $uid, fields: $fields, metadata: $metadata) {
+    renderedForm { uid }
+  }
+}
+"""
+
+
+class RenderedFormReuseTests(FormTemplateMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        self.template = self.make_template(fields=["name"])
+
+    def test_same_data_and_version_reuse_the_form(self):
+        first = self.template.render_with_data({NAME: "Ada"})
+        self.assertEqual(self.template.render_with_data({NAME: "Ada"}), first)
+        self.assertNotEqual(self.template.render_with_data({NAME: "Grace"}), first)
+        bypassed = self.template.render_with_data({NAME: "Ada"}, use_cache=False)
+        self.assertNotEqual(bypassed, first)
+        self.assertEqual(bypassed.content_hash, first.content_hash)
+
+    def test_new_template_version_renders_again(self):
+        first = self.template.render_with_data({NAME: "Ada"})
+        self.template.name = "survey v2"
+        self.template.save()
+        second = self.template.render_with_data({NAME: "Ada"})
+        self.assertNotEqual(second.content_hash, first.content_hash)
+        self.assertNotEqual(second.rendered_file.name, first.rendered_file.name)
+
+    def test_pending_render_is_not_reused(self):
+        content_hash = self.template.content_hash({NAME: "Ada"})
+        RenderedForm.objects.create(
+            template=self.template,
+            rendering_data={NAME: "Ada"},
+            content_hash=content_hash,
+            status=RenderedForm.RenderStatus.PENDING,
+        )
+        rendered = self.template.render_with_data({NAME: "Ada"})
+        self.assertEqual(rendered.status, RenderedForm.RenderStatus.DONE)
+        self.assertEqual(self.field_values(rendered), {NAME: "Ada"})
+
+    def test_metadata_on_reused_form_gets_its_own_row(self):
+        first = self.template.render_with_data({NAME: "Ada"})
+        first.metadata = {"job": 1}
+        first.save()
+        result = execute(
+            RENDER_FORM_WITH_METADATA,
+            uid=str(self.template.pk),
+            fields={NAME: "Ada"},
+            metadata={"job": 2},
+        )
+        self.assertIsNone(result.errors)
+        rendered = RenderedForm.objects.get(
+            pk=result.data["renderForm"]["renderedForm"]["uid"]
+        )
+        self.assertNotEqual(rendered, first)
+        self.assertEqual(rendered.rendered_file.name, first.rendered_file.name)
+        self.assertEqual(rendered.metadata, {"job": 2})
+
+
+ATTACHMENT_URLS = """
+query {
+  clients {
+    edges { node { attachments { edges { node { url } } } } }
+  }
+}
+"""
+
+
+class FileUrlTests(StorageTestMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        cache.clear()
+        self.addCleanup(cache.clear)
+        for client in ClientFactory.create_batch(3):
+            for name in ("cert.pdf", "log.txt"):
+                client.attachments.create(
+                    name=name, attached_file=f"attachments/{client.pk}/{name}"
+                )
+
+    def urls(self):
+        result = execute(ATTACHMENT_URLS)
+        self.assertIsNone(result.errors)
+        return sorted(
+            attachment["node"]["url"]
+            for client in result.data["clients"]["edges"]
+            for attachment in client["node"]["attachments"]["edges"]
+        )
+
+    def test_page_of_urls_is_resolved_in_one_batch_and_cached(self):
+        with mock.patch.object(
+            self.storage, "url", wraps=self.storage.url
+        ) as url, mock.patch.object(
+            cache, "get_many", wraps=cache.get_many
+        ) as get_many:
+            first = self.urls()
+            self.assertEqual(url.call_count, 6)
+            self.assertEqual(get_many.call_count, 1)
+            self.assertEqual(self.urls(), first)
+            self.assertEqual(url.call_count, 6)
+        self.assertEqual(
+            first,
+            sorted(a.attached_file.url for a in Attachment.objects.all()),
+        )
+
+
+def png(color):
+    out = io.BytesIO()
+    Image.new("RGB", (600, 400), color).save(out, "PNG")
+    return out.getvalue()
+
+
+class ImageDerivativeTests(StorageTestMixin, TransactionTestCase):
+    def setUp(self):
+        super().setUp()
+        self.client_obj = ClientFactory()
+        self.url = f"/upload/client-image/{self.client_obj.pk}"
+
+    def upload(self, name, color):
+        with mock.patch.object(derive_file, "delay") as delay:
+            response = self.client.post(
+                self.url, {"image": SimpleUploadedFile(name, png(color))}
+            )
+        self.assertEqual(response.status_code, 200)
+        self.client_obj.refresh_from_db()
+        (source_name,), _ = delay.call_args
+        self.assertEqual(source_name, self.client_obj.image.name)
+        return FileDerivative.objects.derive(source_name)
+
+    def assertReleased(self, derivatives):
+        pks = [derivative.pk for derivative in derivatives]
+        self.assertFalse(FileDerivative.objects.filter(pk__in=pks).exists())
+        for derivative in derivatives:
+            self.assertFalse(self.storage.exists(derivative.file.name))
+
+    def test_replacing_the_image_deletes_its_derivatives(self):
+        first = self.upload("logo.png", "red")
+        self.assertEqual(len(first), len(settings.THUMBNAIL_SIZES))
+        second = self.upload("logo-2.png", "blue")
+        self.assertReleased(first)
+        for derivative in second:
+            self.assertTrue(self.storage.exists(derivative.file.name))
+
+    def test_clearing_or_deleting_the_image_deletes_its_derivatives(self):
+        derivatives = self.upload("logo.png", "red")
+        self.assertEqual(self.client.delete(self.url).status_code, 200)
+        self.assertReleased(derivatives)
+
+        derivatives = self.upload("logo.png", "green")
+        self.client_obj.delete()
+        self.assertReleased(derivatives)
+
+    def test_saving_other_fields_keeps_the_derivatives(self):
+        derivatives = self.upload("logo.png", "red")
+        self.client_obj.name = "Renamed"
+        self.client_obj.save()
+        self.assertEqual(
+            FileDerivative.objects.filter(
+                pk__in=[derivative.pk for derivative in derivatives]
+            ).count(),
+            len(derivatives),
+        )
+
+
+class AttachmentExportTests(StorageTestMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        self.client_obj = ClientFactory()
+        self.contents = {
+            "attachments/report.pdf": b"%PDF" + b"x" * (3 * EXPORT_CHUNK_SIZE),
+            "attachments/report (2).pdf": b"second report",
+            "attachments/notes.txt": b"notes",
+        }
+        for name, content in (
+            ("report.pdf", self.contents["attachments/report.pdf"]),
+            ("../report.pdf", self.contents["attachments/report (2).pdf"]),
+            ("notes.txt", self.contents["attachments/notes.txt"]),
+        ):
+            stored = self.storage.save(
+                f"attachments/{self.client_obj.pk}/file", ContentFile(content)
+            )
+            self.client_obj.attachments.create(name=name, attached_file=stored)
+
+    def export(self, **params):
+        response = self.client.get(f"/export/client/{self.client_obj.pk}.zip", params)
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.streaming)
+        pieces = list(response.streaming_content)
+        return pieces, zipfile.ZipFile(io.BytesIO(b"".join(pieces)))
+
+    def test_zip_holds_every_attachment_under_a_unique_name(self):
+        for prefetch in (0, 2):
+            pieces, archive = self.export(prefetch=prefetch)
+            self.assertIsNone(archive.testzip())
+            self.assertEqual(
+                archive.namelist(),
+                [
+                    "attachments/report.pdf",
+                    "attachments/report (2).pdf",
+                    "attachments/notes.txt",
+                ],
+            )
+            for arcname, content in self.contents.items():
+                self.assertEqual(archive.read(arcname), content)
+            # the large file is streamed chunk by chunk, not built in memory
+            self.assertGreater(len(pieces), 3)
+            self.assertLessEqual(max(map(len, pieces)), EXPORT_CHUNK_SIZE + 1024)
+
+    def test_unknown_object_is_not_found(self):
+        response = self.client.get(f"/export/client/{uuid.uuid4()}.zip")
+        self.assertEqual(response.status_code, 404)
+        response = self.client.get(f"/export/nothing/{self.client_obj.pk}.zip")
+        self.assertEqual(response.status_code, 404)
+
+
+class PromotedKeyTests(TestCase):
+    def setUp(self):
+        self.red = SKU.objects.create(
+            name="Red fender", metadata={"tag": {"color": "red", "sizes": [1, 2]}}
+        )
+        self.blue = SKU.objects.create(
+            name="Blue fender", metadata={"tag": {"color": "blue"}}
+        )
+        self.item = ItemSKU.objects.create(name="Bollard")
+
+    def test_promoted_key_is_compared_as_text(self):
+        self.assertEqual(list(SKU.objects.filter(metadata__type="item")), [self.item])
+        lookup = SKU.objects.filter(metadata__type="item").query.where.children[0]
+        self.assertIsInstance(lookup.lhs, PromotedKey)
+
+    def test_nested_paths_are_read_from_the_document(self):
+        queryset = SKU.objects.filter(metadata__tag__color="red")
+        self.assertEqual(list(queryset), [self.red])
+        # not the promoted column, which only holds the key's text
+        lookup = queryset.query.where.children[0]
+        self.assertIsInstance(lookup.lhs, KeyTransform)
+        self.assertIsInstance(lookup.lhs.lhs, KeyTransform)
+        self.assertEqual(
+            list(SKU.objects.filter(metadata__tag__sizes__1=2)), [self.red]
+        )
+        self.assertEqual(
+            set(SKU.objects.filter(metadata__tag__color__isnull=False)),
+            {self.red, self.blue},
+        )
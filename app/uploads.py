@@ -0,0 +1,191 @@
+import hashlib
+
+from django.conf import settings
+from django.core import signing
+from django.core.files.base import ContentFile
+from django.core.files.uploadhandler import (
+    MemoryFileUploadHandler,
+    TemporaryFileUploadHandler,
+)
+from django.urls import reverse
+
+# S3 rejects multipart parts smaller than this, except for the last one.
+S3_MIN_PART_SIZE = 5 * 1024 * 1024
+STREAM_BLOCK_SIZE = 64 * 1024
+SIGNED_UPLOAD_SALT = "app.uploads.signed-upload"
+CONFIRM_UPLOAD_SALT = "app.uploads.confirm-upload"
+# how long after requesting an upload URL the upload can still be confirmed
+CONFIRM_UPLOAD_MAX_AGE = 24 * 60 * 60
+
+
+class IncompleteChunkException(Exception):
+    pass
+
+
+def read_exactly(stream, length, block_size=STREAM_BLOCK_SIZE):
+    """
+    Yields blocks of at most block_size until length bytes have been read from
+    stream, raising IncompleteChunkException if it ends early.
+    """
+    remaining = length
+    while remaining:
+        block = stream.read(min(block_size, remaining))
+        if not block:
+            raise IncompleteChunkException
+        remaining -= len(block)
+        yield block
+
+
+def iter_storage_chunks(storage, name, chunk_size=STREAM_BLOCK_SIZE):
+    """
+    Streams a stored file without holding it in memory; S3 files opened
+    through the storage are downloaded whole first.
+    """
+    if hasattr(storage, "bucket"):
+        key = storage._normalize_name(storage._clean_name(name))
+        body = storage.bucket.Object(key).get()["Body"]
+        yield from body.iter_chunks(chunk_size)
+        return
+    with storage.open(name, "rb") as f:
+        yield from f.chunks(chunk_size)
+
+
+class HashingUploadHandlerMixin:
+    """
+    Computes the SHA-256 of an uploaded file as its chunks arrive and
+    exposes it as `sha256` on the resulting UploadedFile.
+    """
+
+    def new_file(self, *args, **kwargs):
+        self.digest = hashlib.sha256()
+        return super().new_file(*args, **kwargs)
+
+    def receive_data_chunk(self, raw_data, start):
+        self.digest.update(raw_data)
+        return super().receive_data_chunk(raw_data, start)
+
+    def file_complete(self, file_size):
+        file_obj = super().file_complete(file_size)
+        if file_obj is not None:
+            file_obj.sha256 = self.digest.hexdigest()
+        return file_obj
+
+
+class HashingMemoryFileUploadHandler(
+    HashingUploadHandlerMixin, MemoryFileUploadHandler
+):
+    pass
+
+
+class HashingTemporaryFileUploadHandler(
+    HashingUploadHandlerMixin, TemporaryFileUploadHandler
+):
+    pass
+
+
+class FileSystemUploadBackend:
+    """
+    Appends chunks to the final file in place, so memory use is one block no
+    matter how large the chunk or the file is.
+    """
+
+    min_part_size = 0
+
+    def __init__(self, storage):
+        self.storage = storage
+
+    def reserve_name(self, name):
+        return self.storage.save(name, ContentFile(b""))
+
+    def presigned_put_url(self, name, content_type):
+        # there is nothing to presign against, so hand out a signed token for
+        # SignedUploadView, which streams the body into the reserved file
+        token = signing.dumps(name, salt=SIGNED_UPLOAD_SALT)
+        return reverse("signed-upload", args=[token])
+
+    def write(self, name, stream, length):
+        with open(self.storage.path(name), "wb") as f:
+            for block in read_exactly(stream, length):
+                f.write(block)
+
+    def start(self, session):
+        session.storage_name = self.reserve_name(session.storage_name)
+
+    def write_chunk(self, session, stream, length):
+        with open(self.storage.path(session.storage_name), "r+b") as f:
+            # drop whatever a failed earlier attempt wrote past the offset
+            f.seek(session.offset)
+            f.truncate()
+            for block in read_exactly(stream, length):
+                f.write(block)
+
+    def complete(self, session):
+        pass
+
+    def abort(self, session):
+        self.storage.delete(session.storage_name)
+
+
+class S3MultipartUploadBackend:
+    """
+    Uploads each chunk as one part of an S3 multipart upload, holding at most
+    one chunk in memory.
+    """
+
+    min_part_size = S3_MIN_PART_SIZE
+
+    def __init__(self, storage):
+        self.storage = storage
+
+    def _object(self, name):
+        key = self.storage._normalize_name(self.storage._clean_name(name))
+        return self.storage.bucket.Object(key)
+
+    def _multipart_upload(self, session):
+        return self._object(session.storage_name).MultipartUpload(session.upload_id)
+
+    def reserve_name(self, name):
+        return self.storage.get_available_name(name)
+
+    def presigned_put_url(self, name, content_type):
+        obj = self._object(name)
+        return obj.meta.client.generate_presigned_url(
+            "put_object",
+            Params={
+                "Bucket": obj.bucket_name,
+                "Key": obj.key,
+                "ContentType": content_type,
+            },
+            ExpiresIn=settings.UPLOAD_URL_EXPIRY,
+            HttpMethod="PUT",
+        )
+
+    def start(self, session):
+        session.storage_name = self.reserve_name(session.storage_name)
+        obj = self._object(session.storage_name)
+        upload = obj.initiate_multipart_upload(
+            **self.storage._get_write_parameters(obj.key)
+        )
+        session.upload_id = upload.id
+        session.parts = []
+
+    def write_chunk(self, session, stream, length):
+        body = b"".join(read_exactly(stream, length))
+        # a retried chunk re-uploads the same part number, replacing the part
+        part_number = len(session.parts) + 1
+        response = self._multipart_upload(session).Part(part_number).upload(Body=body)
+        session.parts.append({"PartNumber": part_number, "ETag": response["ETag"]})
+
+    def complete(self, session):
+        self._multipart_upload(session).complete(
+            MultipartUpload={"Parts": session.parts}
+        )
+
+    def abort(self, session):
+        self._multipart_upload(session).abort()
+
+
+def get_upload_backend(storage):
+    if hasattr(storage, "bucket"):
+        return S3MultipartUploadBackend(storage)
+    return FileSystemUploadBackend(storage)
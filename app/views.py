@@ -1,21 +1,55 @@
+import json
+import logging
+import os
+from collections import Counter
 from datetime import datetime
 from uuid import uuid4
 
-from django.core.files.storage import default_storage
+from django.apps import apps
+from django.conf import settings
+from django.contrib.contenttypes.fields import GenericRelation
+from django.contrib.contenttypes.models import ContentType
+from django.core import signing
+from django.db import transaction
+from django.http import HttpResponseBadRequest, JsonResponse, StreamingHttpResponse
 from django.shortcuts import Http404, HttpResponse, render
+from django.utils import timezone
+from django.utils.text import get_valid_filename
 from django.utils.decorators import method_decorator
 from django.views.decorators.csrf import csrf_exempt
 from django.views.generic import View
+from graphene_django.views import GraphQLView, HttpError
+from graphql.execution import ExecutionResult
 
 from app.models import (
     Attachment,
+    AttachmentBlob,
     Invoice,
     Client,
     Contact,
     SKU,
     FormTemplate,
+    ObjectUid,
     RenderedForm,
+    UploadSession,
+    schedule_derivation,
 )
+from app.exports import export_entries, stream_zip
+from app.instrumentation import (
+    current_trace,
+    metrics_allowed,
+    render_metrics,
+    tracing_enabled,
+)
+from app.persisted_queries import PreparedBackend, persisted_queries, query_hash
+from app.query_cost import QueryCostError, QueryThrottled, check_query_cost
+from app.uploads import (
+    SIGNED_UPLOAD_SALT,
+    IncompleteChunkException,
+    get_upload_backend,
+)
+
+logger = logging.getLogger(__name__)
 
 
 class FilenameConflictException(Exception):
@@ -26,7 +60,7 @@ class FilenameConflictException(Exception):
 class AttachmentView(View):
     def delete(self, request, attachment_uid, **kwargs):
         try:
-            a = Attchment.objects.get(uid=attachment_uid)
+            a = Attachment.objects.get(uid=attachment_uid)
         except Attachment.DoesNotExist:
             raise Http404
         a.delete()
@@ -37,8 +71,8 @@ class AttachmentView(View):
 @method_decorator(csrf_exempt, name="dispatch")
 class InvoiceAttachmentView(View):
     @classmethod
-    def check_for_conflicts(cls, name):
-        if not default_storage.exists(name):
+    def check_for_conflicts(cls, obj, name):
+        if not obj.attachments.filter(name=name).exists():
             return
         raise FilenameConflictException
 
@@ -49,20 +83,20 @@ class InvoiceAttachmentView(View):
             raise Http404
         file_obj = request.FILES.get("attachment_file")
         name = request.POST.get("filename", file_obj.name)
-        file_obj.name = (
-            f"attachments/invoice/{invoice_uid}/{datetime.now().isoformat()}/{file_obj.name}",
-        )
         metadata = {}
         for k, v in request.POST.items():
             if k != "filename":
                 metadata[k] = v
 
         try:
-            self.check_for_conflicts(name)
+            self.check_for_conflicts(invoice, name)
         except FilenameConflictException:
             return HttpResponse(status=420)
 
-        invoice.attachments.create(name=name, metadata=metadata, attached_file=file_obj)
+        blob = AttachmentBlob.objects.store(file_obj, name)
+        invoice.attachments.create(
+            name=name, metadata=metadata, blob=blob, attached_file=blob.file.name
+        )
 
         return HttpResponse(status=200)
 
@@ -70,8 +104,8 @@ class InvoiceAttachmentView(View):
 @method_decorator(csrf_exempt, name="dispatch")
 class ClientAttachmentView(View):
     @classmethod
-    def check_for_conflicts(cls, name):
-        if not default_storage.exists(name):
+    def check_for_conflicts(cls, obj, name):
+        if not obj.attachments.filter(name=name).exists():
             return
         raise FilenameConflictException
 
@@ -82,20 +116,20 @@ class ClientAttachmentView(View):
             raise Http404
         file_obj = request.FILES.get("attachment_file")
         name = request.POST.get("filename", file_obj.name)
-        file_obj.name = (
-            f"attachments/client/{client_uid}/{datetime.now().isoformat()}/{file_obj.name}",
-        )
         metadata = {}
         for k, v in request.POST.items():
             if k != "filename":
                 metadata[k] = v
 
         try:
-            self.check_for_conflicts(name)
+            self.check_for_conflicts(client, name)
         except FilenameConflictException:
             return HttpResponse(status=420)
 
-        client.attachments.create(name=name, metadata=metadata, attached_file=file_obj)
+        blob = AttachmentBlob.objects.store(file_obj, name)
+        client.attachments.create(
+            name=name, metadata=metadata, blob=blob, attached_file=blob.file.name
+        )
 
         return HttpResponse(status=200)
 
@@ -103,8 +137,8 @@ class ClientAttachmentView(View):
 @method_decorator(csrf_exempt, name="dispatch")
 class ContactAttachmentView(View):
     @classmethod
-    def check_for_conflicts(cls, name):
-        if not default_storage.exists(name):
+    def check_for_conflicts(cls, obj, name):
+        if not obj.attachments.filter(name=name).exists():
             return
         raise FilenameConflictException
 
@@ -115,24 +149,296 @@ class ContactAttachmentView(View):
             raise Http404
         file_obj = request.FILES.get("attachment_file")
         name = request.POST.get("filename", file_obj.name)
-        file_obj.name = (
-            f"attachments/contact/{contact_uid}/{datetime.now().isoformat()}/{file_obj.name}",
-        )
         metadata = {}
         for k, v in request.POST.items():
             if k != "filename":
                 metadata[k] = v
 
         try:
-            self.check_for_conflicts(name)
+            self.check_for_conflicts(contact, name)
         except FilenameConflictException:
             return HttpResponse(status=420)
 
-        contact.attachments.create(name=name, metadata=metadata, attached_file=file_obj)
+        blob = AttachmentBlob.objects.store(file_obj, name)
+        contact.attachments.create(
+            name=name, metadata=metadata, blob=blob, attached_file=blob.file.name
+        )
 
         return HttpResponse(status=200)
 
 
+def attachable_models():
+    return {
+        model._meta.model_name: model
+        for model in apps.get_app_config("app").get_models()
+        if any(
+            isinstance(field, GenericRelation) and field.related_model is Attachment
+            for field in model._meta.get_fields()
+        )
+    }
+
+
+@method_decorator(csrf_exempt, name="dispatch")
+class MultiAttachmentView(View):
+    """
+    Attaches every file posted as `attachment_files` to one object of any
+    model with attachments; the other fields become each one's metadata.
+    Nothing is attached if any filename is already taken on the object.
+    """
+
+    def post(self, request, model_name, object_uid, **kwargs):
+        model = attachable_models().get(model_name)
+        if model is None:
+            raise Http404
+        try:
+            obj = model.objects.get(pk=object_uid)
+        except model.DoesNotExist:
+            raise Http404
+        files = request.FILES.getlist("attachment_files")
+        if not files:
+            return HttpResponse(status=400)
+        metadata = dict(request.POST.items())
+        names = [file_obj.name for file_obj in files]
+
+        conflicts = {name for name, count in Counter(names).items() if count > 1}
+        conflicts.update(
+            obj.attachments.filter(name__in=names).values_list("name", flat=True)
+        )
+        if conflicts:
+            return JsonResponse({"conflicts": sorted(conflicts)}, status=420)
+
+        content_type = ContentType.objects.get_for_model(model)
+        saved = []
+        try:
+            with transaction.atomic():
+                blobs = AttachmentBlob.objects.store_many(
+                    list(zip(files, names)), saved=saved
+                )
+                attachments = Attachment.objects.bulk_create(
+                    Attachment(
+                        content_type=content_type,
+                        object_id=obj.pk,
+                        name=name,
+                        metadata=metadata,
+                        blob=blob,
+                        attached_file=blob.file.name,
+                    )
+                    for name, blob in zip(names, blobs)
+                )
+                AttachmentBlob.objects.add_references(
+                    Counter(blob.pk for blob in blobs)
+                )
+                ObjectUid.objects.register(attachments)
+        except BaseException:
+            # the blobs pointing at these files were rolled back
+            storage = AttachmentBlob._meta.get_field("file").storage
+            for name in saved:
+                storage.delete(name)
+            raise
+        return JsonResponse(
+            {"attachments": [str(attachment.uid) for attachment in attachments]}
+        )
+
+
+class AttachmentExportView(View):
+    """
+    Streams a ZIP of every attachment on one object, plus its rendered forms
+    with ?rendered_forms=1. ?prefetch=N reads the next N files concurrently.
+    """
+
+    def get(self, request, model_name, object_uid, **kwargs):
+        model = attachable_models().get(model_name)
+        if model is None:
+            raise Http404
+        try:
+            obj = model.objects.get(pk=object_uid)
+        except model.DoesNotExist:
+            raise Http404
+        try:
+            prefetch = int(request.GET.get("prefetch", settings.EXPORT_PREFETCH))
+        except ValueError:
+            return HttpResponse(status=400)
+        prefetch = max(0, min(prefetch, settings.EXPORT_PREFETCH_MAX))
+        entries = export_entries(
+            obj, include_rendered_forms=request.GET.get("rendered_forms") == "1"
+        )
+        response = StreamingHttpResponse(
+            stream_zip(entries, prefetch=prefetch), content_type="application/zip"
+        )
+        response["Content-Disposition"] = (
+            f'attachment; filename="{model_name}-{object_uid}.zip"'
+        )
+        return response
+
+
+def upload_offset_response(session, status=204):
+    response = HttpResponse(status=status)
+    response["Upload-Offset"] = session.offset
+    response["Upload-Length"] = session.size
+    return response
+
+
+@method_decorator(csrf_exempt, name="dispatch")
+class ChunkedAttachmentView(View):
+    """
+    Starts a resumable upload of an attachment to an instance of `model`.
+    Takes `filename`, the total size as an Upload-Length header (or `size`
+    field) and any other fields as metadata, and returns the session uid to
+    send chunks to through UploadSessionView.
+    """
+
+    model = None
+    kind = None
+
+    def post(self, request, object_uid, **kwargs):
+        try:
+            obj = self.model.objects.get(pk=object_uid)
+        except self.model.DoesNotExist:
+            raise Http404
+        name = request.POST.get("filename")
+        try:
+            size = int(request.headers.get("Upload-Length", request.POST.get("size")))
+        except (TypeError, ValueError):
+            return HttpResponse(status=400)
+        if not name or size <= 0:
+            return HttpResponse(status=400)
+        metadata = {}
+        for k, v in request.POST.items():
+            if k not in ("filename", "size"):
+                metadata[k] = v
+        filename = get_valid_filename(os.path.basename(name))
+        session = UploadSession(
+            content_object=obj,
+            name=name,
+            size=size,
+            metadata=metadata,
+            storage_name=f"attachments/{self.kind}/{object_uid}/{datetime.now().isoformat()}/{filename}",
+        )
+        storage = Attachment._meta.get_field("attached_file").storage
+        get_upload_backend(storage).start(session)
+        session.save()
+        return JsonResponse(
+            {
+                "uid": str(session.uid),
+                "offset": session.offset,
+                "chunk_size": settings.ATTACHMENT_UPLOAD_CHUNK_SIZE,
+            },
+            status=201,
+        )
+
+
+@method_decorator(csrf_exempt, name="dispatch")
+class UploadSessionView(View):
+    """
+    HEAD reports how much of an upload has been received, PATCH appends the
+    request body at the Upload-Offset header, POST completes the upload into
+    an Attachment and DELETE abandons it.
+    """
+
+    def get_session(self, session_uid):
+        try:
+            return UploadSession.objects.select_for_update().get(pk=session_uid)
+        except UploadSession.DoesNotExist:
+            raise Http404
+
+    def head(self, request, session_uid, **kwargs):
+        try:
+            session = UploadSession.objects.get(pk=session_uid)
+        except UploadSession.DoesNotExist:
+            raise Http404
+        return upload_offset_response(session, status=200)
+
+    def patch(self, request, session_uid, **kwargs):
+        try:
+            offset = int(request.headers["Upload-Offset"])
+            length = int(request.META.get("CONTENT_LENGTH") or 0)
+        except (KeyError, ValueError):
+            return HttpResponse(status=400)
+        if length <= 0:
+            return HttpResponse(status=400)
+        if length > settings.ATTACHMENT_UPLOAD_CHUNK_SIZE:
+            return HttpResponse(status=413)
+        backend = get_upload_backend(
+            Attachment._meta.get_field("attached_file").storage
+        )
+        with transaction.atomic():
+            session = self.get_session(session_uid)
+            if session.completed_at or offset != session.offset:
+                return upload_offset_response(session, status=409)
+            end = offset + length
+            if end > session.size:
+                return upload_offset_response(session, status=413)
+            if end < session.size and length < backend.min_part_size:
+                return upload_offset_response(session, status=400)
+            try:
+                backend.write_chunk(session, request, length)
+            except IncompleteChunkException:
+                return upload_offset_response(session, status=400)
+            session.offset = end
+            session.save(update_fields=["offset", "parts", "updated_at"])
+        return upload_offset_response(session)
+
+    def post(self, request, session_uid, **kwargs):
+        backend = get_upload_backend(
+            Attachment._meta.get_field("attached_file").storage
+        )
+        with transaction.atomic():
+            session = self.get_session(session_uid)
+            if session.completed_at:
+                return JsonResponse({"attachment": str(session.attachment_id)})
+            if session.offset != session.size:
+                return upload_offset_response(session, status=409)
+            backend.complete(session)
+            blob = AttachmentBlob.objects.adopt(session.storage_name)
+            session.attachment = Attachment.objects.create(
+                content_type_id=session.content_type_id,
+                object_id=session.object_id,
+                name=session.name,
+                metadata=session.metadata,
+                blob=blob,
+                attached_file=blob.file.name,
+                upload_name=session.storage_name,
+            )
+            session.completed_at = timezone.now()
+            session.save()
+        return JsonResponse({"attachment": str(session.attachment.uid)}, status=201)
+
+    def delete(self, request, session_uid, **kwargs):
+        backend = get_upload_backend(
+            Attachment._meta.get_field("attached_file").storage
+        )
+        with transaction.atomic():
+            session = self.get_session(session_uid)
+            if session.completed_at:
+                return upload_offset_response(session, status=409)
+            backend.abort(session)
+            session.delete()
+        return HttpResponse(status=204)
+
+
+@method_decorator(csrf_exempt, name="dispatch")
+class SignedUploadView(View):
+    """
+    Stand-in for a presigned S3 PUT when files are stored on the local
+    filesystem: writes the request body to the name sealed in the token.
+    """
+
+    def put(self, request, token, **kwargs):
+        try:
+            name = signing.loads(
+                token, salt=SIGNED_UPLOAD_SALT, max_age=settings.UPLOAD_URL_EXPIRY
+            )
+            length = int(request.META.get("CONTENT_LENGTH") or 0)
+        except (signing.BadSignature, ValueError):
+            return HttpResponse(status=403)
+        storage = Attachment._meta.get_field("attached_file").storage
+        try:
+            get_upload_backend(storage).write(name, request, length)
+        except IncompleteChunkException:
+            return HttpResponse(status=400)
+        return HttpResponse(status=200)
+
+
 @method_decorator(csrf_exempt, name="dispatch")
 class ContactImageView(View):
     def delete(self, request, contact_uid, **kwargs):
@@ -160,6 +466,7 @@ class ContactImageView(View):
         )
         contact.image = file_obj
         contact.save()
+        schedule_derivation(contact.image.name)
 
         return HttpResponse(status=200)
 
@@ -187,6 +494,7 @@ class ClientImageView(View):
 
         client.image = file_obj
         client.save()
+        schedule_derivation(client.image.name)
 
         return HttpResponse(status=200)
 
@@ -214,6 +522,7 @@ class SKUImageView(View):
 
         sku.image = file_obj
         sku.save()
+        schedule_derivation(sku.image.name)
 
         return HttpResponse(status=200)
 
@@ -236,5 +545,93 @@ class FormTemplateView(View):
         try:
             template.write_parsed_annotations()
         except Exception:
-            print("Failed to parse annotations...")  # !!!
+            logger.exception(
+                "Failed to parse the annotations of form template %s", template.uid
+            )
         return HttpResponse(template.template_file.url, status=200)
+
+
+class PersistedQueryGraphQLView(GraphQLView):
+    """
+    GraphQLView that accepts automatic persisted queries: a client may send
+    extensions.persistedQuery.sha256Hash instead of the query, and is told
+    PersistedQueryNotFound when it has to send both once to register it.
+    Operations are checked against the query cost limits before they run,
+    and responses carry extensions.tracing when GRAPHQL_TRACING is on.
+    """
+
+    @staticmethod
+    def get_graphql_params(request, data):
+        query, variables, operation_name, id = GraphQLView.get_graphql_params(
+            request, data
+        )
+        extensions = request.GET.get("extensions") or data.get("extensions")
+        if isinstance(extensions, str):
+            try:
+                extensions = json.loads(extensions)
+            except ValueError:
+                raise HttpError(HttpResponseBadRequest("Extensions are invalid JSON."))
+        persisted = (extensions or {}).get("persistedQuery")
+        if not persisted:
+            return query, variables, operation_name, id
+        sha256 = persisted.get("sha256Hash")
+        if query:
+            if query_hash(query) != sha256:
+                raise HttpError(
+                    HttpResponseBadRequest("provided sha does not match query")
+                )
+            persisted_queries.register(sha256, query)
+        else:
+            query = persisted_queries.get(sha256)
+            if query is None:
+                raise HttpError(HttpResponse(), "PersistedQueryNotFound")
+        return query, variables, operation_name, id
+
+    def execute_graphql_request(
+        self, request, data, query, variables, operation_name, show_graphiql=False
+    ):
+        if not query:
+            return super().execute_graphql_request(
+                request, data, query, variables, operation_name, show_graphiql
+            )
+        backend = self.get_backend(request)
+        try:
+            document = backend.document_from_string(self.schema, query)
+        except Exception as e:
+            return ExecutionResult(errors=[e], invalid=True)
+        try:
+            check_query_cost(
+                self.schema, document.document_ast, variables, operation_name, request
+            )
+        except QueryCostError as e:
+            return ExecutionResult(errors=[e], invalid=True)
+        except QueryThrottled as e:
+            raise HttpError(HttpResponse(status=429), str(e))
+        # run the document built above rather than parsing the query again
+        self.backend = PreparedBackend(backend, document)
+        try:
+            return super().execute_graphql_request(
+                request, data, query, variables, operation_name, show_graphiql
+            )
+        finally:
+            self.backend = backend
+
+    def json_encode(self, request, d, pretty=False):
+        trace = current_trace()
+        if trace is not None and tracing_enabled():
+            d.setdefault("extensions", {})["tracing"] = trace.as_extension()
+        return super().json_encode(request, d, pretty)
+
+
+class MetricsView(View):
+    """
+    Request and resolver histograms of this process in the Prometheus text
+    format, for scrapers on the same host.
+    """
+
+    def get(self, request):
+        if not metrics_allowed(request):
+            raise Http404()
+        return HttpResponse(
+            render_metrics(), content_type="text/plain; version=0.0.4; charset=utf-8"
+        )
@@ -0,0 +1,16 @@
+import os
+
+from celery import Celery
+
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "crusher.settings")
+
+app = Celery("crusher")
+app.config_from_object("django.conf:settings", namespace="CELERY")
+app.autodiscover_tasks()
+
+
+@app.on_after_configure.connect
+def create_filesystem_broker_folders(sender, **kwargs):
+    if sender.conf.broker_url.startswith("filesystem://"):
+        for folder in sender.conf.broker_transport_options.values():
+            os.makedirs(folder, exist_ok=True)
@@ -47,6 +47,7 @@ INSTALLED_APPS = [
 GRAPHENE = {"SCHEMA": "app.schema.schema"}
 
 MIDDLEWARE = [
+    "app.instrumentation.TimingMiddleware",
     "django.middleware.security.SecurityMiddleware",
     "django.contrib.sessions.middleware.SessionMiddleware",
     "django.middleware.common.CommonMiddleware",
@@ -143,3 +144,73 @@ AWS_ACCESS_KEY_ID = os.getenv("AWS_ACCESS_KEY", "")
 AWS_SECRET_ACCESS_KEY = os.getenv("AWS_SECRET_KEY", "")
 AWS_S3_ENDPOINT_URL = os.getenv("AWS_S3_ENDPOINT_URL", "")
 AWS_STORAGE_BUCKET_NAME = os.getenv("AWS_STORAGE_BUCKET_NAME", "crusher-local-testing")
+# Lifetime of signed GET URLs, and how long before expiry a cached one is
+# retired. Presigned upload URLs are only valid for UPLOAD_URL_EXPIRY.
+SIGNED_URL_EXPIRY = AWS_QUERYSTRING_EXPIRE = int(os.getenv("SIGNED_URL_EXPIRY", 3600))
+SIGNED_URL_EXPIRY_MARGIN = int(os.getenv("SIGNED_URL_EXPIRY_MARGIN", 300))
+UPLOAD_URL_EXPIRY = int(os.getenv("UPLOAD_URL_EXPIRY", 900))
+
+# Number of parsed form templates kept in memory per process for rendering.
+FORM_TEMPLATE_CACHE_SIZE = int(os.getenv("FORM_TEMPLATE_CACHE_SIZE", 64))
+# Concurrent storage uploads used by FormTemplate.render_many.
+FORM_RENDER_UPLOAD_WORKERS = int(os.getenv("FORM_RENDER_UPLOAD_WORKERS", 8))
+# Hash uploaded files while they stream in, so attachments can be stored by
+# content (see AttachmentBlob).
+FILE_UPLOAD_HANDLERS = [
+    "app.uploads.HashingMemoryFileUploadHandler",
+    "app.uploads.HashingTemporaryFileUploadHandler",
+]
+# Concurrent storage uploads used by the multi-file attachment endpoint.
+ATTACHMENT_UPLOAD_WORKERS = int(os.getenv("ATTACHMENT_UPLOAD_WORKERS", 8))
+# Files read ahead concurrently by the attachment ZIP export, by default and
+# at most (?prefetch=N).
+EXPORT_PREFETCH = int(os.getenv("EXPORT_PREFETCH", 2))
+EXPORT_PREFETCH_MAX = 8
+# Thumbnail edge lengths generated for uploaded images, and the largest file
+# the worker will load to derive thumbnails or PDF previews from.
+THUMBNAIL_SIZES = [128, 512]
+DERIVATIVE_MAX_SOURCE_SIZE = int(
+    os.getenv("DERIVATIVE_MAX_SOURCE_SIZE", 64 * 1024 * 1024)
+)
+# Parsed and validated GraphQL documents kept per worker, and the persisted
+# queries written by `manage.py build_persisted_queries` from the frontend.
+GRAPHQL_DOCUMENT_CACHE_SIZE = int(os.getenv("GRAPHQL_DOCUMENT_CACHE_SIZE", 256))
+PERSISTED_QUERIES_MANIFEST = BASE_DIR / "frontend" / "persisted-queries.json"
+# Cache holding the persisted queries clients register at runtime. Only a
+# cache shared by all workers (Redis, Memcached) shares them; the default
+# local-memory cache keeps them per process.
+PERSISTED_QUERIES_CACHE = os.getenv("PERSISTED_QUERIES_CACHE", "default")
+# Static limits checked before a GraphQL operation runs (see app/query_cost.py):
+# nesting depth, cost (roughly the objects it may load, multiplying nested
+# connections by their first/last) and, if set, the cost a client may spend
+# per minute. The frontend's heaviest query costs about 31000.
+GRAPHQL_MAX_DEPTH = int(os.getenv("GRAPHQL_MAX_DEPTH", 10))
+GRAPHQL_MAX_COST = int(os.getenv("GRAPHQL_MAX_COST", 50000))
+GRAPHQL_COST_PER_MINUTE = int(os.getenv("GRAPHQL_COST_PER_MINUTE", 0)) or None
+# Adds per-resolver timings and query counts to GraphQL responses as
+# extensions.tracing, and the totals and slowest resolver paths to every
+# response as a Server-Timing header. Both expose the schema's internals, so
+# they are off unless DEBUG. /metrics is always on.
+GRAPHQL_TRACING = os.getenv("GRAPHQL_TRACING", str(DEBUG)).lower() in ("1", "true")
+GRAPHQL_SERVER_TIMING = os.getenv("GRAPHQL_SERVER_TIMING", str(DEBUG)).lower() in (
+    "1",
+    "true",
+)
+# Largest chunk accepted by the chunked attachment upload endpoint. With S3
+# storage every chunk but the last must be at least 5 MiB.
+ATTACHMENT_UPLOAD_CHUNK_SIZE = int(
+    os.getenv("ATTACHMENT_UPLOAD_CHUNK_SIZE", 8 * 1024 * 1024)
+)
+
+# Celery defaults to a filesystem broker inside the project directory, which the
+# web and worker containers share, so no Redis/RabbitMQ is needed. Point
+# CELERY_BROKER_URL at a real broker in production, or use "memory://" with
+# CELERY_TASK_ALWAYS_EAGER=1 to run tasks inline (e.g. in tests).
+CELERY_BROKER_URL = os.getenv("CELERY_BROKER_URL", "filesystem://")
+CELERY_QUEUE_DIR = os.getenv("CELERY_QUEUE_DIR", str(BASE_DIR / "var" / "celery"))
+CELERY_BROKER_TRANSPORT_OPTIONS = {
+    "data_folder_in": CELERY_QUEUE_DIR,
+    "data_folder_out": CELERY_QUEUE_DIR,
+    "control_folder": CELERY_QUEUE_DIR + "/control",
+}
+CELERY_TASK_ALWAYS_EAGER = os.getenv("CELERY_TASK_ALWAYS_EAGER", "") == "1"
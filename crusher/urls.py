@@ -19,11 +19,19 @@ from django.conf import settings
 from django.conf.urls.static import static
 from django.views.generic.base import TemplateView
 
-from graphene_django.views import GraphQLView
 import app.views
+from app.instrumentation import resolver_middleware
+from app.persisted_queries import cached_backend
+from app.models import Client, Contact, Invoice
 
 urlpatterns = [
-    path("graphql", GraphQLView.as_view(graphiql=True)),
+    path(
+        "graphql",
+        app.views.PersistedQueryGraphQLView.as_view(
+            graphiql=True, backend=cached_backend, middleware=resolver_middleware
+        ),
+    ),
+    path("metrics", app.views.MetricsView.as_view()),
     path(
         "upload/invoice-attachment/<uuid:invoice_uid>",
         app.views.InvoiceAttachmentView.as_view(),
@@ -36,6 +44,32 @@ urlpatterns = [
         "upload/client-attachment/<uuid:client_uid>",
         app.views.ClientAttachmentView.as_view(),
     ),
+    path(
+        "upload/invoice-attachment/<uuid:object_uid>/chunked",
+        app.views.ChunkedAttachmentView.as_view(model=Invoice, kind="invoice"),
+    ),
+    path(
+        "upload/contact-attachment/<uuid:object_uid>/chunked",
+        app.views.ChunkedAttachmentView.as_view(model=Contact, kind="contact"),
+    ),
+    path(
+        "upload/client-attachment/<uuid:object_uid>/chunked",
+        app.views.ChunkedAttachmentView.as_view(model=Client, kind="client"),
+    ),
+    path(
+        "upload/attachments/<str:model_name>/<uuid:object_uid>",
+        app.views.MultiAttachmentView.as_view(),
+    ),
+    path("upload/chunked/<uuid:session_uid>", app.views.UploadSessionView.as_view()),
+    path(
+        "export/<str:model_name>/<uuid:object_uid>.zip",
+        app.views.AttachmentExportView.as_view(),
+    ),
+    path(
+        "upload/signed/<str:token>",
+        app.views.SignedUploadView.as_view(),
+        name="signed-upload",
+    ),
     path(
         "upload/client-image/<uuid:client_uid>",
         app.views.ClientImageView.as_view(),